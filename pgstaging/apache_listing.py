@@ -1,73 +1,67 @@
 ##
-## HTML Parser for apache listings, with basic matching
+## Parser for apache listings, with basic matching
 ##
+## Apache mod_autoindex (and nginx autoindex) output one file per line, so
+## rather than running a full HTML parser we match each complete line
+## against a regular expression, as the chunks of the listing arrive.
+##
+
+import re, urllib
+
+# <tr><td valign="top"><img ...></td><td><a href="foo.dump">foo.dump</a></td>
+#     <td align="right">2011-03-11 02:00  </td><td align="right"> 29G</td>...
+TABLE_ROW = re.compile(r'<a href="(?P<href>[^"?/][^"]*)">.*?</a>\s*</td>'
+                       r'\s*<td[^>]*>[^<]*</td>'
+                       r'\s*<td[^>]*>\s*(?P<size>[^<]*?)\s*</td>', re.I)
 
-from HTMLParser import HTMLParser
+# <a href="foo.dump">foo.dump</a>     11-Mar-2011 02:00   29G
+# as given by Apache without HTMLTable, and by nginx
+PRE_LINE  = re.compile(r'<a href="(?P<href>[^"?/][^"]*)">.*?</a>'
+                       r'\s+\S+\s+\S+\s+(?P<size>\S+)', re.I)
 
-class ApacheListingParser(HTMLParser):
-    """ parses HTML listing given by Apache mod_dir """
+class ApacheListingParser:
+    """ parses HTML listing given by Apache mod_autoindex """
 
     def __init__(self, content, pattern):
-        """ buffer is a file-like object, contains the HTML source """
-        self.buffering = False
-        self.buffer    = ""
+        """ content is an iterable of HTML chunks, of any size """
         self.content   = content
         self.pattern   = pattern
-        HTMLParser.__init__(self)
-
-        self.current_tag    = None
-        self.current_file   = None
-        self.saw_a          = False
-        self.n_td_since_a   = 0
 
-        # [('filename', 'size'), ...]
-        self.files = []
+        # incomplete last line of the chunks seen so far
+        self.buffer    = ""
 
     def parse(self):
-        for line in self.content:
-            self.feed(line)
-
-        return self.files
-
-    def handle_starttag(self, tag, attrs):
-        if tag == 'a':
-            self.buffering = True
-            self.saw_a     = True
-
-        if tag == 'td':
-            if self.saw_a:
-                self.n_td_since_a += 1
-
-            if self.n_td_since_a == 2:
-                self.buffering = True
-
-        self.current_tag = tag
-
-    def handle_endtag(self, tag):
-        if self.current_tag == 'a':
-            if self.buffer.find(self.pattern) > -1:
-                self.current_file = self.buffer
+        """ return [(size, filename), ...] """
+        files = []
+        for chunk in self.content:
+            files.extend(self.feed(chunk))
 
-            self.buffering = False
+        files.extend(self.close())
+        return files
 
-        if self.current_tag == 'td':
-            if self.buffering and self.current_file:
-                self.files.append((self.buffer, self.current_file))
+    def feed(self, chunk):
+        """ consume a chunk, return the files found in the lines it ends """
+        lines = (self.buffer + chunk).split('\n')
+        self.buffer = lines.pop()
 
-            self.buffering = False
+        return [f for line in lines for f in self.match(line)]
 
-        if tag == 'tr':
-            self.n_td_since_a = 0
-            self.current_file = None
-            self.saw_a        = False
+    def close(self):
+        """ return the files found in the last line, if any """
+        line, self.buffer = self.buffer, ""
+        return self.match(line)
 
-        # clean up for next tag data
-        self.current_tag = None
-        self.buffer      = ""
+    def match(self, line):
+        """ return [(size, filename)] for the file given on this line """
+        m = TABLE_ROW.search(line) or PRE_LINE.search(line)
+        if m is None:
+            return []
 
-    def handle_data(self, data):
-        if self.buffering:
-            if data.strip('\r\n') != '':
-                self.buffer += data
+        # anchor text is truncated on long names, the href is not
+        filename = urllib.unquote(m.group('href'))
 
+        # skip sub directories
+        if filename.endswith('/') or filename.find(self.pattern) == -1:
+            return []
 
+        return [(m.group('size'), filename)]
@@ -0,0 +1,161 @@
+##
+## Filter a pg_restore -l catalog in a single pass
+##
+## The catalog lines we filter look like this:
+##
+##   3385; 1259 123008 TABLE londiste subscriber_table payment
+##   6662; 0 788811 TABLE DATA payment abocb_code payment
+##   6236; 2620 15995620 TRIGGER jdb www_to_reporting_logger webadmin
+##
+## Everything we need to decide about a line is compiled once: the schemas
+## to restore and the tables to restore without their data are sets, the
+## relname_nodata regexps are a single alternation unless one of them uses
+## backreferences or named groups, that the alternation would renumber or
+## duplicate, or inline flags, that would apply to all of them, and the
+## triggers are reduced to the set of those calling a function we don't
+## restore. Each line is then searched once for the object types we know
+## about and split once, and is written out as it comes, commented out
+## when we skip it.
+##
+
+import re
+
+# what an alternation of regexps would break: group references and names,
+# and inline flags, that are global to the whole pattern
+GROUP_REFERENCES = re.compile(r'\\\d|\(\?P[=<]|\(\?[iLmsux]')
+
+# lines about other objects are always restored
+KEYWORDS = re.compile('SCHEMA|ACL|TABLE|TYPE|FUNCTION|OPERATOR|CAST|SEQUENCE'
+                      '|VIEW|COMMENT|DEFAULT|INDEX|TRIGGER|DOMAIN|CONSTRAINT')
+
+class catalogfilter:
+    """ Comment out the catalog lines of what we don't restore """
+
+    def __init__(self, schemas = None, schemas_nodata = None,
+                 tables = None, relname_nodata = None, triggers = None):
+        """ tables are schema.table names to restore without data, triggers
+        is what restore.pgrestore.get_trigger_funcs() returns """
+        # schemas we restore at least the structure of
+        self.schemas = set(schemas or []) | set(schemas_nodata or [])
+        if self.schemas:
+            self.schemas.add('pg_catalog')
+
+        self.nodata = set(schemas_nodata or [])
+        self.tables = set([tuple(t.split('.')[:2]) for t in tables or []])
+
+        self.relname = []
+        if relname_nodata:
+            if [r for r in relname_nodata if GROUP_REFERENCES.search(r)]:
+                self.relname = [re.compile(r) for r in relname_nodata]
+            else:
+                alternation  = "|".join(["(?:%s)" % r for r in relname_nodata])
+                self.relname = [re.compile(alternation)]
+
+        # (schema, trigger) of triggers calling a function we skip
+        self.triggers = set()
+        for schema, funcs in (triggers or {}).items():
+            for trigger, procs in funcs.items():
+                for p in procs:
+                    if p.split('.')[0] not in self.schemas:
+                        self.triggers.add((schema, trigger))
+                        break
+
+        # counted by the last self.filter() call
+        self.lines    = 0
+        self.filtered = 0
+
+    def filter_out(self, line):
+        """ should we skip the object of this catalog line? """
+        if not KEYWORDS.search(line):
+            return False
+
+        fields = line.split()
+        if len(fields) < 7:
+            return False
+
+        a, b, c, d = fields[3:7]
+        table = None
+
+        if a in ('ACL', 'SCHEMA'):
+            if b == '-':
+                schema = c
+            else:
+                schema = b
+
+        elif a == 'COMMENT':
+            if b == '-' and c == 'SCHEMA':
+                schema = d
+            elif b != '-':
+                schema = b
+            else:
+                # comments on objects outside of any schema
+                return False
+
+        elif b == 'CLASS':
+            schema = c
+
+        elif b == 'DATA':
+            schema = c
+            table  = d
+
+        elif a == 'SEQUENCE':
+            if b == 'OWNED' and c == 'BY':
+                schema = d
+            elif b == 'SET':
+                schema = c
+            else:
+                schema = b
+
+        elif a == 'FK' and b == 'CONSTRAINT':
+            schema = c
+
+        else:
+            schema = b
+
+        # ACL lines for schemas we exclude
+        if a == 'ACL' and b == '-' and c not in self.schemas:
+            return True
+
+        if schema not in self.schemas:
+            return True
+
+        # triggers depending on a function we don't restore
+        if a == 'TRIGGER' and (b, c) in self.triggers:
+            return True
+
+        if a == 'TABLE' and b == 'DATA':
+            if schema in self.nodata or (schema, table) in self.tables:
+                return True
+
+            relname = "%s.%s" % (schema, table)
+            for r in self.relname:
+                if r.search(relname):
+                    return True
+
+        return False
+
+    def filter(self, lines, out):
+        """ write the catalog lines to the out file object, commenting out
+        the ones we skip, without a trailing newline """
+        write      = out.write
+        filter_out = self.filter_out
+
+        self.lines    = 0
+        self.filtered = 0
+
+        sep = ''
+        for line in lines:
+            line = line.rstrip('\n')
+            if line.strip() == "":
+                continue
+
+            self.lines += 1
+
+            # filter_out means we turn it into a comment
+            if filter_out(line):
+                self.filtered += 1
+                write(sep + ';' + line)
+            else:
+                write(sep + line)
+
+            sep = '\n'
@@ -1,9 +1,9 @@
 ##
 ## Commands available both in command line or in console
 ##
-import os, os.path, ConfigParser
+import os, os.path, time, ConfigParser
 
-import utils
+import utils, httppool, fetch
 from staging import Staging
 from options import DEBUG, VERBOSE, DRY_RUN
 
@@ -95,6 +95,76 @@ def parse_config(conffile,
                 relname_nodata = [s.strip() for s in relname_nodata.split(',')]
             staging.relname_nodata = relname_nodata
 
+            restore_stream = get_option(config, dbname, "restore_stream", True)
+            staging.restore_stream = restore_stream == "True"
+
+            fetch_jobs = get_option(config, dbname, "fetch_jobs", True)
+            if fetch_jobs:
+                staging.fetch_jobs = int(fetch_jobs)
+
+            host_fetch_jobs = get_option(config, dbname,
+                                         "host_fetch_jobs", True)
+            if host_fetch_jobs:
+                staging.host_fetch_jobs = int(host_fetch_jobs)
+
+            cache_size = get_option(config, dbname, "cache_size", True)
+            if cache_size:
+                staging.cache_size = utils.parse_size(cache_size)
+
+            toc_cache = get_option(config, dbname, "toc_cache", True)
+            if toc_cache:
+                staging.toc_cache = toc_cache == "True"
+
+            listing_ttl = get_option(config, dbname, "listing_ttl", True)
+            if listing_ttl:
+                staging.listing_ttl = int(listing_ttl)
+
+            listing_url = get_option(config, dbname, "listing_url", True)
+            if listing_url:
+                staging.listing_url = listing_url
+
+            host_rate_limit = get_option(config, dbname,
+                                         "host_rate_limit", True)
+            if host_rate_limit:
+                staging.host_rate_limit = utils.parse_size(host_rate_limit)
+
+            fetch_rate_limit = get_option(config, dbname,
+                                          "fetch_rate_limit", True)
+            if fetch_rate_limit:
+                staging.fetch_rate_limit = utils.parse_size(fetch_rate_limit)
+
+            mirror_min_rate = get_option(config, dbname,
+                                         "mirror_min_rate", True)
+            if mirror_min_rate:
+                staging.mirror_min_rate = utils.parse_size(mirror_min_rate)
+
+            watch_interval = get_option(config, dbname, "watch_interval", True)
+            if watch_interval:
+                staging.watch_interval = int(watch_interval)
+
+            fetch_drop_cache = get_option(config, dbname,
+                                          "fetch_drop_cache", True)
+            if fetch_drop_cache:
+                staging.fetch_drop_cache = fetch_drop_cache == "True"
+
+            fetch_direct_io = get_option(config, dbname,
+                                         "fetch_direct_io", True)
+            if fetch_direct_io:
+                staging.fetch_direct_io = fetch_direct_io == "True"
+
+            fetch_buffer_size = get_option(config, dbname,
+                                           "fetch_buffer_size", True)
+            if fetch_buffer_size:
+                staging.fetch_buffer_size = utils.parse_size(fetch_buffer_size)
+
+            remote_fetch = get_option(config, dbname, "remote_fetch", True)
+            if remote_fetch:
+                staging.remote_fetch = remote_fetch == "True"
+
+            remote_restore = get_option(config, dbname, "remote_restore", True)
+            if remote_restore:
+                staging.remote_restore = remote_restore == "True"
+
             search_path = get_option(config, dbname, "search_path", True)
             if search_path:
                 search_path = [s.strip() for s in search_path.split(',')]
@@ -301,12 +371,88 @@ def restore(conffile, args):
     # now load configuration and restore
     staging = parse_config(conffile, dbname)
     staging.set_backup_date(backup_date, 'latest')
+    run_restore(staging)
+
+def run_restore(staging):
+    """ restore the dump of given staging object and report timings """
     wget_t, pgrestore_t, vacuumdb_t = staging.restore()
 
-    print "  fetching:", duration_pprint(wget_t)
-    print "pg_restore:", duration_pprint(pgrestore_t)
+    if wget_t is None:
+        # the dump has been streamed into pg_restore
+        print " streaming:", duration_pprint(pgrestore_t)
+    else:
+        print "  fetching:", duration_pprint(wget_t)
+        print "pg_restore:", duration_pprint(pgrestore_t)
+
+    if staging.wget_rate:
+        print "      rate: %s/s" % staging.pp_file_size(staging.wget_rate)
+
+    if staging.wget_resident is not None:
+        print "    cached: %s of the dump in page cache" \
+              % staging.pp_file_size(staging.wget_resident)
+
+    if staging.wget_progress:
+        print_fetch_summary(staging.wget_progress)
+
+    if staging.wget_compression:
+        print_compression(staging, staging.wget_compression)
     print "    vacuum:", duration_pprint(vacuumdb_t)
 
+    if staging.tocs and staging.tocs.hits:
+        print " toc cache:", duration_pprint(staging.tocs.saved), \
+              "of pg_restore saved"
+
+    # the restore stages ran concurrently, tell what bounded the run
+    p = staging.restore_pipeline
+    print
+    print "%12s  %10s  %10s" % ('stage', 'start', 'duration')
+    for name, start, secs in p.timings():
+        print "%12s  %10s  %10s" % (name,
+                                    duration_pprint(start),
+                                    duration_pprint(secs))
+
+    print "  total:", duration_pprint(p.end_time - p.start_time)
+    print "  critical path:", " > ".join(p.critical_path())
+
+    print_http_stats()
+
+def watch(conffile, args):
+    """ <dbname> wait for the next dump, then restore it """
+    import watch
+
+    usage = "watch <dbname>"
+    if len(args) != 1:
+        raise WrongNumberOfArgumentsException, usage
+
+    staging = parse_config(conffile, args[0])
+
+    w = watch.watcher(staging, staging.watch_interval)
+    staging.set_backup_date(w.wait().isoformat())
+
+    run_restore(staging)
+
+    # the new database is live once pgbouncer is switched to it
+    p = staging.restore_pipeline
+    done = p.ended.get('switch', p.end_time)
+
+    published, detected, total = w.freshness(done)
+    print
+    if published is not None:
+        print "  detected:", duration_pprint(published), "after publication"
+    print "  restored:", duration_pprint(detected), "after detection"
+    if total is not None:
+        print " freshness:", duration_pprint(total), \
+              "from the dump Last-Modified to the %s" \
+              % ('switch' in p.ended and "switch" or "restore")
+
+def print_http_stats():
+    """ in verbose mode, tell how many HTTP connections we could reuse """
+    from options import VERBOSE
+
+    if VERBOSE:
+        print "  http connections: %(new)d new, %(reused)d reused" \
+              % httppool.stats()
+
 def restore_from_dump(conffile, args):
     """ <dbname> <dumpfile> """
     usage = "load <dbname> <dumpfile>"
@@ -317,6 +463,9 @@ def restore_from_dump(conffile, args):
     staging = parse_config(conffile, args[0])
     secs = staging.load(args[1])
 
+    if staging.wget_compression:
+        print_compression(staging, staging.wget_compression)
+
     print "load time:", duration_pprint(secs)
 
 def fetch_dump(conffile, args):
@@ -332,6 +481,169 @@ def fetch_dump(conffile, args):
 
     print "  timing", duration_pprint(staging.wget_timing)
 
+    if staging.wget_rate:
+        print "  rate   %s/s" % staging.pp_file_size(staging.wget_rate)
+
+    if staging.wget_resident is not None:
+        print "  cached %s of the dump in page cache" \
+              % staging.pp_file_size(staging.wget_resident)
+
+    if staging.wget_progress:
+        print_fetch_summary(staging.wget_progress)
+
+    if staging.wget_compression:
+        print_compression(staging, staging.wget_compression)
+
+    print_http_stats()
+
+def bench_fetch(conffile, args):
+    """ <dbname> [size] """
+    from options import BUFSIZE
+    usage = "bench <dbname> [size]"
+
+    dbname, size = parse_args_for_dbname_and_date(args, usage)
+
+    staging = parse_config(conffile, dbname)
+    size    = utils.parse_size(size or "1G")
+    bufsize = staging.fetch_buffer_size or BUFSIZE
+
+    print "receiving %s with a %s buffer" \
+          % (staging.pp_file_size(size), staging.pp_file_size(bufsize))
+
+    print "%10s %12s %12s" % ("loop", "cpu s/GB", "wall s/GB")
+    for name, reuse in (("read", False), ("readinto", True)):
+        cpu, wall = fetch.benchmark(size, bufsize, reuse)
+        print "%10s %12.3f %12.3f" % (name,
+                                      cpu * 2**30 / size,
+                                      wall * 2**30 / size)
+
+def bench_toc(conffile, args):
+    """ <dbname> [dump] """
+    import dumptoc
+    usage = "bench-toc <dbname> [dump]"
+
+    if len(args) not in (1, 2):
+        raise WrongNumberOfArgumentsException, usage
+
+    staging  = parse_config(conffile, args[0])
+    filename = None
+
+    if len(args) > 1:
+        filename = args[1]
+
+    if filename is None or not os.path.exists(filename):
+        staging.set_backup_date(None)
+        filename = staging.get_dump()
+        print filename
+
+    native, forked = dumptoc.benchmark(filename, staging.pg_restore)
+
+    print "%12s %10s %10s" % ("TOC read by", "lines", "wall")
+    for name, (secs, lines) in (("dumptoc", native),
+                                ("pg_restore", forked)):
+        print "%12s %10d %10s" % (name, lines, duration_pprint(secs))
+
+def bench_restore(conffile, args):
+    """ <dbname> [date] """
+    usage = "bench-restore <dbname> [date]"
+
+    dbname, backup_date = parse_args_for_dbname_and_date(args, usage)
+
+    staging = parse_config(conffile, dbname)
+    staging.set_backup_date(backup_date, 'latest')
+
+    results = staging.bench_restore()
+
+    print
+    print "%14s  %10s  %10s  %10s" % ('pg_restore via', 'fetch',
+                                      'pg_restore', 'total')
+    for path, wget_t, pgrestore_t, total in results:
+        # streamed restores have no separate fetch timing
+        fetch_t = "-"
+        if wget_t is not None:
+            fetch_t = duration_pprint(wget_t)
+
+        print "%14s  %10s  %10s  %10s" % (path,
+                                          fetch_t,
+                                          duration_pprint(pgrestore_t),
+                                          duration_pprint(total))
+
+def print_compression(staging, s):
+    """ print the sizes, ratio and decompression cost of a dump """
+    line = "%s, %s -> %s" % (s['kind'],
+                             staging.pp_file_size(s['compressed']),
+                             staging.pp_file_size(s['uncompressed']))
+    if s['ratio']:
+        line += " (x%.1f)" % s['ratio']
+
+    print "  compress:", line
+
+    line = duration_pprint(s['secs'])
+    if s['rate']:
+        line += ", %s/s" % staging.pp_file_size(s['rate'])
+
+    print "decompress:", line
+
+def print_fetch_summary(p):
+    """ print time to first byte, then a machine readable summary """
+    s = p.summary()
+    if s['ttfb'] is not None:
+        print "      ttfb:", duration_pprint(s['ttfb'])
+
+    print "   summary:", p.record()
+
+def prefetch(conffile, args):
+    """ fetch the latest dumps of given sections ahead of restore """
+    import prefetch
+    from options import PREFETCH_WORKERS
+
+    usage = "prefetch --all | --match <regexp> | <dbname> [<dbname> ...]"
+    args  = parse_args_for_sections(conffile, args, usage)
+
+    p = prefetch.prefetcher(PREFETCH_WORKERS)
+    for db in args:
+        p.add(parse_config(conffile, db))
+
+    for section, filename, status, secs in p.run():
+        print "%-25s %-30s %10s  %s" % (section, filename,
+                                        duration_pprint(secs), status)
+
+    print_http_stats()
+
+def fanout(conffile, args):
+    """ fetch the latest dump once, restore it in all given sections """
+    import fanout
+
+    usage = "fanout --all | --match <regexp> | <dbname> [<dbname> ...]"
+    args  = parse_args_for_sections(conffile, args, usage)
+
+    f = fanout.fanout()
+    for db in args:
+        f.add(parse_config(conffile, db))
+
+    results = f.run()
+
+    print
+    for url, sections, status, secs in f.fetches:
+        print "%s: %s in %s, for %s" % (url, status, duration_pprint(secs),
+                                        ", ".join(sections))
+
+    print
+    print "%-25s %-15s %-25s %10s %10s  %s" % ('section', 'host', 'database',
+                                             'pg_restore', 'total', 'status')
+    for section, host, dbname, status, p in results:
+        pgrestore_t, total = '-', '-'
+        if p and 'pg_restore' in p.ended:
+            pgrestore_t = duration_pprint(p.ended['pg_restore']
+                                          - p.started['pg_restore'])
+        if p and hasattr(p, 'end_time'):
+            total = duration_pprint(p.end_time - p.start_time)
+
+        print "%-25s %-15s %-25s %10s %10s  %s" % (section, host, dbname,
+                                                   pgrestore_t, total, status)
+
+    print_http_stats()
+
 def purge(conffile, args):
     """ purge <dbname> """
     usage = "purge <dbname>"
@@ -426,15 +738,25 @@ def list_databases(conffile, args):
 def list_backups(conffile, args):
     """ list available backups for a given database """
     if len(args) not in (1, 2):
-        raise WrongNumberOfArgumentsException, "backups <dbname> [remote|local|oldest|latest]"
-
-    if len(args) == 2 and args[1] not in ('oldest', 'latest', 'remote', 'local'):
-        mesg = "backups command can list only 'oldest' or 'latest' backup"
-        raise UnknownOptionException, mesg
+        raise WrongNumberOfArgumentsException, "backups <dbname> [remote|local|cache|mirrors|oldest|latest|<date>]"
 
     dbname = args[0]
     staging = parse_config(conffile, dbname)
 
+    if len(args) == 2 and args[1] not in ('oldest', 'latest', 'remote',
+                                          'local', 'cache', 'mirrors'):
+        try:
+            staging.parse_date(args[1])
+        except ValueError:
+            mesg = "backups command can list only 'remote', 'local', " \
+                   "'cache', 'mirrors', 'oldest', 'latest' or the backup " \
+                   "nearest to a YYYYMMDD or YYYY-MM-DD date"
+            raise UnknownOptionException, mesg
+
+        # the backup nearest to given date
+        print "%6s %s " % staging.get_nearest_backup(args[1])
+        return
+
     if len(args) == 1 or args[1] == 'remote':
         for size, backup in staging.list_backups():
             print "%6s %s " % (size, backup)
@@ -448,6 +770,30 @@ def list_backups(conffile, args):
         for size, backup in staging.list_local_backups():
             print "%6s %s " % (size, backup)
 
+    elif args[1] == 'cache':
+        backups, stats = staging.list_cached_backups()
+        for size, backup in backups:
+            print "%6s %s " % (size, backup)
+
+        if stats:
+            print "hits: %d, misses: %d, evictions: %d, saved: %s" \
+                  % (stats['hits'], stats['misses'], stats['evictions'],
+                     staging.pp_file_size(stats['hit_bytes']))
+
+    elif args[1] == 'mirrors':
+        for host, rate, measured, failed, error \
+                in staging.get_mirrors().list(staging.backup_hosts):
+            status = []
+            if rate is not None:
+                status.append("%s/s, %s ago"
+                              % (staging.pp_file_size(rate),
+                                 duration_pprint(time.time() - measured)))
+            if failed is not None:
+                status.append("failed %s ago: %s"
+                              % (duration_pprint(time.time() - failed), error))
+
+            print "%-30s %s" % (host, ", ".join(status) or "unknown")
+
 def psql_connect(conffile, args):
     """ launch a psql connection to the given configured section """
     usage = "psql <dbname> [date]"
@@ -487,14 +833,13 @@ def show_dbsize(conffile, args):
     name, size, pretty = staging.dbsize()
     print "%25s: %s" % (name, pretty)
 
-def show_all_dbsizes(conffile, args):
-    """ show dbsize for all databases of a dbname section """
-    usage = "dbsizes <dbname> [<dbname> ...]"
+def parse_args_for_sections(conffile, args, usage):
+    """ expand --all and --match <regexp> into a list of sections """
+    import sys
+
     if len(args) < 1:
         raise WrongNumberOfArgumentsException, usage
 
-    total_size = 0
-
     if args[0] in ('--all', '--match'):
         config = ConfigParser.SafeConfigParser()
 
@@ -517,6 +862,15 @@ def show_all_dbsizes(conffile, args):
 
         args = [x for x in config.sections() if regexp.search(x)]
 
+    return args
+
+def show_all_dbsizes(conffile, args):
+    """ show dbsize for all databases of a dbname section """
+    usage = "dbsizes <dbname> [<dbname> ...]"
+    args  = parse_args_for_sections(conffile, args, usage)
+
+    total_size = 0
+
     for db in args:
         # now load configuration and restore
         staging = parse_config(conffile, db)
@@ -778,6 +1132,12 @@ exports = {
     "load":      restore_from_dump,
     "createdb":  createdb,
     "fetch":     fetch_dump,
+    "prefetch":  prefetch,
+    "fanout":    fanout,
+    "watch":     watch,
+    "bench":     bench_fetch,
+    "bench-restore": bench_restore,
+    "bench-toc": bench_toc,
     "pitr":      pitr,
     "presql":    pre_source_extra_files,
     "postsql":   post_source_extra_files,
@@ -0,0 +1,219 @@
+##
+## Decompress dumps on the fly
+##
+## Backups published as .dump.gz or .dump.zst files, or served with a
+## Content-Encoding, are decompressed while they're being received, so
+## that only compressed bytes travel over the network. gzip is handled
+## with zlib, zstd with the zstd command line tool.
+##
+
+import os, time, zlib, threading, subprocess
+
+from utils import CorruptDumpException, UnknownCommandException
+
+# filename extension: compression
+EXTENSIONS = {'.gz': 'gzip', '.zst': 'zstd'}
+
+# decompressed to compressed size ratio we plan room for, until we have
+# decompressed such a dump: custom format dumps made with -Z0 compress well
+ESTIMATED_RATIO = 4
+
+# Content-Encoding: compression
+ENCODINGS  = {'gzip': 'gzip', 'x-gzip': 'gzip', 'zstd': 'zstd'}
+
+ZSTD = "zstd"
+
+def kind_of(filename):
+    """ return the compression of given file name, or None """
+    for ext, kind in EXTENSIONS.items():
+        if filename.endswith(ext):
+            return kind
+    return None
+
+def kind_of_encoding(encoding):
+    """ return the compression of given Content-Encoding, or None """
+    if encoding is None:
+        return None
+    return ENCODINGS.get(encoding.strip().lower())
+
+def available():
+    """ return the extensions we know how to decompress, preferred first """
+    exts = []
+
+    # zstd decompresses faster, when we have it
+    for d in os.environ.get('PATH', os.defpath).split(os.pathsep):
+        if os.access(os.path.join(d, ZSTD), os.X_OK):
+            exts.append('.zst')
+            break
+
+    exts.append('.gz')
+    return exts
+
+def strip_extension(filename):
+    """ foo.2011-03-11.dump.gz is foo.2011-03-11.dump """
+    for ext in EXTENSIONS:
+        if filename.endswith(ext):
+            return filename[:-len(ext)]
+    return filename
+
+def decompressedstream(source, kind):
+    """ return a file-like object reading source, decompressed """
+    if kind == 'gzip':
+        return gzipstream(source)
+
+    if kind == 'zstd':
+        return zstdstream(source)
+
+    raise CorruptDumpException, "Unknown compression '%s'" % kind
+
+class gzipstream:
+    """ Decompress a gzip stream, made of one or more members """
+
+    def __init__(self, source):
+        self.source  = source
+        self.kind    = 'gzip'
+        self.z       = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        self.eof     = False
+
+        # statistics
+        self.read_bytes    = 0
+        self.written_bytes = 0
+        self.secs          = 0
+
+    def read(self, size):
+        """ return some decompressed data, '' at end of stream """
+        while not self.eof:
+            data = self.source.read(size)
+            self.read_bytes += len(data)
+
+            start = time.time()
+            try:
+                # zlib checks the CRC32 and ISIZE trailer of each member as
+                # it reaches it, a stream that ends before that is truncated
+                if not data:
+                    if not self.member_done():
+                        raise CorruptDumpException, \
+                              "gzip: unexpected end of stream after %d bytes" \
+                              % self.read_bytes
+
+                    out = self.z.flush()
+                    self.eof = True
+                else:
+                    out = self.z.decompress(data)
+
+                    # pigz and cat produce concatenated gzip members
+                    while self.z.unused_data:
+                        rest   = self.z.unused_data
+                        self.z = zlib.decompressobj(16 + zlib.MAX_WBITS)
+                        out   += self.z.decompress(rest)
+
+            except zlib.error, e:
+                raise CorruptDumpException, "gzip: %s" % e
+
+            self.secs += time.time() - start
+
+            if out:
+                self.written_bytes += len(out)
+                return out
+
+        return ""
+
+    def member_done(self):
+        """ did the current member end, trailer included? Once it did, zlib
+        leaves whatever we give it in unused_data """
+        probe = self.z.copy()
+        probe.decompress('\0')
+        return probe.unused_data == '\0'
+
+class zstdstream:
+    """ Decompress a zstd stream with the zstd command line tool, fed by a
+    thread """
+
+    def __init__(self, source):
+        from options import BUFSIZE
+
+        self.source  = source
+        self.kind    = 'zstd'
+
+        try:
+            self.proc = subprocess.Popen([ZSTD, "-d", "-c", "-q"],
+                                         stdin  = subprocess.PIPE,
+                                         stdout = subprocess.PIPE,
+                                         bufsize = BUFSIZE)
+        except OSError, e:
+            mesg = "Error: %s command: %s" % (ZSTD, e.strerror)
+            raise UnknownCommandException, mesg
+
+        self.error   = None
+        self.rusage  = None
+
+        # statistics
+        self.read_bytes    = 0
+        self.written_bytes = 0
+        self.secs          = 0
+
+        self.feeder  = threading.Thread(target = self.feed)
+        self.feeder.setDaemon(True)
+        self.feeder.start()
+
+    def feed(self):
+        """ thread body: copy source into zstd stdin """
+        from options import BUFSIZE
+
+        try:
+            try:
+                data = self.source.read(BUFSIZE)
+                while data:
+                    self.read_bytes += len(data)
+                    self.proc.stdin.write(data)
+                    data = self.source.read(BUFSIZE)
+
+            except Exception, e:
+                # read() raises it in the main thread
+                self.error = e
+        finally:
+            try:
+                self.proc.stdin.close()
+            except IOError:
+                pass
+
+    def read(self, size):
+        """ return some decompressed data, '' at end of stream """
+        data = os.read(self.proc.stdout.fileno(), size)
+
+        if data:
+            self.written_bytes += len(data)
+            return data
+
+        self.feeder.join()
+
+        # the CPU time zstd used is our decompression cost
+        pid, status, self.rusage = os.wait4(self.proc.pid, 0)
+        self.proc.returncode = os.WEXITSTATUS(status)
+        self.secs = self.rusage.ru_utime + self.rusage.ru_stime
+
+        if self.error:
+            raise self.error
+
+        if status != 0:
+            mesg = "zstd failed with status %d" % self.proc.returncode
+            raise CorruptDumpException, mesg
+
+        return ""
+
+def stats(stream):
+    """ return compression statistics of a decompressed stream """
+    s = {'kind':         stream.kind,
+         'compressed':   stream.read_bytes,
+         'uncompressed': stream.written_bytes,
+         'secs':         stream.secs,
+         'ratio':        None,
+         'rate':         None}
+
+    if stream.read_bytes:
+        s['ratio'] = float(stream.written_bytes) / stream.read_bytes
+
+    if stream.secs > 0:
+        s['rate'] = stream.written_bytes / stream.secs
+
+    return s
@@ -0,0 +1,322 @@
+##
+## Size bounded cache of the dump files fetched into tmpdir
+##
+## The index is kept in tmpdir/pg_staging.cache, with a section per backup
+## URL giving the local file name, its size, the mirror and the remote
+## validators (ETag and Last-Modified) it was fetched with, its verified
+## digest and when it was last used. Mirrors serve the same file with
+## their own ETags, so the ETag is only checked against the same mirror.
+## When adding a dump makes the cache go over its budget, the least
+## recently used dumps are removed, except the ones a running restore
+## pinned, by process id, until it's done with them.
+##
+## Compressed dumps are kept decompressed, so we also record the size of
+## the local file, which is what counts against the budget.
+##
+
+import os, time, errno, fcntl, threading, ConfigParser
+
+import compress
+
+INDEX = "pg_staging.cache"
+STATS = "stats"
+
+class dumpcache:
+    """ Keep dump files in tmpdir, within a byte budget """
+
+    # threads of the same process share the index file
+    lock = threading.Lock()
+
+    def __init__(self, tmpdir, budget):
+        """ budget is a number of bytes, or None for no limit """
+        self.tmpdir = tmpdir
+        self.budget = budget
+        self.index  = os.path.join(tmpdir, INDEX)
+
+    def key(self, hosts, url):
+        """ cache entries are keyed by the backup URL, whatever the mirror
+        in hosts we fetch it from """
+        if url.startswith('file://'):
+            return url
+
+        return "http://%s%s" % (",".join(sorted(hosts)), url)
+
+    def open(self):
+        """ lock and read the index, return (lockfile, config) """
+        self.lock.acquire()
+
+        lockfile = open("%s.lock" % self.index, "w")
+        fcntl.flock(lockfile, fcntl.LOCK_EX)
+
+        config = ConfigParser.RawConfigParser()
+        config.read(self.index)
+
+        if not config.has_section(STATS):
+            config.add_section(STATS)
+            for s in ('hits', 'misses', 'evictions', 'hit_bytes'):
+                config.set(STATS, s, 0)
+
+        return lockfile, config
+
+    def close(self, lockfile, config, write = True):
+        """ write the index back and release the locks """
+        try:
+            if write:
+                tmpname = "%s.tmp" % self.index
+                fd = open(tmpname, "w")
+                config.write(fd)
+                fd.close()
+                os.rename(tmpname, self.index)
+        finally:
+            fcntl.flock(lockfile, fcntl.LOCK_UN)
+            lockfile.close()
+            self.lock.release()
+
+    def count(self, config, stat, value = 1):
+        """ increment given statistic """
+        config.set(STATS, stat, config.getint(STATS, stat) + value)
+
+    def get(self, key, host, size, etag, last_modified, pin = False):
+        """ return the cached filename for key when its validators match the
+        remote ones of host, or None. With pin, the dump is not evicted
+        until self.unpin() """
+        from options import TERSE, VERBOSE
+
+        lockfile, config = self.open()
+        try:
+            filename = self.valid(config, key, host, size, etag,
+                                  last_modified)
+
+            if filename is None and config.has_section(key) \
+                   and not self.pinned(config, key):
+                if VERBOSE:
+                    print "cache: '%s' is stale" % config.get(key, 'filename')
+                self.remove(config, key)
+
+            if filename and pin:
+                self.add_pin(config, key)
+
+            if filename:
+                config.set(key, 'atime', time.time())
+                self.count(config, 'hits')
+                self.count(config, 'hit_bytes', size)
+
+                if not TERSE:
+                    print "cache hit: '%s'" % filename
+            else:
+                self.count(config, 'misses')
+
+            return filename
+
+        finally:
+            self.close(lockfile, config)
+
+    def peek(self, key, host, size, etag, last_modified):
+        """ return the cached filename for key like self.get() does, without
+        using it """
+        lockfile, config = self.open()
+        try:
+            return self.valid(config, key, host, size, etag, last_modified)
+
+        finally:
+            self.close(lockfile, config, write = False)
+
+    def valid(self, config, key, host, size, etag, last_modified):
+        """ return the filename of the cached dump when it's there and its
+        validators match the remote ones of host, or None """
+        if not config.has_section(key):
+            return None
+
+        name = config.get(key, 'filename')
+
+        same_host = not config.has_option(key, 'host') \
+                    or config.get(key, 'host') == str(host)
+
+        valid = config.getint(key, 'size') == size \
+                and (config.get(key, 'etag') == str(etag) or not same_host) \
+                and config.get(key, 'last_modified') == str(last_modified)
+
+        if valid and os.path.exists(name) \
+               and os.path.getsize(name) == self.local_size(config, key):
+            return name
+
+        return None
+
+    def ratio(self, kind):
+        """ return the highest decompressed to compressed size ratio of the
+        cached dumps of given compression kind, or None """
+        lockfile, config = self.open()
+        try:
+            ratios = [float(self.local_size(config, k))
+                      / config.getint(k, 'size')
+                      for k in self.entries(config)
+                      if compress.kind_of(k) == kind
+                      and config.getint(k, 'size') > 0]
+
+            return ratios and max(ratios) or None
+
+        finally:
+            self.close(lockfile, config, write = False)
+
+    def add(self, key, host, filename, size, etag, last_modified,
+            digest = None, local_size = None, pin = False):
+        """ register a dump freshly fetched from host, evicting older ones,
+        pinning it as self.get() does """
+        lockfile, config = self.open()
+        try:
+            # another key could have been using the same local file
+            for k in self.entries(config):
+                if k != key and config.get(k, 'filename') == filename:
+                    config.remove_section(k)
+
+            if not config.has_section(key):
+                config.add_section(key)
+
+            config.set(key, 'filename', filename)
+            config.set(key, 'size', size)
+            config.set(key, 'host', str(host))
+            config.set(key, 'etag', str(etag))
+            config.set(key, 'last_modified', str(last_modified))
+            config.set(key, 'digest', str(digest))
+            config.set(key, 'atime', time.time())
+
+            if local_size is not None:
+                config.set(key, 'local_size', local_size)
+
+            if pin:
+                self.add_pin(config, key)
+
+            self.evict(config, keep = key)
+
+        finally:
+            self.close(lockfile, config)
+
+    def unpin(self, key):
+        """ the restore is done with the dump we pinned """
+        lockfile, config = self.open()
+        try:
+            if config.has_option(key, 'pins'):
+                pins = config.get(key, 'pins').split()
+                if str(os.getpid()) in pins:
+                    pins.remove(str(os.getpid()))
+                config.set(key, 'pins', " ".join(pins))
+
+        finally:
+            self.close(lockfile, config)
+
+    def add_pin(self, config, key):
+        """ pin the entry for this process, once per use """
+        pins = []
+        if config.has_option(key, 'pins'):
+            pins = config.get(key, 'pins').split()
+
+        config.set(key, 'pins', " ".join(pins + [str(os.getpid())]))
+
+    def pinned(self, config, key):
+        """ is a running process using the entry? the pins of processes
+        that died are ignored """
+        if not config.has_option(key, 'pins'):
+            return False
+
+        for pid in config.get(key, 'pins').split():
+            try:
+                os.kill(int(pid), 0)
+                return True
+            except OSError, e:
+                if e.errno == errno.EPERM:
+                    return True
+
+        return False
+
+    def contains(self, filename):
+        """ is filename managed by the cache? """
+        lockfile, config = self.open()
+        try:
+            for k in self.entries(config):
+                if config.get(k, 'filename') == filename:
+                    return True
+            return False
+
+        finally:
+            self.close(lockfile, config, write = False)
+
+    def forget(self, filename):
+        """ remove filename from the cache, and from the disk """
+        lockfile, config = self.open()
+        try:
+            for k in self.entries(config):
+                if config.get(k, 'filename') == filename:
+                    self.remove(config, k)
+
+        finally:
+            self.close(lockfile, config)
+
+    def entries(self, config):
+        """ list cache entries keys """
+        return [s for s in config.sections() if s != STATS]
+
+    def local_size(self, config, key):
+        """ size of the local file, that differs for compressed dumps """
+        if config.has_option(key, 'local_size'):
+            return config.getint(key, 'local_size')
+
+        return config.getint(key, 'size')
+
+    def remove(self, config, key):
+        """ remove the entry and its file """
+        from options import VERBOSE
+
+        name = config.get(key, 'filename')
+        if os.path.exists(name):
+            if VERBOSE:
+                print "rm %s" % name
+            os.unlink(name)
+
+        config.remove_section(key)
+
+    def evict(self, config, keep = None):
+        """ remove least recently used entries until we fit the budget """
+        from options import TERSE
+
+        # prefetched dumps of sections without a cache budget
+        if self.budget is None:
+            return
+
+        lru = [(config.getfloat(k, 'atime'), k) for k in self.entries(config)]
+        lru.sort()
+
+        total = sum([self.local_size(config, k) for a, k in lru])
+
+        for atime, k in lru:
+            if total <= self.budget:
+                break
+
+            if k == keep or self.pinned(config, k):
+                continue
+
+            if not TERSE:
+                print "cache: evicting '%s'" % config.get(k, 'filename')
+
+            total -= self.local_size(config, k)
+            self.remove(config, k)
+            self.count(config, 'evictions')
+
+    def list(self):
+        """ return cache content, least recently used first, and stats """
+        lockfile, config = self.open()
+        try:
+            content = []
+            for k in self.entries(config):
+                content.append((config.getfloat(k, 'atime'),
+                                self.local_size(config, k),
+                                config.get(k, 'filename'),
+                                k))
+            content.sort()
+
+            stats = dict([(s, config.getint(STATS, s))
+                          for s in config.options(STATS)])
+
+            return content, stats
+
+        finally:
+            self.close(lockfile, config, write = False)
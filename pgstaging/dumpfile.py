@@ -0,0 +1,263 @@
+##
+## Write dump files without trashing the page cache
+##
+## Dumps written into tmpdir would otherwise fill the page cache, evicting
+## what the other restores running on the same host need. We preallocate
+## the file when we know its size, so that our appends don't fragment it,
+## and drop the written ranges from the page cache once they're on disk.
+## Ranges written ahead of the running digest of a segmented download are
+## left for the hashing thread to drop once it read them back. Optionally,
+## most of the data is written with O_DIRECT, bypassing the page cache
+## entirely.
+##
+
+import os, mmap, errno, ctypes
+
+from utils import libc_call
+
+# from linux/fadvise.h and linux/fs.h
+POSIX_FADV_DONTNEED         = 4
+SYNC_FILE_RANGE_WAIT_BEFORE = 1
+SYNC_FILE_RANGE_WRITE       = 2
+SYNC_FILE_RANGE_WAIT_AFTER  = 4
+
+O_DIRECT = getattr(os, 'O_DIRECT', 0)
+
+# O_DIRECT offsets, lengths and buffer addresses are multiple of that
+ALIGN = 4096
+
+# how many written bytes we let pile up in the page cache
+DROP_SIZE = 64 * 1024 * 1024
+
+# errors telling that the file system doesn't support what we ask
+UNSUPPORTED = (errno.EOPNOTSUPP, errno.ENOSYS, errno.EINVAL)
+
+def libc_call64(name, restype, argtypes):
+    """ prefer the 64 bits offsets variant of name, for 32 bits systems """
+    return libc_call(name + '64', restype, argtypes) \
+           or libc_call(name, restype, argtypes)
+
+def fallocate(fd, offset, length):
+    """ allocate the blocks of the file range, return False when the file
+    system can't. Unlike posix_fallocate(), never falls back to writing
+    zeroes, which would go through the page cache """
+    func = libc_call64('fallocate', ctypes.c_int,
+                       [ctypes.c_int, ctypes.c_int,
+                        ctypes.c_int64, ctypes.c_int64])
+    if func is None:
+        return False
+
+    if func(fd, 0, offset, length) != 0:
+        e = ctypes.get_errno()
+        if e in UNSUPPORTED:
+            return False
+        raise OSError(e, os.strerror(e))
+
+    return True
+
+def drop(fd, offset, length):
+    """ write the file range to disk then drop it from the page cache """
+    sync = libc_call('sync_file_range', ctypes.c_int,
+                     [ctypes.c_int, ctypes.c_int64, ctypes.c_int64,
+                      ctypes.c_uint])
+    fadvise = libc_call64('posix_fadvise', ctypes.c_int,
+                          [ctypes.c_int, ctypes.c_int64, ctypes.c_int64,
+                           ctypes.c_int])
+    if fadvise is None:
+        return
+
+    # only clean pages can be dropped
+    if sync is None or sync(fd, offset, length,
+                            SYNC_FILE_RANGE_WAIT_BEFORE
+                            | SYNC_FILE_RANGE_WRITE
+                            | SYNC_FILE_RANGE_WAIT_AFTER) != 0:
+        os.fdatasync(fd)
+
+    fadvise(fd, offset, length, POSIX_FADV_DONTNEED)
+
+def resident(filename):
+    """ return how many bytes of filename are in the page cache """
+    mincore = libc_call('mincore', ctypes.c_int,
+                        [ctypes.c_void_p, ctypes.c_size_t, ctypes.c_void_p])
+
+    size = os.path.getsize(filename)
+    if mincore is None or size == 0:
+        return None
+
+    f = open(filename, "rb")
+    try:
+        # a private mapping we never write to shows the file pages
+        m = mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_COPY)
+        try:
+            pages = (size + mmap.PAGESIZE - 1) / mmap.PAGESIZE
+            vec   = (ctypes.c_ubyte * pages)()
+            addr  = ctypes.addressof(ctypes.c_char.from_buffer(m))
+
+            if mincore(addr, size, vec) != 0:
+                return None
+
+            return min(size, sum([v & 1 for v in vec]) * mmap.PAGESIZE)
+        finally:
+            m.close()
+    finally:
+        f.close()
+
+class dumpfile:
+    """ A dump file open for writing, at given offsets, leaving the page
+    cache alone """
+
+    def __init__(self, filename, truncate = False,
+                 drop_cache = True, direct = False):
+        """ drop_cache drops written ranges from the page cache, direct
+        writes them with O_DIRECT when the file system allows it """
+        flags = os.O_WRONLY | os.O_CREAT
+        if truncate:
+            flags |= os.O_TRUNC
+
+        self.filename   = filename
+        self.fd         = os.open(filename, flags, 0666)
+        self.drop_cache = drop_cache
+        self.offset     = 0
+
+        # [start, end] of what we wrote since we last dropped it
+        self.dirty      = None
+
+        # returns the offset up to which the file has been hashed, we only
+        # drop what's below it and leave the rest to the hashing thread
+        self.hashed     = None
+
+        # tmpfs and others refuse O_DIRECT
+        self.direct_fd  = None
+        self.buffer     = None
+        if direct and O_DIRECT:
+            try:
+                self.direct_fd = os.open(filename, os.O_WRONLY | O_DIRECT)
+            except OSError, e:
+                if e.errno != errno.EINVAL:
+                    raise
+
+    def fileno(self):
+        return self.fd
+
+    def preallocate(self, size):
+        """ make the file size bytes long, allocating its blocks when the
+        file system allows, return True when it did """
+        if fallocate(self.fd, 0, size):
+            return True
+
+        os.ftruncate(self.fd, size)
+        return False
+
+    def truncate(self):
+        """ cut the file at the current offset, preallocated space past
+        that is not ours """
+        os.ftruncate(self.fd, self.offset)
+
+    def seek(self, offset):
+        self.offset = offset
+
+    def write(self, data):
+        """ write data at the current offset, a string or a memoryview """
+        if self.direct_fd is None:
+            self.pwrite(data)
+            return
+
+        # O_DIRECT the aligned middle part of data, if any
+        head  = min(len(data), -self.offset % ALIGN)
+        count = (len(data) - head) / ALIGN * ALIGN
+
+        if count == 0:
+            self.pwrite(data)
+            return
+
+        self.pwrite(data[:head])
+        self.pwrite_direct(data[head:head + count])
+        self.pwrite(data[head + count:])
+
+    def pwrite(self, data):
+        """ buffered write of data at the current offset """
+        if not data:
+            return
+
+        os.lseek(self.fd, self.offset, os.SEEK_SET)
+
+        # slicing a memoryview doesn't copy
+        view = memoryview(data)
+
+        written = 0
+        while written < len(data):
+            written += os.write(self.fd, view[written:])
+
+        self.advance(len(data))
+
+    def pwrite_direct(self, data):
+        """ O_DIRECT write of data, aligned, at the current offset """
+        pwrite = libc_call64('pwrite', ctypes.c_ssize_t,
+                             [ctypes.c_int, ctypes.c_void_p,
+                              ctypes.c_size_t, ctypes.c_int64])
+
+        # anonymous mappings are page aligned
+        if self.buffer is None or len(self.buffer) < len(data):
+            self.buffer = mmap.mmap(-1, len(data))
+
+        # mmap objects only take strings
+        if isinstance(data, memoryview):
+            data = data.tobytes()
+
+        self.buffer.seek(0)
+        self.buffer.write(data)
+        addr = ctypes.addressof(ctypes.c_char.from_buffer(self.buffer))
+
+        written = 0
+        while written < len(data):
+            n = pwrite(self.direct_fd, addr + written, len(data) - written,
+                       self.offset + written)
+            if n < 0:
+                e = ctypes.get_errno()
+                raise OSError(e, os.strerror(e))
+            written += n
+
+        # bypassed the page cache, nothing to drop
+        self.offset += len(data)
+
+    def advance(self, n):
+        """ n bytes have been written at the current offset, by us or by
+        the kernel on our behalf """
+        start, end = self.offset, self.offset + n
+        self.offset = end
+
+        if not self.drop_cache:
+            return
+
+        if self.dirty and self.dirty[1] == start:
+            self.dirty[1] = end
+        else:
+            self.drop()
+            self.dirty = [start, end]
+
+        if self.dirty[1] - self.dirty[0] >= DROP_SIZE:
+            self.drop()
+
+    def drop(self):
+        """ drop what we wrote from the page cache """
+        if not self.dirty:
+            return
+
+        start, end = self.dirty
+        if self.hashed is not None:
+            end = max(start, min(end, self.hashed()))
+
+        if end > start:
+            drop(self.fd, start, end - start)
+
+        self.dirty = None
+
+    def close(self):
+        try:
+            self.drop()
+        finally:
+            os.close(self.fd)
+            if self.direct_fd is not None:
+                os.close(self.direct_fd)
+            if self.buffer is not None:
+                self.buffer.close()
@@ -0,0 +1,449 @@
+##
+## Read the TOC of a custom format dump without pg_restore
+##
+## A pg_dump -Fc archive starts with a header, then its TOC: one entry per
+## object, with its dumpId, description, namespace, tag, owner, the SQL to
+## create it and the dumpIds it depends on, then the offset of its data, if
+## any, in the rest of the file. We read that much, as pg_restore does in
+## ReadHead() and ReadToc(), and produce the same lines as pg_restore -l and
+## the trigger functions we used to find in pg_restore -s output.
+##
+## Archive versions are the ones of pg_backup_archiver.h, from 1.0 to 1.16
+## (PostgreSQL 17). Other formats and versions raise
+## UnsupportedDumpFormatException so that callers can use pg_restore.
+##
+
+import re, time, struct
+
+from utils import UnsupportedDumpFormatException, CorruptDumpException
+
+MAGIC         = "PGDMP"
+ARCH_CUSTOM   = 1
+MAX_VERSION   = (1, 16, 0)
+
+# how much of the dump we read at once
+CHUNK         = 1024 * 1024
+
+# offset flags of the custom format
+OFFSET_POS_NOT_SET = 1
+OFFSET_POS_SET     = 2
+OFFSET_NO_DATA     = 3
+OFFSET             = struct.Struct('<BQ')
+
+# pg_restore takes care of those entries itself, or only with -C
+SPECIAL  = ('ENCODING', 'STDSTRINGS', 'SEARCHPATH',
+            'DATABASE', 'DATABASE PROPERTIES')
+
+# entries about another object, named in their tag
+LO_DESCS = ('ACL', 'COMMENT', 'SECURITY LABEL')
+
+EXECUTE  = re.compile(r'EXECUTE\s+(?:PROCEDURE|FUNCTION)\s+([^(]+)\(')
+
+class tocentry:
+    """ One TOC entry, as ReadToc() reads it """
+
+    def __init__(self):
+        self.dump_id     = None
+        self.had_dumper  = None
+        self.tableoid    = 0
+        self.oid         = 0
+        self.tag         = None
+        self.desc        = None
+        self.section     = None
+        self.defn        = None
+        self.drop_stmt   = None
+        self.copy_stmt   = None
+        self.namespace   = None
+        self.tablespace  = None
+        self.tableam     = None
+        self.relkind     = None
+        self.owner       = None
+        self.deps        = []
+        self.data_state  = None
+        self.data_offset = None
+
+    def listed(self):
+        """ would pg_restore -l list this entry? """
+        if self.desc in SPECIAL:
+            return False
+
+        # database comments and ACLs are only restored with -C
+        if self.desc in LO_DESCS and (self.tag or '').startswith('DATABASE '):
+            return False
+
+        # see _tocEntryRequired() in pg_backup_archiver.c
+        schema, data = True, True
+        if not self.had_dumper:
+            data = self.desc in ('SEQUENCE SET', 'BLOB', 'BLOB METADATA') \
+                   or (self.desc in LO_DESCS
+                       and (self.tag or '').startswith('LARGE OBJECT'))
+            schema = not data
+
+        if not self.defn:
+            schema = False
+
+        return schema or data
+
+    def line(self):
+        """ the pg_restore -l line of this entry """
+        def sanitize(s, hyphen = False):
+            if not s:
+                return hyphen and '-' or ''
+            if '\n' in s or '\r' in s:
+                return s.replace('\n', ' ').replace('\r', ' ')
+            return s
+
+        return "%d; %d %d %s %s %s %s" % (self.dump_id,
+                                          self.tableoid, self.oid,
+                                          self.desc,
+                                          sanitize(self.namespace, True),
+                                          sanitize(self.tag),
+                                          sanitize(self.owner))
+
+class dumptoc:
+    """ Read the header and the TOC of a custom format dump """
+
+    def __init__(self, filename):
+        """ read the header, raise UnsupportedDumpFormatException when the
+        file isn't a custom format dump we know how to read """
+        self.filename = filename
+
+        f = open(filename, 'rb')
+        try:
+            head = f.read(CHUNK)
+        finally:
+            f.close()
+
+        try:
+            self.toc_start = self.read_head(head)
+        except (IndexError, struct.error):
+            self.truncated()
+
+    def truncated(self):
+        mesg = "Dump '%s' is truncated: its TOC is incomplete" % self.filename
+        raise CorruptDumpException, mesg
+
+    ##
+    # The TOC is parsed from a buffer, the *_at(buf, pos) methods returning
+    # (value, next pos) and raising IndexError or struct.error when buf
+    # ends first.
+
+    def unpack(self, buf, pos):
+        """ return the (sign, value) ReadInt() reads at pos in buf: a sign
+        byte then int_size bytes, little endian. read_head() replaces it
+        with a struct unpack for the common int sizes """
+        sign = 0
+        if self.version > (1, 0, 0):
+            sign = ord(buf[pos])
+            pos += 1
+
+        value = 0
+        for i in range(self.int_size):
+            value += ord(buf[pos + i]) << (8 * i)
+
+        return sign, value
+
+    def int_at(self, buf, pos):
+        """ ReadInt() """
+        sign, value = self.unpack(buf, pos)
+        if sign:
+            value = -value
+        return value, pos + self.int_len
+
+    def str_at(self, buf, pos):
+        """ ReadStr(): a length then the bytes, None for a -1 length """
+        n, pos = self.int_at(buf, pos)
+        if n < 0:
+            return None, pos
+
+        end = pos + n
+        if end > len(buf):
+            raise IndexError
+        return buf[pos:end], end
+
+    def offset_at(self, buf, pos):
+        """ ReadOffset(): return (flag, offset), next pos """
+        if self.version < (1, 7, 0):
+            i, pos = self.int_at(buf, pos)
+            if i < 0:
+                return (OFFSET_POS_NOT_SET, None), pos
+            elif i == 0:
+                return (OFFSET_NO_DATA, None), pos
+            return (OFFSET_POS_SET, i), pos
+
+        if self.off_size == 8:
+            flag, offset = OFFSET.unpack_from(buf, pos)
+        else:
+            flag   = ord(buf[pos])
+            offset = 0
+            for i in range(self.off_size):
+                offset += ord(buf[pos + 1 + i]) << (8 * i)
+
+        if flag not in (OFFSET_POS_NOT_SET, OFFSET_POS_SET, OFFSET_NO_DATA):
+            mesg = "Dump '%s': unexpected data offset flag %d" \
+                   % (self.filename, flag)
+            raise CorruptDumpException, mesg
+
+        if flag != OFFSET_POS_SET:
+            offset = None
+
+        return (flag, offset), pos + 1 + self.off_size
+
+    def read_head(self, buf):
+        """ ReadHead(), return where the TOC entries start """
+        if buf[:len(MAGIC)] != MAGIC:
+            mesg = "'%s' is not a custom format dump" % self.filename
+            raise UnsupportedDumpFormatException, mesg
+
+        pos  = len(MAGIC)
+        vmaj = ord(buf[pos])
+        vmin = ord(buf[pos + 1])
+        vrev = 0
+        pos += 2
+        if vmaj > 1 or (vmaj == 1 and vmin > 0):
+            vrev = ord(buf[pos])
+            pos += 1
+
+        self.version = v = (vmaj, vmin, vrev)
+        if v < (1, 0, 0) or v > MAX_VERSION:
+            mesg = "Dump '%s': unsupported archive version %d.%d" \
+                   % (self.filename, vmaj, vmin)
+            raise UnsupportedDumpFormatException, mesg
+
+        self.int_size = ord(buf[pos])
+        self.off_size = self.int_size
+        pos += 1
+        if v >= (1, 7, 0):
+            self.off_size = ord(buf[pos])
+            pos += 1
+
+        self.int_len = self.int_size
+        if v > (1, 0, 0):
+            self.int_len += 1
+
+            # the common int sizes are read with a single unpack
+            if self.int_size in (4, 8):
+                self.unpack = struct.Struct(self.int_size == 4 and '<BI'
+                                            or '<BQ').unpack_from
+
+        self.format = ord(buf[pos])
+        pos += 1
+        if self.format != ARCH_CUSTOM:
+            mesg = "Dump '%s': archive format %d is not custom" \
+                   % (self.filename, self.format)
+            raise UnsupportedDumpFormatException, mesg
+
+        # an algorithm byte from 1.15 on, a zlib level before
+        self.compression = None
+        if v >= (1, 15, 0):
+            self.compression = ord(buf[pos])
+            pos += 1
+        elif v >= (1, 4, 0):
+            self.compression, pos = self.int_at(buf, pos)
+        elif v >= (1, 2, 0):
+            self.compression = ord(buf[pos])
+            pos += 1
+
+        self.created = None
+        self.dbname  = None
+        if v >= (1, 4, 0):
+            # sec, min, hour, mday, mon, year, isdst
+            tm = []
+            for i in range(7):
+                value, pos = self.int_at(buf, pos)
+                tm.append(value)
+
+            self.created = (tm[5] + 1900, tm[4] + 1, tm[3],
+                            tm[2], tm[1], tm[0])
+            self.dbname, pos = self.str_at(buf, pos)
+
+        self.remote_version = None
+        self.dump_version   = None
+        if v >= (1, 10, 0):
+            self.remote_version, pos = self.str_at(buf, pos)
+            self.dump_version, pos   = self.str_at(buf, pos)
+
+        # the TOC entry fields of this archive version, in order, and
+        # whether they are strings or ints. None is for the WITH OIDS flag
+        # that pg_restore doesn't support anymore
+        fields = [('dump_id', False), ('had_dumper', False)]
+        if v >= (1, 8, 0):
+            fields.append(('tableoid', True))
+        fields += [('oid', True), ('tag', True), ('desc', True)]
+        if v >= (1, 11, 0):
+            fields.append(('section', False))
+        fields += [('defn', True), ('drop_stmt', True)]
+        if v >= (1, 3, 0):
+            fields.append(('copy_stmt', True))
+        if v >= (1, 6, 0):
+            fields.append(('namespace', True))
+        if v >= (1, 10, 0):
+            fields.append(('tablespace', True))
+        if v >= (1, 14, 0):
+            fields.append(('tableam', True))
+        if v >= (1, 16, 0):
+            fields.append(('relkind', False))
+        fields.append(('owner', True))
+        if v >= (1, 9, 0):
+            fields.append((None, True))
+
+        self.fields = fields
+
+        self.count, pos = self.int_at(buf, pos)
+        return pos
+
+    def entry_at(self, buf, pos):
+        """ ReadToc() body and the custom format _ReadExtraToc(). This is
+        where reading the TOC spends its time, so ints and strings are read
+        here rather than with self.int_at() and self.str_at() """
+        unpack  = self.unpack
+        int_len = self.int_len
+        buf_len = len(buf)
+
+        te = tocentry()
+        for name, is_str in self.fields:
+            sign, value = unpack(buf, pos)
+            pos += int_len
+
+            if is_str:
+                if sign and value:
+                    value = None
+                else:
+                    end = pos + value
+                    if end > buf_len:
+                        raise IndexError
+                    value = buf[pos:end]
+                    pos   = end
+            elif sign:
+                value = -value
+
+            if name:
+                te.__dict__[name] = value
+
+        te.tableoid = int(te.tableoid or 0)
+        te.oid      = int(te.oid or 0)
+
+        # dependencies are strings, up to a -1 length
+        if self.version >= (1, 5, 0):
+            while True:
+                sign, value = unpack(buf, pos)
+                pos += int_len
+                if sign and value:
+                    break
+
+                end = pos + value
+                if end > buf_len:
+                    raise IndexError
+                te.deps.append(int(buf[pos:end]))
+                pos = end
+
+        (te.data_state, te.data_offset), pos = self.offset_at(buf, pos)
+        if self.version < (1, 7, 0):
+            size, pos = self.int_at(buf, pos)
+
+        return te, pos
+
+    def entries(self):
+        """ yield the TOC entries, one at a time, reading the dump CHUNK
+        bytes at a time """
+        f = open(self.filename, 'rb')
+        try:
+            f.seek(self.toc_start)
+            buf = f.read(CHUNK)
+            pos = 0
+            eof = False
+            n   = 0
+
+            while n < self.count:
+                try:
+                    te, pos = self.entry_at(buf, pos)
+                except (IndexError, struct.error):
+                    # the entry spans the end of the buffer
+                    if eof:
+                        self.truncated()
+
+                    more = f.read(CHUNK)
+                    eof  = more == ''
+                    buf  = buf[pos:] + more
+                    pos  = 0
+                    continue
+
+                n += 1
+                yield te
+        finally:
+            f.close()
+
+    def listing(self):
+        """ yield the lines pg_restore -l prints """
+        yield ";"
+        if self.created:
+            yield "; Archive created at %04d-%02d-%02d %02d:%02d:%02d" \
+                  % self.created
+        yield ";     dbname: %s" % (self.dbname or '')
+        yield ";     TOC Entries: %d" % self.count
+        yield ";     Compression: %s" % self.compression
+        yield ";     Dump Version: %d.%d-%d" % self.version
+        yield ";     Format: CUSTOM"
+        yield ";     Integer: %d bytes" % self.int_size
+        yield ";     Offset: %d bytes" % self.off_size
+        if self.remote_version:
+            yield ";     Dumped from database version: %s" \
+                  % self.remote_version
+        if self.dump_version:
+            yield ";     Dumped by pg_dump version: %s" % self.dump_version
+        yield ";"
+        yield ";"
+        yield "; Selected TOC Entries:"
+        yield ";"
+
+        for te in self.entries():
+            if te.listed():
+                yield te.line()
+
+    def triggers(self):
+        """ return {schema: {trigger: [functions]}} as found in the TRIGGER
+        entries definitions, functions are schema qualified """
+        create_trigger = 'CREATE TRIGGER'
+
+        triggers = {}
+        for te in self.entries():
+            if te.desc != 'TRIGGER' or not te.defn:
+                continue
+
+            start = te.defn.find(create_trigger)
+            if start == -1:
+                continue
+
+            schema = te.namespace or 'public'
+            name   = te.defn[start + len(create_trigger):].split()[0]
+            funcs  = triggers.setdefault(schema, {}).setdefault(name, [])
+
+            m = EXECUTE.search(te.defn, start)
+            if m:
+                pname = m.group(1).strip()
+
+                # procedure name is NOT schema qualified
+                if pname.find('.') == -1:
+                    pname = '%s.%s' % (schema, pname)
+
+                if pname not in funcs:
+                    funcs.append(pname)
+
+        return triggers
+
+def benchmark(filename, pg_restore):
+    """ return (native, pg_restore) (seconds, lines) of listing the TOC
+    of filename """
+    import utils
+
+    start = time.time()
+    lines = sum(1 for l in dumptoc(filename).listing())
+    native = (time.time() - start, lines)
+
+    start = time.time()
+    lines = sum(1 for l in utils.run_command_lines([pg_restore, "-l",
+                                                    filename])
+                if l.strip())
+    forked = (time.time() - start, lines)
+
+    return native, forked
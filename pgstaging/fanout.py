@@ -0,0 +1,123 @@
+##
+## Restore the same dump into several targets at once
+##
+## Sections restoring the same dump, such as the dev and preprod copies of
+## a production database, would each fetch it on their own then restore it
+## one after another. Here the dump is fetched once, by the first section
+## needing it, and every section then runs its own restore from that local
+## copy concurrently: createdb, pgbouncer, pg_restore, switch and the rest.
+## A target failing doesn't stop the others.
+##
+
+import time, threading
+
+class fanout:
+    """ Restore the latest dump of a list of Staging objects, fetching each
+    dump only once """
+
+    def __init__(self):
+        self.pending = []       # Staging objects
+        self.results = []       # [(section, host, dbname, status, pipeline)]
+        self.fetches = []       # [(url, sections, status, secs)]
+        self.lock    = threading.Lock()
+
+    def add(self, staging):
+        """ restore the latest dump of this section """
+        self.pending.append(staging)
+
+    def group(self):
+        """ return [(key, [sections])], sections sharing the same dump
+        together, in order """
+        groups = []
+        keys   = {}
+        for s in self.pending:
+            s.set_backup_date(None, 'latest')
+
+            key = (" ".join(s.backup_hosts), s.backup_filename)
+            if key not in keys:
+                keys[key] = []
+                groups.append((key, keys[key]))
+
+            keys[key].append(s)
+
+        return groups
+
+    def run(self):
+        """ fetch and restore them all, return the results """
+        for key, sections in self.group():
+            self.restore_group(key[1], sections)
+
+        return self.results
+
+    def restore_group(self, url, sections):
+        """ fetch the dump then restore it in all the sections at once """
+        from options import DEBUG
+
+        # sections fetching the dump on their target can't share it
+        local  = [s for s in sections if not s.restore_on_target()]
+        first  = local and local[0] or None
+        dump   = None
+
+        if first:
+            start = time.time()
+            try:
+                dump   = first.get_dump()
+                status = "fetched"
+            except Exception, e:
+                if DEBUG:
+                    raise
+                status = "error: %s" % str(e).replace('\n', ' ')
+
+            self.fetches.append((url, [s.section for s in local], status,
+                                 time.time() - start))
+
+        threads = []
+        for s in sections:
+            if s in local and dump is None:
+                self.record(s, "error: could not fetch the dump", None)
+                continue
+
+            if s in local:
+                s.dump_file = dump
+
+            t = threading.Thread(target = self.restore, args = (s,))
+            t.start()
+            threads.append(t)
+
+        for t in threads:
+            t.join()
+
+        # the dump is removed once, as the fetching section says
+        if dump:
+            try:
+                first.do_remove_dump(dump)
+            finally:
+                first.unpin_dumps()
+
+    def restore(self, s):
+        """ thread body: restore section s, record the result """
+        from options import DEBUG
+
+        try:
+            s.restore()
+            status = "restored"
+
+            if s.auto_switch:
+                status += ", switched"
+
+        except Exception, e:
+            if DEBUG:
+                import traceback
+                traceback.print_exc()
+            status = "error: %s" % str(e).replace('\n', ' ')
+
+        self.record(s, status, s.restore_pipeline)
+
+    def record(self, s, status, pipeline):
+        """ keep track of the result of section s """
+        self.lock.acquire()
+        try:
+            self.results.append((s.section, s.host, s.dated_dbname,
+                                 status, pipeline))
+        finally:
+            self.lock.release()
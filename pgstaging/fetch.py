@@ -0,0 +1,839 @@
+##
+## Fetch backup files over HTTP, using parallel Range requests when the
+## server supports them
+##
+## Downloads happen into a <dump>.partial file, with a small sidecar file
+## <dump>.partial.state recording how many bytes of each segment are known
+## to be written, so that the next attempt resumes where we left.
+##
+## Bytes are hashed in file order as they're written, and the dump is
+## checked against its size and its .sha256 or .md5 sidecar file on the
+## backup host, when there's one.
+##
+## Compressed dumps, either by name or by Content-Encoding, are fetched in
+## a single stream and decompressed on the fly.
+##
+## When given a min_rate, a download getting less than that over a whole
+## STALL_WINDOW fails, so that we can resume it from another mirror.
+##
+## Plain dumps are received into a buffer allocated once per stream, and
+## written and hashed from there, rather than allocating a new string for
+## each read.
+##
+
+import os, re, time, socket, httplib, hashlib, threading, ConfigParser
+
+import throttle, httppool, progress, compress, dumpfile
+from utils import CouldNotGetDumpException, CorruptDumpException
+from utils import FetchCancelledException
+
+# sidecar files we look for, in order of preference
+CHECKSUMS = ('sha256', 'md5')
+
+# seconds over which we measure the rate of a download against min_rate,
+# reading at most STALL_CHUNK bytes at a time to notice a slow mirror early
+STALL_WINDOW = 30
+STALL_CHUNK  = 256 * 1024
+
+# what the benchmark() server sends at a time
+BENCH_BLOCK  = 1024 * 1024
+
+# seconds between two saves of the segments state of a download
+CHECKPOINT   = 1
+
+def readinto(r, view):
+    """ read at most len(view) bytes of the HTTP response r into view,
+    return how many, 0 at end of body """
+    if hasattr(r, 'readinto'):
+        return r.readinto(view)
+
+    # python 2 responses only have read(), but their socket file object is
+    # not buffered: when we know how many bytes are left, receive them
+    # directly
+    buffered = getattr(r.fp, '_rbuf', None)
+    if r.chunked or r.length is None or buffered is None or buffered.tell():
+        data = r.read(len(view))
+        view[:len(data)] = data
+        return len(data)
+
+    if r.length == 0:
+        return 0
+
+    n = r.fp._sock.recv_into(view, min(len(view), r.length))
+
+    # as r.read() does, so that the connection can be reused
+    r.length -= n
+    if n == 0 or r.length == 0:
+        r.close()
+
+    return n
+
+def get_checksum(host, url):
+    """ return (algorithm, hexdigest) from the url sidecar, or None """
+    from options import VERBOSE
+
+    for algo in CHECKSUMS:
+        pool, conn, r = httppool.request(host, "GET", "%s.%s" % (url, algo))
+        try:
+            data = r.read()
+        finally:
+            pool.release(conn, r)
+
+        if r.status != 200:
+            continue
+
+        # either "hexdigest" or "hexdigest  filename", as sha256sum does
+        m = re.match(r'\s*([0-9a-fA-F]+)', data)
+        if m and len(m.group(1)) == hashlib.new(algo).digest_size * 2:
+            if VERBOSE:
+                print "checksum of %s from %s.%s" % (url, url, algo)
+
+            return algo, m.group(1).lower()
+
+    return None
+
+class digester:
+    """ Hash and count the bytes of a dump, in order, then check them
+    against its expected size and checksum """
+
+    def __init__(self, url, size = None, checksum = None):
+        """ without a checksum to check, still compute a sha256 one """
+        self.url      = url
+        self.size     = size
+        self.checksum = checksum
+        self.count    = 0
+
+        self.algo     = 'sha256'
+        if checksum:
+            self.algo = checksum[0]
+
+        self.hash     = hashlib.new(self.algo)
+
+    def update(self, data):
+        """ data follows what we already hashed """
+        self.hash.update(data)
+        self.count += len(data)
+
+    def check(self):
+        """ raise CorruptDumpException when the dump is not what we
+        expected, return its 'algorithm:hexdigest' digest """
+        if self.size is not None and self.count != self.size:
+            mesg = "Dump '%s' is truncated: got %d bytes out of %d" \
+                   % (self.url, self.count, self.size)
+            raise CorruptDumpException, mesg
+
+        hexdigest = self.hash.hexdigest()
+        if self.checksum and self.checksum[1] != hexdigest:
+            mesg = "Dump '%s' %s checksum mismatch: got %s, expected %s" \
+                   % (self.url, self.checksum[0], hexdigest, self.checksum[1])
+            raise CorruptDumpException, mesg
+
+        return "%s:%s" % (self.algo, hexdigest)
+
+class verifiedstream:
+    """ A file-like object hashing what's read from source, checked at
+    end of stream """
+
+    def __init__(self, source, digester):
+        self.source   = source
+        self.digester = digester
+        self.digest   = None
+
+    def read(self, size):
+        data = self.source.read(size)
+
+        if data:
+            self.digester.update(data)
+        else:
+            self.digest = self.digester.check()
+
+        return data
+
+class countedstream:
+    """ A file-like object checking we read exactly size bytes """
+
+    def __init__(self, source, url, size):
+        self.source = source
+        self.url    = url
+        self.size   = size
+        self.count  = 0
+
+    def read(self, size):
+        data = self.source.read(size)
+        self.count += len(data)
+
+        if not data and self.size is not None and self.count != self.size:
+            mesg = "Dump '%s' is truncated: got %d bytes out of %d" \
+                   % (self.url, self.count, self.size)
+            raise CorruptDumpException, mesg
+
+        return data
+
+def dumpstream(source, r, url, compression, digester):
+    """ return (stream, decompressed) where stream reads the dump out of
+    source, the body of the HTTP response r, decompressing it when either
+    its name or its Content-Encoding says so. Bytes are hashed as they are
+    in the remote file. decompressed is the decompressing stream, if any """
+    encoding = compress.kind_of_encoding(r.getheader('content-encoding'))
+    length   = r.getheader('content-length')
+    if length is not None:
+        length = int(length)
+
+    decoded  = None
+
+    # servers may add a Content-Encoding to .gz files, that we then only
+    # decode once
+    if encoding and encoding != compression:
+        # the server compressed the file for us: Content-Length is the one
+        # of the compressed body, the checksum the one of the file
+        source  = compress.decompressedstream(
+            countedstream(source, url, length), encoding)
+        decoded = source
+        length  = None
+
+    digester.size = length
+    stream = verifiedstream(source, digester)
+
+    if compression:
+        # the checksum is the one of the compressed file
+        stream  = compress.decompressedstream(stream, compression)
+        decoded = stream
+
+    return stream, decoded
+
+class responsestream:
+    """ A file-like object reading an HTTP response for an httpfetch """
+
+    def __init__(self, f, r):
+        self.f = f
+        self.r = r
+
+    def read(self, size):
+        data = self.f.read(self.r, size)
+        self.f.transferred += len(data)
+        return data
+
+class httpfetch:
+    """ Download an URL to a local file, either in a single stream or in
+    several segments fetched concurrently """
+
+    def __init__(self, host, url, filename, jobs = 1, limit = None):
+        """ jobs is how many concurrent Range requests to issue, limit is
+        a throttle.throttle object shared by them """
+        self.host          = host
+        self.url           = url
+        self.filename      = filename
+        self.partial       = "%s.partial" % filename
+        self.statefile     = "%s.partial.state" % filename
+        self.jobs          = int(jobs)
+
+        self.limit         = limit
+        if self.limit is None:
+            self.limit = throttle.throttle(host)
+
+        # filled in by self.head()
+        self.headed        = False
+        self.size          = None
+        self.accept_ranges = False
+        self.etag          = None
+        self.last_modified = None
+
+        # [[start, end, done], ...], shared with the segment threads
+        self.ranges        = []
+        self.lock          = threading.Lock()
+
+        # is a segment thread hashing, and when did we last save the state
+        self.hashing       = False
+        self.saved_at      = 0
+
+        # errors raised in the segment threads
+        self.errors        = []
+
+        # bytes per second under which we give up, and [start, bytes] of
+        # the current measure
+        self.min_rate      = None
+        self.window        = None
+
+        # how to write the local copy, see dumpfile
+        self.drop_cache    = True
+        self.direct        = False
+
+        # size of the buffer each stream reads into
+        self.bufsize       = None
+
+        # threading.Event set when we should stop fetching
+        self.cancel        = None
+
+        # filled in by self.fetch()
+        self.digester      = None
+        self.digest        = None
+        self.transferred   = 0
+        self.rate          = None
+
+        # compressed dumps are decompressed on the fly
+        self.compression   = compress.kind_of(url)
+        self.decompressed  = None
+
+        # the expected size can be given before we HEAD the url
+        self.progress      = progress.progress("http://%s%s" % (host, url))
+
+    def head(self):
+        """ HEAD the url to know its size, validators and if we can fetch
+        ranges """
+        pool, conn, r = httppool.request(self.host, "HEAD", self.url)
+        try:
+            r.read()
+        finally:
+            pool.release(conn, r)
+
+        if r.status != 200:
+            mesg = "Could not get dump '%s': %s" % (self.url, r.reason)
+            raise CouldNotGetDumpException, mesg
+
+        length = r.getheader('content-length')
+        if length is not None:
+            self.size = int(length)
+
+        self.accept_ranges = r.getheader('accept-ranges', '') == 'bytes'
+        self.etag          = r.getheader('etag')
+        self.last_modified = r.getheader('last-modified')
+        self.headed        = True
+
+    def segments(self):
+        """ split the file in self.jobs ranges: [[start, end, done], ...] """
+        # don't bother with segments smaller than our buffer
+        jobs = max(1, min(self.jobs, self.size / self.get_bufsize()))
+        step = self.size / jobs
+
+        ranges = []
+        for i in range(jobs):
+            start = i * step
+            end   = start + step - 1
+
+            # last segment gets the remainder
+            if i == jobs - 1:
+                end = self.size - 1
+
+            ranges.append([start, end, 0])
+
+        return ranges
+
+    def load_state(self):
+        """ return the ranges saved by a previous attempt, or None when
+        there's nothing to resume """
+        from options import TERSE
+
+        if not os.path.exists(self.partial) \
+               or not os.path.exists(self.statefile):
+            return None
+
+        state = ConfigParser.RawConfigParser()
+        try:
+            state.read(self.statefile)
+
+            # mirrors have their own ETags for the same file, resuming
+            # from another one needs the same size and Last-Modified
+            same_host = not state.has_option('partial', 'host') \
+                        or state.get('partial', 'host') == self.host
+
+            same = state.get('partial', 'url') == self.url \
+                   and state.getint('partial', 'size') == self.size \
+                   and (state.get('partial', 'etag') == str(self.etag)
+                        or not same_host) \
+                   and state.get('partial', 'last_modified') \
+                       == str(self.last_modified)
+
+            ranges = []
+            for segment in state.get('partial', 'segments').split():
+                bounds, done = segment.split(':')
+                start, end   = bounds.split('-')
+                ranges.append([int(start), int(end), int(done)])
+
+        except (ConfigParser.Error, ValueError):
+            same = False
+
+        if not same:
+            if not TERSE:
+                print "Notice: remote dump changed, restarting from scratch"
+            self.discard()
+            return None
+
+        if not TERSE:
+            done = sum([d for s, e, d in ranges])
+            print "resuming '%s' at %d/%d bytes" \
+                  % (self.partial, done, self.size)
+
+        return ranges
+
+    def save_state(self):
+        """ save current progress, called with self.lock held """
+        self.saved_at = time.time()
+
+        state = ConfigParser.RawConfigParser()
+        state.add_section('partial')
+        state.set('partial', 'host', self.host)
+        state.set('partial', 'url', self.url)
+        state.set('partial', 'size', self.size)
+        state.set('partial', 'etag', str(self.etag))
+        state.set('partial', 'last_modified', str(self.last_modified))
+        state.set('partial', 'segments',
+                  " ".join(["%d-%d:%d" % (s, e, d) for s, e, d in self.ranges]))
+
+        # write then rename, so that the state file is never half written
+        tmpname = "%s.tmp" % self.statefile
+        fd = open(tmpname, "w")
+        state.write(fd)
+        fd.close()
+        os.rename(tmpname, self.statefile)
+
+    def discard(self):
+        """ remove partial download and its state """
+        for name in (self.partial, self.statefile):
+            if os.path.exists(name):
+                os.unlink(name)
+
+    def fetch(self):
+        """ fetch the file, return its local filename """
+        from options import VERBOSE
+
+        if not self.headed:
+            self.head()
+
+        if self.size:
+            self.progress.size = self.size
+
+        start_time = time.time()
+        self.digester = digester(self.url, self.size,
+                                 get_checksum(self.host, self.url))
+
+        if self.accept_ranges and self.size and not self.compression:
+            self.ranges = self.load_state()
+
+            if self.ranges is None:
+                self.ranges = self.segments()
+
+                # preallocate the file, segments are written at their offset
+                dump_fd = self.open_partial(truncate = True)
+                dump_fd.preallocate(self.size)
+                dump_fd.close()
+
+                self.lock.acquire()
+                self.save_state()
+                self.lock.release()
+
+            if VERBOSE:
+                print "fetching %d segments of %s" % (len(self.ranges),
+                                                      self.url)
+
+            # hash what a previous attempt already fetched
+            self.digest_catchup()
+
+            self.progress.begin(sum([d for s, e, d in self.ranges]))
+            try:
+                self.fetch_segments()
+            finally:
+                self.progress.done()
+
+        else:
+            if VERBOSE and self.compression:
+                print "Notice: decompressing %s on the fly" % self.url
+            elif VERBOSE:
+                print "Notice: no Range support, fetching in a single stream"
+
+            self.discard()
+
+            self.progress.begin()
+            try:
+                self.fetch_single()
+            except CorruptDumpException:
+                # decompressing checks the dump as it goes
+                self.discard()
+                raise
+            finally:
+                self.progress.done()
+
+        try:
+            self.digest = self.digester.check()
+        except CorruptDumpException:
+            # don't resume from corrupted data next time
+            self.discard()
+            raise
+
+        if VERBOSE:
+            print "%s: %s" % (self.url, self.digest)
+
+        # bytes per second we got on the wire, resumed ones not included
+        elapsed = time.time() - start_time
+        if elapsed > 0:
+            self.rate = self.transferred / elapsed
+
+        # the download is complete
+        os.rename(self.partial, self.filename)
+        self.discard()
+
+        return self.filename
+
+    def open_partial(self, truncate = False):
+        """ return the partial file as a dumpfile """
+        return dumpfile.dumpfile(self.partial, truncate,
+                                 self.drop_cache, self.direct)
+
+    def get_bufsize(self):
+        """ the size of our read buffers """
+        from options import BUFSIZE
+        return self.bufsize or BUFSIZE
+
+    def fetch_single(self):
+        """ fetch the whole file in a single stream, can't resume """
+        pool, conn, r = httppool.request(self.host, "GET", self.url,
+                                         {'Accept-Encoding': 'gzip'})
+        try:
+            if r.status != 200:
+                mesg = "Could not get dump '%s': %s" % (self.url, r.reason)
+                raise CouldNotGetDumpException, mesg
+
+            encoding = compress.kind_of_encoding(
+                r.getheader('content-encoding'))
+
+            dump_fd = self.open_partial(truncate = True)
+
+            # we only know the decompressed size of plain dumps
+            if self.size and not self.compression:
+                dump_fd.preallocate(self.size)
+
+            try:
+                if self.compression or encoding:
+                    self.copy_decompressed(r, dump_fd)
+                else:
+                    self.copy_plain(r, dump_fd)
+
+                dump_fd.truncate()
+            finally:
+                dump_fd.close()
+
+        finally:
+            pool.release(conn, r)
+
+    def copy_plain(self, r, dump_fd):
+        """ copy the body of response r to dump_fd as it is """
+        length = r.getheader('content-length')
+        if length is not None:
+            self.digester.size = int(length)
+
+        for data in self.chunks(r):
+            dump_fd.write(data)
+            self.digester.update(data)
+            self.transferred += len(data)
+
+    def copy_decompressed(self, r, dump_fd):
+        """ copy the body of response r to dump_fd, decompressed """
+        from options import BUFSIZE
+
+        source, self.decompressed = dumpstream(responsestream(self, r), r,
+                                               self.url, self.compression,
+                                               self.digester)
+
+        data = source.read(BUFSIZE)
+        while data:
+            dump_fd.write(data)
+            data = source.read(BUFSIZE)
+
+    def fetch_segments(self):
+        """ fetch all the segments at once, each into its own offset of the
+        partial file """
+
+        threads = []
+        for segment in self.ranges:
+            start, end, done = segment
+            if start + done > end:
+                # already complete
+                continue
+
+            t = threading.Thread(target = self.fetch_range, args = (segment,))
+            t.start()
+            threads.append(t)
+
+        for t in threads:
+            t.join()
+
+        # hash what the threads left, and checkpoint where they stopped
+        self.lock.acquire()
+        try:
+            self.hashing = False
+            self.save_state()
+        finally:
+            self.lock.release()
+
+        if not self.errors:
+            self.digest_catchup()
+
+        for e in self.errors:
+            if isinstance(e, FetchCancelledException):
+                raise e
+
+        if self.errors:
+            raise CouldNotGetDumpException, self.errors[0]
+
+    def read(self, r, size):
+        """ read at most size bytes of response r, within our bandwidth
+        limits """
+        self.check_cancel()
+
+        if self.min_rate:
+            size = min(size, STALL_CHUNK)
+
+        data = r.read(self.limit.chunk(size))
+        self.limit.consume(len(data))
+
+        if data:
+            self.progress.update(len(data))
+
+        if self.min_rate:
+            self.check_rate(len(data))
+
+        return data
+
+    def chunks(self, r, length = None):
+        """ yield the body of response r, or its first length bytes, as
+        views of a buffer we reuse: each one is only valid until we're
+        asked for the next """
+        view = memoryview(bytearray(self.get_bufsize()))
+
+        while length is None or length > 0:
+            self.check_cancel()
+
+            size = len(view)
+            if length is not None:
+                size = min(size, length)
+            if self.min_rate:
+                size = min(size, STALL_CHUNK)
+
+            n = readinto(r, view[:self.limit.chunk(size)])
+            self.limit.consume(n)
+
+            if n:
+                self.progress.update(n)
+
+            if self.min_rate:
+                self.check_rate(n)
+
+            if not n:
+                break
+
+            if length is not None:
+                length -= n
+
+            yield view[:n]
+
+    def check_cancel(self):
+        """ raise FetchCancelledException once self.cancel is set """
+        if self.cancel is not None and self.cancel.isSet():
+            mesg = "Fetching '%s' from %s cancelled" % (self.url, self.host)
+            raise FetchCancelledException, mesg
+
+    def check_rate(self, n):
+        """ we just got n bytes, raise CouldNotGetDumpException when we got
+        less than self.min_rate bytes per second over the last window """
+        now = time.time()
+
+        self.lock.acquire()
+        try:
+            if self.window is None:
+                self.window = [now, 0]
+
+            self.window[1] += n
+            start, count = self.window
+
+            if now - start < STALL_WINDOW:
+                return
+
+            self.window = [now, 0]
+        finally:
+            self.lock.release()
+
+        rate = count / (now - start)
+        if rate < self.min_rate:
+            mesg = "Fetching '%s' from %s stalled at %d bytes/s" \
+                   % (self.url, self.host, rate)
+            raise CouldNotGetDumpException, mesg
+
+    def fetch_range(self, segment):
+        """ fetch what's missing of the segment into the partial file """
+        start, end, done = segment
+
+        pool, conn, r = None, None, None
+        try:
+            pool, conn, r = httppool.request(
+                self.host, "GET", self.url,
+                headers = {'Range': 'bytes=%d-%d' % (start + done, end)})
+
+            if r.status != 206:
+                mesg = "Could not get range %d-%d of '%s': %s" \
+                       % (start + done, end, self.url, r.reason)
+                raise CouldNotGetDumpException, mesg
+
+            dump_fd = self.open_partial()
+            dump_fd.seek(start + done)
+
+            # keep what's ahead of the digest in the page cache, so that
+            # digest_catchup() reads it from there
+            dump_fd.hashed = lambda: self.digester.count
+
+            try:
+                left = end - start - done + 1
+                for data in self.chunks(r, left):
+                    # stop as soon as another segment failed
+                    if self.errors:
+                        break
+
+                    # only checkpoint bytes that made it to the file, dumpfile
+                    # writes are not buffered
+                    dump_fd.write(data)
+                    left -= len(data)
+
+                    self.lock.acquire()
+                    try:
+                        offset = start + segment[2]
+                        segment[2] += len(data)
+                        self.transferred += len(data)
+
+                        if time.time() - self.saved_at >= CHECKPOINT:
+                            self.save_state()
+                    finally:
+                        self.lock.release()
+
+                    self.digest_catchup(offset, data)
+
+                if left > 0 and not self.errors:
+                    mesg = "Short read on range %d-%d of '%s'" \
+                           % (start, end, self.url)
+                    raise CouldNotGetDumpException, mesg
+            finally:
+                dump_fd.close()
+
+        except Exception, e:
+            # the main thread raises the exception for us
+            self.errors.append(e)
+
+        if pool:
+            pool.release(conn, r)
+
+    def digest_catchup(self, offset = None, data = None):
+        """ hash data written at offset when it comes right after what we
+        hashed, then the bytes already written after it, when their segment
+        got ahead of the previous one. Only one thread hashes at a time, the
+        others return at once, and the file is read and hashed without
+        self.lock held """
+        from options import BUFSIZE
+
+        self.lock.acquire()
+        try:
+            if self.hashing:
+                return
+            self.hashing = True
+        finally:
+            self.lock.release()
+
+        fd = None
+        try:
+            if data is not None and offset == self.digester.count:
+                self.digester.update(data)
+
+            while True:
+                # we're done when no segment has more bytes to hash, the
+                # other threads saw self.hashing until then
+                self.lock.acquire()
+                try:
+                    size = self.unhashed()
+                    if not size:
+                        self.hashing = False
+                        return
+                finally:
+                    self.lock.release()
+
+                if fd is None:
+                    fd = open(self.partial, "rb")
+
+                offset = self.digester.count
+                fd.seek(offset)
+                data = fd.read(min(BUFSIZE, size))
+                if not data:
+                    self.hashing = False
+                    return
+
+                self.digester.update(data)
+
+                # the segment threads left these pages for us to drop
+                if self.drop_cache:
+                    dumpfile.drop(fd.fileno(), offset, len(data))
+
+        except:
+            self.hashing = False
+            raise
+
+        finally:
+            if fd is not None:
+                fd.close()
+
+    def unhashed(self):
+        """ how many bytes are written right after what we hashed, called
+        with self.lock held """
+        for start, end, done in self.ranges:
+            if start <= self.digester.count < start + done:
+                return start + done - self.digester.count
+        return 0
+
+def benchmark(size, bufsize, reuse):
+    """ receive an HTTP body of size bytes over a local socket and write it
+    to /dev/null, either with a read() per buffer or reusing a single
+    buffer, and return the (cpu, wall) seconds it took. The cpu time
+    includes the sending thread, that costs the same in both cases """
+    # the loopback is a very fast mirror
+    listener = socket.socket()
+    listener.bind(('127.0.0.1', 0))
+    listener.listen(1)
+
+    receiver = socket.create_connection(listener.getsockname())
+    sender   = listener.accept()[0]
+    listener.close()
+
+    def send():
+        try:
+            sender.sendall("HTTP/1.1 200 OK\r\nContent-Length: %d\r\n\r\n"
+                           % size)
+            block = '\0' * BENCH_BLOCK
+            left  = size
+            while left > 0:
+                sender.sendall(buffer(block, 0, min(left, BENCH_BLOCK)))
+                left -= BENCH_BLOCK
+        finally:
+            sender.close()
+
+    t = threading.Thread(target = send)
+    t.start()
+
+    r = httplib.HTTPResponse(receiver)
+    r.begin()
+
+    out = dumpfile.dumpfile(os.devnull, drop_cache = False)
+
+    start, cpu = time.time(), os.times()
+    try:
+        if reuse:
+            view = memoryview(bytearray(bufsize))
+            n = readinto(r, view)
+            while n:
+                out.write(view[:n])
+                n = readinto(r, view)
+        else:
+            data = r.read(bufsize)
+            while data:
+                out.write(data)
+                data = r.read(bufsize)
+    finally:
+        out.close()
+        receiver.close()
+        t.join()
+
+    end, times = time.time(), os.times()
+    return (times[0] + times[1] - cpu[0] - cpu[1], end - start)
@@ -0,0 +1,139 @@
+##
+## Keep-alive HTTP connections to the backup hosts
+##
+## Listings, checksums and dumps are all fetched from the same few backup
+## hosts, so we keep the HTTP/1.1 connections open once a response has
+## been read entirely, and reuse them for the next request to the same
+## host. Connections left idle for too long are closed, and we never open
+## more than a given number of connections to any host at once.
+##
+
+import time, socket, httplib, threading
+
+# backup_host: connectionpool, shared by the whole process
+pools = {}
+pools_lock = threading.Lock()
+
+def get_pool(host):
+    """ return the connection pool of given host """
+    from options import HTTP_POOL_SIZE, HTTP_IDLE_TIMEOUT, HTTP_TIMEOUT
+
+    pools_lock.acquire()
+    try:
+        if host not in pools:
+            pools[host] = connectionpool(host,
+                                         HTTP_POOL_SIZE, HTTP_IDLE_TIMEOUT,
+                                         HTTP_TIMEOUT)
+        return pools[host]
+    finally:
+        pools_lock.release()
+
+def request(host, method, url, headers = {}):
+    """ send the request to host, return (pool, conn, response) """
+    pool = get_pool(host)
+    conn, r = pool.request(method, url, headers)
+    return pool, conn, r
+
+def stats():
+    """ return {'new': n, 'reused': n} for all hosts """
+    s = {'new': 0, 'reused': 0}
+    for pool in pools.values():
+        s['new']    += pool.new
+        s['reused'] += pool.reused
+    return s
+
+class connectionpool:
+    """ Keep-alive connections to a single host """
+
+    def __init__(self, host, size, idle_timeout, timeout = None):
+        """ size is the max number of connections, idle or in use, and
+        timeout how long to wait for the server, in seconds """
+        self.host         = host
+        self.size         = size
+        self.idle_timeout = idle_timeout
+        self.timeout      = timeout
+
+        self.idle         = []   # [(time.time(), conn), ...]
+        self.used         = 0
+        self.cond         = threading.Condition()
+
+        # counters
+        self.new          = 0
+        self.reused       = 0
+
+    def get(self):
+        """ return (conn, reused), waiting for a free slot """
+        self.cond.acquire()
+        try:
+            while not self.idle and self.used >= self.size:
+                self.cond.wait()
+
+            # the server is going to close connections idle for too long,
+            # don't risk it
+            now = time.time()
+            while self.idle and now - self.idle[0][0] > self.idle_timeout:
+                stamp, conn = self.idle.pop(0)
+                conn.close()
+
+            self.used += 1
+
+            if self.idle:
+                stamp, conn = self.idle.pop()
+                self.reused += 1
+                return conn, True
+
+            self.new += 1
+        finally:
+            self.cond.release()
+
+        return httplib.HTTPConnection(self.host, timeout = self.timeout), False
+
+    def release(self, conn, r = None):
+        """ give conn back, keep it open only when the response r has been
+        read entirely and the server agrees """
+        self.cond.acquire()
+        try:
+            self.used -= 1
+
+            if r is not None and r.isclosed() and not r.will_close:
+                self.idle.append((time.time(), conn))
+            else:
+                conn.close()
+
+            self.cond.notify()
+        finally:
+            self.cond.release()
+
+    def close_idle(self):
+        """ close all idle connections """
+        self.cond.acquire()
+        try:
+            for stamp, conn in self.idle:
+                conn.close()
+            self.idle = []
+        finally:
+            self.cond.release()
+
+    def request(self, method, url, headers = {}):
+        """ send the request, return (conn, response), conn is to be
+        released once the response has been read """
+        from options import VERBOSE
+
+        for attempt in (1, 2):
+            conn, reused = self.get()
+
+            try:
+                conn.request(method, url, headers = headers)
+                return conn, conn.getresponse()
+
+            except (httplib.HTTPException, socket.error), e:
+                self.release(conn)
+
+                if not reused or attempt == 2:
+                    raise
+
+                # the server closed our idle connections, start afresh
+                if VERBOSE:
+                    print "http://%s: reconnecting, %s" % (self.host, repr(e))
+
+                self.close_idle()
@@ -0,0 +1,304 @@
+##
+## Shared cache of the backup directories listings
+##
+## Many sections usually share the same backup directory, and we need its
+## listing to find the latest or oldest backup of each of them. We parse
+## each listing only once, index it per database name and date, and only
+## fetch it again when it's older than its time to live, using a
+## conditional request so that the server can tell us it didn't change.
+##
+## The listing is parsed as it's received, and can be either an Apache or
+## nginx HTML autoindex, an nginx JSON autoindex or a plain manifest file
+## with a file name per line, optionally preceded by its size.
+##
+## Only the dumps themselves, plain or compressed, are indexed. The sidecar
+## and marker files published next to them, such as foo_db.2011-03-12.dump
+## .sha256, are kept apart, by the name of their dump.
+##
+
+import os, re, time, datetime, threading, itertools, json
+
+import httppool, localfetch, compress
+from utils import CouldNotGetDumpException
+
+# how much of the listing we read from the socket at once
+CHUNK_SIZE = 64 * 1024
+
+# a dump, then the suffix of the sidecar files published next to it
+DUMP_FILENAME = re.compile(r'^(.*?\.dump(?:%s)?)(\..*)?$'
+                           % "|".join([re.escape(ext)
+                                       for ext in compress.EXTENSIONS]))
+
+# (host, url): backuplisting, shared by all Staging objects
+listings = {}
+listings_lock = threading.Lock()
+
+def get_listing(host, url, ttl):
+    """ return the fresh listing for given backup directory """
+    listings_lock.acquire()
+    try:
+        if (host, url) not in listings:
+            listings[(host, url)] = backuplisting(host, url)
+        l = listings[(host, url)]
+    finally:
+        listings_lock.release()
+
+    l.refresh(ttl)
+    return l
+
+def parse_listing(chunks):
+    """ yield (size, filename) for the files of the listing given in chunks,
+    guessing its format from its first non blank chunk """
+    from apache_listing import ApacheListingParser
+
+    chunks = iter(chunks)
+
+    first = ""
+    for first in chunks:
+        if first.strip():
+            break
+
+    head = first.lstrip()
+    if head.startswith('<'):
+        # an empty pattern matches all files
+        parser = ApacheListingParser(None, '')
+    elif head.startswith('['):
+        parser = jsonlisting()
+    else:
+        parser = manifestlisting()
+
+    for chunk in itertools.chain([first], chunks):
+        for f in parser.feed(chunk):
+            yield f
+
+    for f in parser.close():
+        yield f
+
+class jsonlisting:
+    """ parses nginx autoindex_format json listings, an array of objects
+    without nesting """
+
+    entry = re.compile(r'\{[^{}]*\}')
+
+    def __init__(self):
+        self.buffer = ""
+
+    def feed(self, chunk):
+        """ return files of the complete entries seen so far """
+        self.buffer += chunk
+
+        files = []
+        end   = 0
+        for m in self.entry.finditer(self.buffer):
+            end = m.end()
+            e   = json.loads(m.group(0))
+
+            if e.get('type') == 'file':
+                files.append((str(e.get('size', '-')),
+                              e['name'].encode('utf-8')))
+
+        self.buffer = self.buffer[end:]
+        return files
+
+    def close(self):
+        """ any leftover is not an entry """
+        self.buffer = ""
+        return []
+
+class manifestlisting:
+    """ parses a manifest file: '[size] filename' lines, # comments """
+
+    def __init__(self):
+        self.buffer = ""
+
+    def feed(self, chunk):
+        """ return files of the lines ended in this chunk """
+        lines = (self.buffer + chunk).split('\n')
+        self.buffer = lines.pop()
+
+        return [f for line in lines for f in self.match(line)]
+
+    def close(self):
+        """ return the file on the last line, if any """
+        line, self.buffer = self.buffer, ""
+        return self.match(line)
+
+    def match(self, line):
+        """ return [(size, filename)] for the file given on this line """
+        line = line.strip()
+        if not line or line.startswith('#'):
+            return []
+
+        fields = line.split(None, 1)
+        if len(fields) == 1:
+            return [('-', fields[0])]
+
+        return [tuple(fields)]
+
+def parse_backup_filename(filename):
+    """ return dbname, date from foo_db.2011-03-11.dump, or None """
+    try:
+        dbname, date = filename.split('.')[0:2]
+        y, m, d = date.split('-')
+        return dbname, datetime.date(int(y), int(m), int(d))
+    except ValueError:
+        return None
+
+class backuplisting:
+    """ A backup directory listing, indexed by database name and date """
+
+    def __init__(self, host, url):
+        """ the listing is fetched at first refresh() """
+        self.host          = host
+        self.url           = url
+        self.fetched       = None
+        self.etag          = None
+        self.last_modified = None
+        self.lock          = threading.Lock()
+
+        # [(size, filename), ...] as found in the listing
+        self.files         = []
+
+        # {dbname: [(date, size, filename), ...]}, sorted by date
+        self.index         = {}
+
+        # {dump filename: [suffix, ...]}, such as '.sha256' or '.done'
+        self.sidecars      = {}
+
+    def refresh(self, ttl):
+        """ fetch the listing again when it's older than ttl seconds """
+        self.lock.acquire()
+        try:
+            if self.fetched is None or time.time() - self.fetched > ttl:
+                self.fetch()
+        finally:
+            self.lock.release()
+
+    def fetch(self):
+        """ (conditional) GET of the listing, parse it when it changed """
+        from options import VERBOSE
+
+        if localfetch.is_local(self.url):
+            return self.fetch_directory()
+
+        headers = {}
+        if self.etag:
+            headers['If-None-Match'] = self.etag
+        if self.last_modified:
+            headers['If-Modified-Since'] = self.last_modified
+
+        pool, conn, r = httppool.request(self.host, "GET", self.url, headers)
+
+        try:
+            if r.status == 304:
+                r.read()
+                if VERBOSE:
+                    print "listing of http://%s%s did not change" \
+                          % (self.host, self.url)
+
+                self.fetched = time.time()
+                return
+
+            if r.status != 200:
+                raise CouldNotGetDumpException, r.reason
+
+            # parse the listing while we receive it
+            start = time.time()
+            self.parse(iter(lambda: r.read(CHUNK_SIZE), ""))
+
+            if VERBOSE:
+                print "listing of http://%s%s: %d files in %.3fs" \
+                      % (self.host, self.url, len(self.files),
+                         time.time() - start)
+
+        finally:
+            pool.release(conn, r)
+
+        self.etag          = r.getheader('etag')
+        self.last_modified = r.getheader('last-modified')
+        self.fetched       = time.time()
+
+    def fetch_directory(self):
+        """ list a local directory, unless its mtime didn't change """
+        try:
+            mtime = os.stat(localfetch.path(self.url)).st_mtime
+        except OSError, e:
+            raise CouldNotGetDumpException, e.strerror
+
+        if mtime != self.last_modified:
+            self.build(localfetch.list_directory(self.url))
+            self.last_modified = mtime
+
+        self.fetched = time.time()
+
+    def parse(self, chunks):
+        """ parse the listing and build the index """
+        self.build(parse_listing(chunks))
+
+    def build(self, listing):
+        """ build the index of the listing, given as (size, filename) """
+        files    = []
+        index    = {}
+        sidecars = {}
+        for size, filename in listing:
+            files.append((size, filename))
+
+            m = DUMP_FILENAME.match(filename)
+            if m is None:
+                continue
+
+            dump, suffix = m.groups()
+            if suffix:
+                sidecars.setdefault(dump, []).append(suffix)
+                continue
+
+            parsed = parse_backup_filename(filename)
+            if parsed:
+                dbname, date = parsed
+                index.setdefault(dbname, []).append((date, size, filename))
+
+        for dbname in index:
+            index[dbname].sort()
+
+        self.files    = files
+        self.index    = index
+        self.sidecars = sidecars
+
+    def backups(self, pattern):
+        """ return the [(size, filename)] list of files matching pattern """
+        return [(s, f) for s, f in self.files if f.find(pattern) > -1]
+
+    def get_sidecars(self, filename):
+        """ return the suffixes of the files published next to the dump """
+        return self.sidecars.get(filename, [])
+
+    def latest(self, dbname):
+        """ return (size, filename) of the latest backup of dbname """
+        if not self.index.get(dbname):
+            return None
+
+        date, size, filename = self.index[dbname][-1]
+        return size, filename
+
+    def oldest(self, dbname):
+        """ return (size, filename) of the oldest backup of dbname """
+        if not self.index.get(dbname):
+            return None
+
+        date, size, filename = self.index[dbname][0]
+        return size, filename
+
+    def nearest(self, dbname, date):
+        """ return (size, filename) of the backup of dbname nearest to given
+        date, preferring the older one when two are as near """
+        if not self.index.get(dbname):
+            return None
+
+        best = None
+        for d, size, filename in self.index[dbname]:
+            distance = abs((d - date).days)
+
+            if best is None or distance < best[0]:
+                best = distance, size, filename
+
+        return best[1], best[2]
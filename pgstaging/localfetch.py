@@ -0,0 +1,270 @@
+##
+## Fetch backup files from a local or mounted directory
+##
+## When the backups are reachable as files, given as a file:// URL, we
+## bring them into tmpdir with the cheapest method the file systems allow:
+## a hard link, a reflink (copy on write clone), an in kernel copy with
+## copy_file_range() or sendfile(), and only then a buffered copy.
+##
+
+import os, time, errno, fcntl, ctypes, email.utils
+
+import progress, compress, dumpfile
+from utils import CouldNotGetDumpException, FetchCancelledException
+from utils import libc_call
+
+# from linux/fs.h: _IOW(0x94, 9, int)
+FICLONE = 0x40049409
+
+# errors telling that a method is not available between those files
+UNSUPPORTED = (errno.EXDEV, errno.EPERM, errno.EINVAL, errno.ENOSYS,
+               errno.EOPNOTSUPP, errno.ENOTTY, errno.EBADF)
+
+def is_local(url):
+    """ is url a file:// one? """
+    return url.startswith('file://')
+
+def path(url):
+    """ file:///var/backups/foo.dump is /var/backups/foo.dump """
+    return url[len('file://'):]
+
+class filefetch:
+    """ Bring a local file into tmpdir, with the same interface as
+    fetch.httpfetch """
+
+    def __init__(self, url, filename):
+        self.url           = url
+        self.source        = path(url)
+        self.filename      = filename
+        self.partial       = "%s.partial" % filename
+
+        # filled in by self.head()
+        self.headed        = False
+        self.size          = None
+        self.etag          = None
+        self.last_modified = None
+
+        # how to write the local copy, see dumpfile
+        self.drop_cache    = True
+        self.direct        = False
+
+        # size of the buffer a plain copy reads into
+        self.bufsize       = None
+
+        # threading.Event set when we should stop copying
+        self.cancel        = None
+
+        # filled in by self.fetch()
+        self.method        = None
+        self.digest        = None
+        self.transferred   = 0
+        self.rate          = None
+        self.progress      = progress.progress(url)
+
+        # compressed dumps are decompressed while copied
+        self.compression   = compress.kind_of(url)
+        self.decompressed  = None
+
+    def head(self):
+        """ stat the source file, for its size and validators """
+        try:
+            st = os.stat(self.source)
+        except OSError, e:
+            mesg = "Could not get dump '%s': %s" % (self.url, e.strerror)
+            raise CouldNotGetDumpException, mesg
+
+        self.size          = st.st_size
+        self.last_modified = email.utils.formatdate(st.st_mtime, usegmt = True)
+        self.headed        = True
+
+    def fetch(self):
+        """ fetch the file, return its local filename """
+        from options import VERBOSE
+
+        if not self.headed:
+            self.head()
+
+        start_time = time.time()
+        self.progress.size = self.size
+
+        methods = (self.hardlink, self.reflink,
+                   self.copy_file_range, self.sendfile, self.copy)
+
+        if self.compression:
+            methods = (self.decompress,)
+
+        for method in methods:
+            if os.path.exists(self.partial):
+                os.unlink(self.partial)
+
+            # a failed method may have reported some bytes already
+            self.progress.begin()
+
+            try:
+                if method():
+                    self.method = method.__name__
+                    break
+
+            except (OSError, IOError), e:
+                if e.errno not in UNSUPPORTED:
+                    raise
+
+                if VERBOSE:
+                    print "%s: %s" % (method.__name__, e.strerror)
+
+        self.progress.done()
+
+        if os.path.getsize(self.partial) != self.size \
+               and not self.compression:
+            os.unlink(self.partial)
+            mesg = "Dump '%s' changed while we copied it" % self.url
+            raise CouldNotGetDumpException, mesg
+
+        os.rename(self.partial, self.filename)
+
+        elapsed = time.time() - start_time
+        if elapsed > 0 and self.method != 'hardlink':
+            self.transferred = self.size
+            self.rate = self.size / elapsed
+
+        return self.filename
+
+    def hardlink(self):
+        """ link the source into tmpdir, needs the same file system """
+        os.link(self.source, self.partial)
+        return True
+
+    def reflink(self):
+        """ clone the source blocks, on btrfs, xfs and the like """
+        src = open(self.source, "rb")
+        dst = open(self.partial, "wb")
+        try:
+            fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+        finally:
+            dst.close()
+            src.close()
+
+        return True
+
+    def check_cancel(self):
+        """ raise FetchCancelledException once self.cancel is set """
+        if self.cancel is not None and self.cancel.isSet():
+            raise FetchCancelledException, "Copy of '%s' cancelled" % self.url
+
+    def open_partial(self, size = None):
+        """ return the partial file as a dumpfile, preallocated to size """
+        dst = dumpfile.dumpfile(self.partial, truncate = True,
+                                drop_cache = self.drop_cache,
+                                direct = self.direct)
+        if size:
+            dst.preallocate(size)
+        return dst
+
+    def kernel_copy(self, call):
+        """ copy with call(src_fd, dst_fd, size), returning how many bytes
+        were copied, or -1 and errno """
+        from options import BUFSIZE
+
+        src = open(self.source, "rb")
+        dst = self.open_partial(self.size)
+        try:
+            done = 0
+            while done < self.size:
+                n = call(src.fileno(), dst.fileno(),
+                         min(self.size - done, 64 * BUFSIZE))
+
+                if n < 0:
+                    e = ctypes.get_errno()
+                    raise OSError(e, os.strerror(e))
+
+                if n == 0:
+                    break
+
+                done += n
+                dst.advance(n)
+                self.progress.update(n)
+                self.check_cancel()
+
+            dst.truncate()
+        finally:
+            dst.close()
+            src.close()
+
+        return True
+
+    def copy_file_range(self):
+        """ in kernel copy, server side for NFS 4.2 """
+        func = libc_call('copy_file_range', ctypes.c_ssize_t,
+                         [ctypes.c_int, ctypes.c_void_p,
+                          ctypes.c_int, ctypes.c_void_p,
+                          ctypes.c_size_t, ctypes.c_uint])
+        if func is None:
+            return False
+
+        return self.kernel_copy(
+            lambda src, dst, n: func(src, None, dst, None, n, 0))
+
+    def sendfile(self):
+        """ in kernel copy, from the page cache to the target file """
+        func = libc_call('sendfile', ctypes.c_ssize_t,
+                         [ctypes.c_int, ctypes.c_int,
+                          ctypes.c_void_p, ctypes.c_size_t])
+        if func is None:
+            return False
+
+        return self.kernel_copy(lambda src, dst, n: func(dst, src, None, n))
+
+    def copy(self):
+        """ good old buffered copy, through a buffer we reuse """
+        from options import BUFSIZE
+
+        view = memoryview(bytearray(self.bufsize or BUFSIZE))
+
+        src = open(self.source, "rb")
+        dst = self.open_partial(self.size)
+        try:
+            n = src.readinto(view)
+            while n:
+                dst.write(view[:n])
+                self.progress.update(n)
+                self.check_cancel()
+                n = src.readinto(view)
+
+            dst.truncate()
+        finally:
+            dst.close()
+            src.close()
+
+        return True
+
+    def decompress(self):
+        """ decompress the source into tmpdir """
+        from options import BUFSIZE
+
+        src = open(self.source, "rb")
+        dst = self.open_partial()
+        try:
+            self.decompressed = compress.decompressedstream(
+                progress.progressstream(src, self.progress),
+                self.compression)
+
+            data = self.decompressed.read(BUFSIZE)
+            while data:
+                dst.write(data)
+                self.check_cancel()
+                data = self.decompressed.read(BUFSIZE)
+        finally:
+            dst.close()
+            src.close()
+
+        return True
+
+def list_directory(url):
+    """ return [(size, filename), ...] for the files of url directory """
+    d = path(url)
+    files = []
+    for name in sorted(os.listdir(d)):
+        p = os.path.join(d, name)
+        if os.path.isfile(p):
+            files.append((str(os.path.getsize(p)), name))
+    return files
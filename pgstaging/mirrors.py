@@ -0,0 +1,210 @@
+##
+## Choose the fastest healthy backup mirror
+##
+## backup_host can be a list of mirrors serving the same backups. We keep
+## statistics about them in tmpdir/pg_staging.mirrors: the throughput the
+## last fetches and probes achieved, and when each mirror last failed.
+## Mirrors we know nothing about, or nothing recent, are probed with a
+## small Range request before choosing, and a mirror that failed recently
+## is only used when all the others failed too.
+##
+
+import os, time, fcntl, socket, httplib, threading, ConfigParser
+
+import httppool
+from utils import CouldNotGetDumpException
+
+STATS       = "pg_staging.mirrors"
+
+PROBE_SIZE  = 1024 * 1024   # bytes fetched to measure a mirror throughput
+PROBE_TTL   = 3600          # seconds we trust a measure for
+FAILURE_TTL = 600           # seconds we avoid a mirror that failed
+
+# new measures count for that much in the mirror rate, older ones for the
+# rest
+WEIGHT      = 0.5
+
+# errors telling that a mirror is not serving us well
+ERRORS = (CouldNotGetDumpException, httplib.HTTPException, socket.error)
+
+def split(backup_host):
+    """ 'a.example.com, b.example.com:8080' is a list of two mirrors """
+    if not backup_host:
+        # file:// backups don't need a backup_host
+        return [backup_host]
+
+    return backup_host.replace(',', ' ').split()
+
+class mirrorstats:
+    """ Persistent throughput and failure statistics of backup mirrors """
+
+    # threads of the same process share the stats file
+    lock = threading.Lock()
+
+    def __init__(self, tmpdir):
+        self.filename = os.path.join(tmpdir, STATS)
+
+    def open(self):
+        """ lock and read the stats, return (lockfile, config) """
+        self.lock.acquire()
+
+        lockfile = open("%s.lock" % self.filename, "w")
+        fcntl.flock(lockfile, fcntl.LOCK_EX)
+
+        config = ConfigParser.RawConfigParser()
+        config.read(self.filename)
+
+        return lockfile, config
+
+    def close(self, lockfile, config, write = True):
+        """ write the stats back and release the locks """
+        try:
+            if write:
+                tmpname = "%s.tmp" % self.filename
+                fd = open(tmpname, "w")
+                config.write(fd)
+                fd.close()
+                os.rename(tmpname, self.filename)
+        finally:
+            fcntl.flock(lockfile, fcntl.LOCK_UN)
+            lockfile.close()
+            self.lock.release()
+
+    def get(self, host):
+        """ return (rate, measured, failed) for host, None when unknown """
+        lockfile, config = self.open()
+        try:
+            return self.read(config, host)
+        finally:
+            self.close(lockfile, config, write = False)
+
+    def read(self, config, host):
+        """ return (rate, measured, failed) from config """
+        values = []
+        for option in ('rate', 'measured', 'failed'):
+            if config.has_option(host, option):
+                values.append(config.getfloat(host, option))
+            else:
+                values.append(None)
+        return tuple(values)
+
+    def record(self, host, rate):
+        """ host just served us at rate bytes per second """
+        lockfile, config = self.open()
+        try:
+            if not config.has_section(host):
+                config.add_section(host)
+
+            old = self.read(config, host)[0]
+            if old is not None:
+                rate = WEIGHT * rate + (1 - WEIGHT) * old
+
+            config.set(host, 'rate', rate)
+            config.set(host, 'measured', time.time())
+            config.remove_option(host, 'failed')
+            config.remove_option(host, 'error')
+        finally:
+            self.close(lockfile, config)
+
+    def failed(self, host, error):
+        """ host failed us """
+        lockfile, config = self.open()
+        try:
+            if not config.has_section(host):
+                config.add_section(host)
+
+            config.set(host, 'failed', time.time())
+            config.set(host, 'error', str(error).replace('\n', ' '))
+        finally:
+            self.close(lockfile, config)
+
+    def healthy(self, failed, now = None):
+        """ is a mirror that failed at given time usable again? """
+        if failed is None:
+            return True
+
+        return (now or time.time()) - failed > FAILURE_TTL
+
+    def probe(self, host, url):
+        """ measure the throughput of host by fetching the first bytes of
+        url, return the rate or None when the mirror failed """
+        from options import VERBOSE
+
+        start = time.time()
+        pool, conn, r = None, None, None
+        try:
+            try:
+                pool, conn, r = httppool.request(
+                    host, "GET", url,
+                    {'Range': 'bytes=0-%d' % (PROBE_SIZE - 1)})
+
+                if r.status not in (200, 206):
+                    raise CouldNotGetDumpException, r.reason
+
+                # servers ignoring Range send the whole file, we only need
+                # the first bytes of it
+                size = 0
+                while size < PROBE_SIZE:
+                    data = r.read(min(64 * 1024, PROBE_SIZE - size))
+                    if not data:
+                        break
+                    size += len(data)
+
+                if r.status == 200:
+                    r.close()
+
+            except ERRORS, e:
+                if VERBOSE:
+                    print "mirror %s: probe failed, %s" % (host, e)
+                self.failed(host, e)
+                return None
+
+        finally:
+            if pool:
+                pool.release(conn, r)
+
+        rate = size / max(time.time() - start, 0.001)
+        self.record(host, rate)
+
+        if VERBOSE:
+            print "mirror %s: probed at %.1f MB/s" % (host, rate / 1024**2)
+
+        return rate
+
+    def rank(self, hosts, url = None):
+        """ return hosts, fastest healthy first. When given url, probe the
+        hosts without a recent enough measure first """
+        now = time.time()
+
+        if url:
+            for host in hosts:
+                rate, measured, failed = self.get(host)
+                if self.healthy(failed, now) \
+                       and (measured is None or now - measured > PROBE_TTL):
+                    self.probe(host, url)
+
+        def order(host):
+            rate, measured, failed = self.get(host)
+
+            # unknown mirrors after the measured ones, failed ones last,
+            # and then the configuration order
+            return (not self.healthy(failed, now),
+                    -(rate or 0),
+                    hosts.index(host))
+
+        return sorted(hosts, key = order)
+
+    def list(self, hosts):
+        """ return [(host, rate, measured, failed, error)] """
+        lockfile, config = self.open()
+        try:
+            content = []
+            for host in hosts:
+                rate, measured, failed = self.read(config, host)
+                error = None
+                if config.has_option(host, 'error'):
+                    error = config.get(host, 'error')
+                content.append((host, rate, measured, failed, error))
+            return content
+        finally:
+            self.close(lockfile, config, write = False)
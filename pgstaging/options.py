@@ -11,6 +11,20 @@ DRY_RUN = False
 
 BUFSIZE = 8 * 1024 * 1024
 
+# how long to trust a backup directory listing, in seconds
+LISTING_TTL = 300
+
+# keep-alive connections to the backup hosts: how many per host at most,
+# and how many seconds an idle one is kept
+HTTP_POOL_SIZE    = 8
+HTTP_IDLE_TIMEOUT = 30
+
+# seconds to wait for a backup host before giving up on it
+HTTP_TIMEOUT      = 120
+
+# how many dumps the prefetch command fetches at the same time
+PREFETCH_WORKERS  = 4
+
 TMPDIR              = None    # given via -t option
 DEFAULT_TMPDIR      = '/tmp'  # hardcoded default for when no setup is made
 DEFAULT_CONFIG_FILE = "/etc/pg_staging/pg_staging.ini"
@@ -6,10 +6,27 @@
 ## with psycopg2 or other libpq based connection libs, so we resort to psql
 ## subprocess.
 ##
-import os
+import os, threading
 import utils
 from utils import CouldNotGetPgBouncerConfigException, SubprocessException
 
+# (host, conffile): lock, editing a configuration reads it, changes it then
+# installs it back, sections restored concurrently must take turns
+config_locks = {}
+config_locks_lock = threading.Lock()
+
+def get_config_lock(host, conffile):
+    """ return the lock serializing edits of the configuration file of the
+    pgbouncer running on host """
+    config_locks_lock.acquire()
+    try:
+        if (host, conffile) not in config_locks:
+            config_locks[(host, conffile)] = threading.Lock()
+
+        return config_locks[(host, conffile)]
+    finally:
+        config_locks_lock.release()
+
 class pgbouncer:
     """ PgBouncer class to get some data out of special SHOW commands """
 
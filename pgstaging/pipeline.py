@@ -0,0 +1,139 @@
+##
+## Run a small graph of dependant stages with a pool of threads
+##
+## The restore command is made of steps that don't all depend on each
+## other: we can create the database and source the pre SQL files while
+## fetching the dump, for example. Each stage runs as soon as all the
+## stages it depends on are done, and we keep track of when it started and
+## ended so that we can tell what bounds the whole run.
+##
+
+import sys, time, threading
+
+class pipeline:
+    """ A set of named stages with dependencies, run concurrently """
+
+    def __init__(self, workers = 4):
+        """ workers is how many stages can run at the same time """
+        self.workers  = workers
+        self.stages   = []      # stage names, in order of addition
+        self.funcs    = {}      # name: function to call
+        self.depends  = {}      # name: [names]
+        self.started  = {}      # name: time.time()
+        self.ended    = {}      # name: time.time()
+        self.failed   = {}      # name: time.time()
+        self.failure  = None    # sys.exc_info() of the first failure
+        self.cond     = threading.Condition()
+
+        # set on the first failure, long running stages check it to stop
+        # early
+        self.cancelled = threading.Event()
+
+    def add(self, name, func, depends = []):
+        """ add a stage, func is called without arguments """
+        for d in depends:
+            if d not in self.funcs:
+                raise Exception, "INTERNAL: stage '%s' depends on " % name \
+                      + "unknown stage '%s'" % d
+
+        self.stages.append(name)
+        self.funcs[name]   = func
+        self.depends[name] = depends
+
+    def ready(self):
+        """ list stages we can start now """
+        return [s for s in self.stages
+                if s not in self.started
+                and not [d for d in self.depends[s] if d not in self.ended]]
+
+    def run_stage(self, name):
+        """ thread body: run the stage and signal the scheduler """
+        from options import VERBOSE
+
+        if VERBOSE:
+            print "stage %s: starting" % name
+
+        try:
+            self.funcs[name]()
+        except:
+            self.cond.acquire()
+            self.failed[name] = time.time()
+            if self.failure is None:
+                self.failure = sys.exc_info()
+                self.cancelled.set()
+            self.cond.notify()
+            self.cond.release()
+            return
+
+        self.cond.acquire()
+        self.ended[name] = time.time()
+        self.cond.notify()
+        self.cond.release()
+
+        if VERBOSE:
+            print "stage %s: done in %.3fs" \
+                  % (name, self.ended[name] - self.started[name])
+
+    def run(self):
+        """ run all the stages, raise the first error we get """
+        self.start_time = time.time()
+
+        self.cond.acquire()
+        try:
+            while len(self.ended) < len(self.stages):
+                running = len(self.started) - len(self.ended) \
+                          - len(self.failed)
+
+                if self.failure:
+                    # don't start anything else, and wait until the stages
+                    # still running are done, they have been cancelled
+                    if running == 0:
+                        t, v, tb = self.failure
+                        raise t, v, tb
+
+                    self.cond.wait()
+                    continue
+
+                for name in self.ready()[:self.workers - running]:
+                    self.started[name] = time.time()
+
+                    t = threading.Thread(target = self.run_stage,
+                                         args   = (name,))
+                    t.setDaemon(True)
+                    t.start()
+
+                if len(self.started) == len(self.ended) + len(self.failed):
+                    # nothing is running and nothing can start
+                    raise Exception, "INTERNAL: pipeline dependency cycle"
+
+                self.cond.wait()
+
+        finally:
+            self.cond.release()
+
+        self.end_time = time.time()
+
+    def timings(self):
+        """ return [(name, offset, duration)] for the stages that ran,
+        offset being the start time relative to the pipeline start """
+        return [(s,
+                 self.started[s] - self.start_time,
+                 self.ended[s] - self.started[s])
+                for s in self.stages if s in self.ended]
+
+    def critical_path(self):
+        """ return the chain of stages that bounded the pipeline duration,
+        starting with the first one """
+        if not self.ended:
+            return []
+
+        # start from the last stage to finish, then follow the dependency
+        # that finished last each time
+        last = max([(self.ended[s], s) for s in self.ended])[1]
+        path = [last]
+
+        while self.depends[last]:
+            last = max([(self.ended[d], d) for d in self.depends[last]])[1]
+            path.insert(0, last)
+
+        return path
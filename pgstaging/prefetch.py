@@ -0,0 +1,162 @@
+##
+## Fetch the latest dumps of many sections ahead of their restore
+##
+## A bounded pool of worker threads fetches the dumps, never running more
+## than host_fetch_jobs downloads from the same backup_host, or set of
+## mirrors, at once, and only starting a download when tmpdir has room for
+## it, counting the downloads still in progress. Fetched dumps are
+## registered in the dump cache, where restore will find them.
+##
+
+import os, time, threading
+
+def free_space(path):
+    """ bytes available to us in the file system holding path """
+    st = os.statvfs(path)
+    return st.f_bavail * st.f_frsize
+
+class prefetcher:
+    """ Prefetch the latest dump of a list of Staging objects """
+
+    def __init__(self, workers = 4):
+        """ workers is how many dumps we fetch at most at the same time """
+        self.workers  = workers
+        self.pending  = []      # Staging objects
+        self.running  = {}      # backup_hosts: number of downloads
+        self.reserved = {}      # tmpdir: bytes being downloaded
+        self.results  = []      # [(section, filename, status, secs)]
+        self.cond     = threading.Condition()
+
+    def add(self, staging):
+        """ prefetch the latest dump of this section """
+        self.pending.append(staging)
+
+    def host(self, s):
+        """ sections share their download limit when they have the same
+        backup_host mirrors, which one we use can change while fetching """
+        return " ".join(s.backup_hosts)
+
+    def next(self):
+        """ return a section we can fetch now, or None, called with
+        self.cond held """
+        for s in self.pending:
+            host = self.host(s)
+            if self.running.get(host, 0) < self.limits[host]:
+                self.pending.remove(s)
+                return s
+
+        return None
+
+    def run(self):
+        """ fetch them all, return the results """
+        # sections sharing a backup_host don't have to agree on the limit
+        self.limits = {}
+        for s in self.pending:
+            limit = self.limits.get(self.host(s), s.host_fetch_jobs)
+            self.limits[self.host(s)] = min(limit, s.host_fetch_jobs)
+
+        threads = []
+        for i in range(min(self.workers, len(self.pending))):
+            t = threading.Thread(target = self.worker)
+            t.start()
+            threads.append(t)
+
+        for t in threads:
+            t.join()
+
+        return self.results
+
+    def worker(self):
+        """ thread body: fetch sections until there's none left """
+        while True:
+            self.cond.acquire()
+            try:
+                s = None
+                while self.pending:
+                    s = self.next()
+                    if s:
+                        break
+
+                    # wait for a download from a busy host to finish
+                    self.cond.wait()
+
+                if s is None:
+                    return
+
+                self.running[self.host(s)] = \
+                    self.running.get(self.host(s), 0) + 1
+            finally:
+                self.cond.release()
+
+            try:
+                self.prefetch(s)
+            finally:
+                self.cond.acquire()
+                self.running[self.host(s)] -= 1
+                self.cond.notifyAll()
+                self.cond.release()
+
+    def reserve(self, tmpdir, size):
+        """ reserve size bytes in tmpdir, return False when there's not
+        enough room for them """
+        self.cond.acquire()
+        try:
+            left = free_space(tmpdir) - self.reserved.get(tmpdir, 0)
+            if size > left:
+                return False
+
+            self.reserved[tmpdir] = self.reserved.get(tmpdir, 0) + size
+            return True
+        finally:
+            self.cond.release()
+
+    def release(self, tmpdir, size):
+        """ the download is over, written bytes are in statvfs now """
+        self.cond.acquire()
+        self.reserved[tmpdir] -= size
+        self.cond.release()
+
+    def prefetch(self, s):
+        """ fetch the latest dump of section s, record the result """
+        from options import DEBUG
+
+        start    = time.time()
+        filename = None
+
+        try:
+            if s.get_latest_backup() is None:
+                status = "no backup found"
+                return
+
+            s.set_backup_date(None, 'latest')
+            filename = os.path.basename(s.backup_filename)
+
+            # only reserve what the dump cache and a partial download don't
+            # hold already
+            size = s.get_dump_room()
+
+            if not self.reserve(s.tmpdir, size):
+                status = "skipped: no room for %s in %s" \
+                         % (s.pp_file_size(size), s.tmpdir)
+            else:
+                try:
+                    dump = s.get_dump(prefetch = True)
+                finally:
+                    self.release(s.tmpdir, size)
+
+                if s.wget_progress is None:
+                    status = "cached"
+                else:
+                    status = "fetched %s" \
+                             % s.pp_file_size(os.path.getsize(dump))
+
+        except Exception, e:
+            if DEBUG:
+                raise
+            status = "error: %s" % e
+
+        finally:
+            self.cond.acquire()
+            self.results.append((s.section, filename, status,
+                                 time.time() - start))
+            self.cond.release()
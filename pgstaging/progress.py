@@ -0,0 +1,168 @@
+##
+## Fetch progress telemetry
+##
+## Downloads report the bytes they get here, from as many threads as they
+## have segments. We keep track of the time to first byte and of the
+## average and instantaneous rates, show them live on stderr, and give a
+## summary once done.
+##
+
+import sys, time, threading
+
+MB = 1024. * 1024
+
+class progress:
+    """ Progress of a single fetch """
+
+    def __init__(self, name, size = None):
+        """ size is the expected number of bytes, when known """
+        self.name      = name
+        self.size      = size
+
+        self.resumed   = 0      # bytes we already had when starting
+        self.bytes     = 0      # bytes received
+        self.start     = None
+        self.ttfb      = None   # time to first byte, in seconds
+        self.end       = None
+
+        # last live display, to compute the instantaneous rate
+        self.shown_at    = None
+        self.shown_bytes = 0
+        self.rate        = None
+
+        self.lock      = threading.Lock()
+
+    def begin(self, resumed = 0):
+        """ the fetch starts now, we already have resumed bytes """
+        self.resumed     = resumed
+        self.bytes       = 0
+        self.ttfb        = None
+        self.start       = time.time()
+        self.shown_at    = self.start
+        self.shown_bytes = 0
+
+    def update(self, n):
+        """ we just received n more bytes """
+        from options import TERSE
+
+        self.lock.acquire()
+        try:
+            now = time.time()
+            if self.start is None:
+                self.begin()
+
+            if self.ttfb is None:
+                self.ttfb = now - self.start
+
+            self.bytes += n
+
+            # refresh the display every second on a terminal, and every
+            # 10s when logging into a file
+            interval = 10
+            if sys.stderr.isatty():
+                interval = 1
+
+            if now - self.shown_at >= interval:
+                self.rate        = (self.bytes - self.shown_bytes) \
+                                   / (now - self.shown_at)
+                self.shown_at    = now
+                self.shown_bytes = self.bytes
+
+                if not TERSE:
+                    self.show(now)
+        finally:
+            self.lock.release()
+
+    def done(self):
+        """ the fetch is over """
+        from options import TERSE
+
+        self.end = time.time()
+
+        if self.start is None:
+            self.start = self.end
+
+        if not TERSE and self.shown_bytes and sys.stderr.isatty():
+            # leave the last progress line on screen
+            sys.stderr.write("\n")
+
+    def average(self, now = None):
+        """ average rate since the start, in bytes per second """
+        if now is None:
+            now = self.end or time.time()
+
+        if self.start is None or now <= self.start:
+            return None
+
+        return self.bytes / (now - self.start)
+
+    def eta(self, now):
+        """ seconds until the fetch is done, or None """
+        avg = self.average(now)
+        if not self.size or not avg:
+            return None
+
+        left = self.size - self.resumed - self.bytes
+        return max(0, left / avg)
+
+    def show(self, now):
+        """ print current progress on stderr """
+        got = self.resumed + self.bytes
+
+        line = "%s: %.1fMB" % (self.name, got / MB)
+        if self.size:
+            line += "/%.1fMB (%d%%)" % (self.size / MB, 100 * got / self.size)
+
+        line += ", %.1f MB/s, avg %.1f MB/s" \
+                % (self.rate / MB, self.average(now) / MB)
+
+        eta = self.eta(now)
+        if eta is not None:
+            line += ", ETA %dm%02ds" % (eta / 60, eta % 60)
+
+        if sys.stderr.isatty():
+            sys.stderr.write("\r%s\033[K" % line)
+        else:
+            sys.stderr.write("%s\n" % line)
+
+        sys.stderr.flush()
+
+    def summary(self):
+        """ return the fetch figures as a dict """
+        return {'url':     self.name,
+                'size':    self.size,
+                'bytes':   self.bytes,
+                'resumed': self.resumed,
+                'secs':    (self.end or time.time()) - (self.start or 0),
+                'ttfb':    self.ttfb,
+                'avg':     self.average()}
+
+    def record(self):
+        """ return a machine readable summary line """
+        s = self.summary()
+
+        fields = [('url', s['url']),
+                  ('bytes', s['bytes']),
+                  ('resumed', s['resumed']),
+                  ('secs', "%.3f" % s['secs'])]
+
+        if s['ttfb'] is not None:
+            fields.append(('ttfb', "%.3f" % s['ttfb']))
+
+        if s['avg'] is not None:
+            fields.append(('avg_mbps', "%.2f" % (s['avg'] / MB)))
+
+        return " ".join(["%s=%s" % (k, v) for k, v in fields])
+
+class progressstream:
+    """ A file-like object reporting what's read from source """
+
+    def __init__(self, source, progress):
+        self.source   = source
+        self.progress = progress
+
+    def read(self, size):
+        data = self.source.read(size)
+        if data:
+            self.progress.update(len(data))
+        return data
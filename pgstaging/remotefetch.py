@@ -0,0 +1,195 @@
+##
+## Have the target host fetch the dump itself
+##
+## Rather than downloading the dump into our tmpdir and then sending it to
+## the target PostgreSQL, we have staging-client.sh fetch it on the target
+## host, into the same tmpdir path there, and pg_restore runs there too. We
+## only coordinate: the client script reports its progress and the checksum
+## of what it fetched, that we check against the dump size and its sidecar
+## checksum file on the backup host, if any.
+##
+
+import time, tempfile
+
+import fetch, localfetch, progress, compress, utils
+from utils import CouldNotGetDumpException, CorruptDumpException
+from utils import FetchCancelledException
+
+class remotefetch:
+    """ Fetch a dump on the target host, with the same interface as
+    fetch.httpfetch """
+
+    def __init__(self, target, use_sudo, host, url, filename):
+        """ target is the host to fetch on, host the backup host to fetch
+        from and filename the local file on the target """
+        self.target        = target
+        self.use_sudo      = use_sudo
+        self.host          = host
+        self.url           = url
+        self.filename      = filename
+
+        # what the target fetches
+        self.source        = url
+        if not localfetch.is_local(url):
+            self.source = "http://%s%s" % (host, url)
+
+        # filled in by self.head()
+        self.headed        = False
+        self.size          = None
+        self.etag          = None
+        self.last_modified = None
+
+        # threading.Event set when we should stop fetching
+        self.cancel        = None
+
+        # filled in by self.fetch()
+        self.digest        = None
+        self.transferred   = 0
+        self.rate          = None
+        self.progress      = progress.progress("%s:%s" % (target, self.source))
+
+        # the client script decompresses after checking the checksum
+        self.compression   = compress.kind_of(url)
+        self.decompressed  = None
+
+        # what the client script told us
+        self.fetched       = 0
+        self.remote_size   = None
+        self.remote_digest = None
+
+    def head(self):
+        """ HEAD the url from here, for its size and validators. Backups
+        given as file:// URLs may only be mounted on the target """
+        if not localfetch.is_local(self.url):
+            f = fetch.httpfetch(self.host, self.url, self.filename)
+            f.head()
+
+            self.size          = f.size
+            self.etag          = f.etag
+            self.last_modified = f.last_modified
+
+        self.headed = True
+
+    def fetch(self):
+        """ have the target fetch the file, return its filename there """
+        from options import VERBOSE
+
+        if not self.headed:
+            self.head()
+
+        checksum = None
+        if not localfetch.is_local(self.url):
+            checksum = fetch.get_checksum(self.host, self.url)
+
+        algo = 'sha256'
+        if checksum:
+            algo = checksum[0]
+
+        start_time = time.time()
+        self.progress.size = self.size
+        self.progress.begin()
+
+        # the client script errors go to a temp file, so that they can't
+        # fill a pipe and block it while we read its progress
+        errors = tempfile.TemporaryFile()
+        proc   = utils.popen_client_script(self.target,
+                                           ["fetch", self.source,
+                                            self.filename, algo],
+                                           self.use_sudo,
+                                           stderr = errors)
+        try:
+            line = proc.stdout.readline()
+            while line:
+                self.parse(line)
+
+                if self.cancel is not None and self.cancel.isSet():
+                    proc.kill()
+                    mesg = "Fetching '%s' on %s cancelled" \
+                           % (self.source, self.target)
+                    raise FetchCancelledException, mesg
+
+                line = proc.stdout.readline()
+        finally:
+            proc.wait()
+            self.progress.done()
+
+        if proc.returncode != 0:
+            errors.seek(0)
+            mesg  = "Could not fetch dump '%s' on %s: error [%d]" \
+                    % (self.source, self.target, proc.returncode)
+            mesg += "\nDetail: %s" % errors.read()
+            errors.close()
+            raise CouldNotGetDumpException, mesg
+
+        errors.close()
+
+        try:
+            self.check(checksum, algo)
+        except CorruptDumpException:
+            # don't restore nor resume from corrupted data
+            self.discard()
+            raise
+
+        if VERBOSE:
+            print "%s: %s" % (self.source, self.digest)
+
+        elapsed = time.time() - start_time
+        if elapsed > 0:
+            self.rate = self.transferred / elapsed
+
+        return self.filename
+
+    def parse(self, line):
+        """ parse a line of the client script fetch output """
+        from options import VERBOSE
+
+        try:
+            key, value = line.split()
+
+            if key == 'resume':
+                self.fetched = int(value)
+                self.progress.begin(self.fetched)
+
+            elif key in ('progress', 'size'):
+                value = int(value)
+                if value > self.fetched:
+                    self.progress.update(value - self.fetched)
+                    self.transferred += value - self.fetched
+                    self.fetched = value
+
+                if key == 'size':
+                    self.remote_size = value
+
+            else:
+                self.remote_digest = (key, value.lower())
+
+        except ValueError:
+            if VERBOSE:
+                print "%s: %s" % (self.target, line.rstrip())
+
+    def check(self, checksum, algo):
+        """ raise CorruptDumpException when the target didn't get the dump
+        we expected, set self.digest """
+        if self.size is not None and self.remote_size != self.size:
+            mesg = "Dump '%s' is truncated on %s: got %s bytes out of %d" \
+                   % (self.source, self.target, self.remote_size, self.size)
+            raise CorruptDumpException, mesg
+
+        if self.remote_digest is None or self.remote_digest[0] != algo:
+            mesg = "Dump '%s': %s did not report its %s checksum" \
+                   % (self.source, self.target, algo)
+            raise CorruptDumpException, mesg
+
+        hexdigest = self.remote_digest[1]
+        if checksum and checksum[1] != hexdigest:
+            mesg = "Dump '%s' %s checksum mismatch on %s: got %s, " \
+                   "expected %s" % (self.source, algo, self.target,
+                                    hexdigest, checksum[1])
+            raise CorruptDumpException, mesg
+
+        self.digest = "%s:%s" % (algo, hexdigest)
+
+    def discard(self):
+        """ remove the dump and its partial download from the target """
+        utils.run_client_script(self.target, ["rmdump", self.filename],
+                                self.use_sudo)
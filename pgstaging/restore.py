@@ -2,16 +2,18 @@
 ## pg_restore support class
 ##
 
-import os, re, psycopg2
+import os, psycopg2
 from psycopg2.extensions import ISOLATION_LEVEL_AUTOCOMMIT
 
-import utils
+import utils, dumptoc
 from utils import NotYetImplementedException
 from utils import CouldNotConnectPostgreSQLException
 from utils import CreatedbFailedException
 from utils import PGRestoreFailedException
 from utils import ExportFileAlreadyExistsException
 from utils import UnknownCommandException
+from utils import SubprocessException
+from utils import UnsupportedDumpFormatException
 
 class pgrestore:
     """ Will launch correct pgrestore binary to restore a dump file to some
@@ -40,6 +42,16 @@ class pgrestore:
         self.restore_jobs    = 1
         self.mconn           = None
 
+        # run pg_restore on the target host, through the client script,
+        # for dumps fetched there, and connect it straight to PostgreSQL
+        # on the local socket when given remote_port
+        self.remote          = False
+        self.remote_port     = None
+        self.use_sudo        = True
+
+        # toccache.toccache object for the dumps we read the TOC of here
+        self.toc_cache       = None
+
         # check that the pg_restore binary do exists
         if not os.path.isfile(self.restore_cmd):
             mesg = "Error: pg_restore command: no such file '%s'" \
@@ -190,9 +202,12 @@ class pgrestore:
         except Exception, e:
             raise
 
-    def pg_restore(self, filename, excluding_tables = []):
-        """ restore dump file to new database """
-        from options import VERBOSE, TERSE
+    def pg_restore_cmd(self, filename = None, excluding_tables = [],
+                       catalog = None):
+        """ prepare the pg_restore command line, reading stdin when no
+        filename is given, and computing the catalog if needed and not
+        given """
+        from options import VERBOSE
 
         if VERBOSE:
             os.system("ls -l %s" % self.restore_cmd)
@@ -206,33 +221,43 @@ class pgrestore:
                 print "Notice: pg_restore will work in a single transaction"
             st = "-1"
 
+        # connect through pgbouncer, or to the target local socket
+        connect = ["-h", self.host, "-p", str(self.port)]
+        if self.remote and self.remote_port:
+            connect = ["-p", str(self.remote_port)]
+
         # prepare cmd in several steps
-        cmd = [self.restore_cmd,
-               st,
-               "-h", self.host,
-               "-p", str(self.port),
-               "-U", self.user,
-               "-d", self.dbname
-               ]
+        cmd = [self.restore_cmd, st] + connect + ["-U", self.user,
+                                                  "-d", self.dbname]
 
         # pg_restore -j
         if self.restore_jobs > 1:
             cmd += ["-j", "%d" % self.restore_jobs]
 
         # Exclude some schemas at restore time?
-        catalog = ""
-        if self.schemas or self.schemas_nodata:
+        if catalog is None and (self.schemas or self.schemas_nodata):
             catalog = "%s" % self.get_catalog(filename,
                                                  excluding_tables,
                                                  out_to_file = True)
 
+        if catalog:
             cmd += ["-L", catalog]
 
+            # skip scp when target is localhost
+            if self.remote and self.host not in ("localhost", "127.0.0.1"):
+                utils.scp(self.host, catalog, '/tmp')
+
         cmd += [filename]
 
         # now filter out empty array elements in order to prepare a command
         # without extra spacing
-        cmd = [x for x in cmd if x is not None and x != '']
+        return [x for x in cmd if x is not None and x != '']
+
+    def pg_restore(self, filename, excluding_tables = [], catalog = None):
+        """ restore dump file to new database """
+        from options import TERSE
+
+        cmd = self.pg_restore_cmd(filename, excluding_tables, catalog)
 
         if not TERSE:
             print " ".join(cmd)
@@ -246,202 +271,213 @@ class pgrestore:
 
         # utils.run_command will raise a SubprocessException if pg_restore
         # returns an error code (non zero)
-        out = utils.run_command(cmd, returning = utils.RET_OUT)
+        if self.remote:
+            out = self.run_remote(cmd)
+        else:
+            out = self.run(cmd)
 
         end_time = time.time()
 
         # time elapsed, in secs
         return end_time - start_time
 
-    def get_catalog(self, filename, tables, out_to_file = False):
-        """ return the backup catalog, pg_restore -l, commenting table data """
-        from options import VERBOSE
+    def run(self, cmd):
+        """ run the pg_restore command here and return its output, see
+        self.run_remote() for the target host """
+        return utils.run_command(cmd, returning = utils.RET_OUT)
+
+    def run_lines(self, cmd):
+        """ run the pg_restore command, on the target host when the dump
+        is there, yielding its output lines as they come """
+        if self.remote:
+            cmd = utils.client_script_command(self.host, ["pg_restore"] + cmd,
+                                              self.use_sudo)
+
+        return utils.run_command_lines(cmd)
+
+    def run_remote(self, cmd):
+        """ run the pg_restore command on the target host, relaying its
+        output as it comes, and return it """
+        import subprocess
+        from options import TERSE
+
+        proc = utils.popen_client_script(self.host, ["pg_restore"] + cmd,
+                                         self.use_sudo,
+                                         stderr = subprocess.STDOUT)
+        out  = []
+        try:
+            line = proc.stdout.readline()
+            while line:
+                out.append(line)
+                if not TERSE:
+                    print "%s: %s" % (self.host, line.rstrip())
+                line = proc.stdout.readline()
+        finally:
+            proc.wait()
+
+        out = "".join(out)
+
+        if proc.returncode != 0:
+            mesg  = 'Error [%d]: %s on %s' % (proc.returncode,
+                                              " ".join(cmd), self.host)
+            mesg += '\nDetail: %s' % out
+            raise SubprocessException, mesg
+
+        return out
+
+    def pg_restore_stream(self, source, tee = None):
+        """ restore to new database the dump read from source, a file-like
+        object, while it's being downloaded. When given a tee filename, also
+        write a local copy of the dump there, only once both the dump and
+        pg_restore are known to be fine """
+        import errno, subprocess, tempfile, time, dumpfile
+        from options import TERSE, DEBUG, BUFSIZE
+
+        # the catalog needs the whole dump file, so we only stream full
+        # restores and pg_restore reads its stdin
+        cmd = self.pg_restore_cmd()
 
-        cmd = [self.restore_cmd, "-l", filename]
-        out = utils.run_command(cmd, returning = utils.RET_OUT)
-
-        from cStringIO import StringIO
-        catalog = StringIO()
-
-        # out is a simple string, so we split on \n or read one char at a
-        # time in the loop, which isn't what we want
-        #
-        # here's what the DATA lines we're after look like:
-        #
-        #3; 2615 122814 SCHEMA - pgq postgres
-        #6893; 0 0 ACL - pgq postgres
-        #3385; 1259 123008 TABLE londiste subscriber_table payment
-        #1206; 1247 123043 TYPE londiste ret_subscriber_table postgres
-        #1118; 1247 122925 TYPE pgq ret_batch_event postgres
-        #142; 1255 122813 FUNCTION public txid_visible_in_snapshot(bigint, txid_snapshot) postgres
-        #70; 1255 1487229 FUNCTION public upper(ip4r) postgres
-        #2526; 2617 1487283 OPERATOR public # postgres
-        #2524; 2617 1487281 OPERATOR public & postgres
-        #2647; 2616 1487309 OPERATOR CLASS public btree_ip4_ops postgres
-        #3961; 2605 1487223 CAST pg_catalog CAST (cidr AS public.ip4r)
-        #6662; 0 788811 TABLE DATA payment abocb_code payment
-        #6663; 0 788819 TABLE DATA payment abocb_renew payment
-        #6664; 0 788825 TABLE DATA payment acte_code payment
-        #3380; 1259 122980 SEQUENCE londiste provider_seq_nr_seq payment
-        #6904; 0 0 SEQUENCE OWNED BY londiste provider_seq_nr_seq payment
-        #6905; 0 0 SEQUENCE SET londiste provider_seq_nr_seq payment
-        #4301; 2604 122984 DEFAULT londiste nr payment
-        #4656; 1259 56340 INDEX archives ap_rev_2004 webadmin
-        #6236; 2620 15995620 TRIGGER jdb www_to_reporting_logger webadmin
-        #6014; 2606 56535 FK CONSTRAINT archives rev_2001_id_compte_fkey webadmin
-
-        # tables are schema.table, we want (schema, table)
-        splitted_tables = []
-        if tables:
-            splitted_tables = [(x.split('.')[0], x.split('.')[1]) for x in tables]
-
-        # for meta data (md_) commands, filter_out what's neither in schemas
-        # nor in schemas_nodata
-        schemas = self.schemas
-        if schemas is None:
-            schemas = []
-
-        md_schemas = schemas
-        if self.schemas_nodata:
-            md_schemas += self.schemas_nodata
-
-        # schemas here are used to filter what to restore (values not in
-        # self.schemas are filtered out)
-        if md_schemas:
-            md_schemas.append('pg_catalog')
+        if not TERSE:
+            print "%s < http" % " ".join(cmd)
 
-        # which triggers calls which function (schema qualified) cache
-        triggers = self.get_trigger_funcs(filename)
+        # try to connect with a safe timeout, raise an exception when failing
+        self.try_connection()
 
-        for line in out.split('\n'):
-            if line.strip() == "":
-                continue
+        # mesure overlapped fetch and pg_restore timing
+        start_time = time.time()
 
-            filter_out = False
-
-            if line.find('SCHEMA') > -1            \
-                   or line.find('ACL') > -1        \
-                   or line.find('TABLE') > -1      \
-                   or line.find('TYPE') > -1       \
-                   or line.find('FUNCTION') > -1   \
-                   or line.find('OPERATOR') > -1   \
-                   or line.find('CAST') > -1       \
-                   or line.find('TABLE DATA') > -1 \
-                   or line.find('SEQUENCE') > -1   \
-                   or line.find('VIEW') > -1       \
-                   or line.find('COMMENT') > -1    \
-                   or line.find('DEFAULT') > -1    \
-                   or line.find('INDEX') > -1      \
-                   or line.find('TRIGGER') > -1    \
-                   or line.find('DOMAIN') > -1    \
-                   or line.find('CONSTRAINT') > -1:
+        # pg_restore output goes to a temp file so that it can't fill a pipe
+        # and block us while we feed its stdin
+        output = tempfile.TemporaryFile()
+        proc   = subprocess.Popen(cmd,
+                                  stdin  = subprocess.PIPE,
+                                  stdout = output,
+                                  stderr = output)
+
+        # the local copy gets its name once complete and restored
+        tee_fd  = None
+        partial = None
+        if tee:
+            partial = "%s.partial" % tee
+            tee_fd  = dumpfile.dumpfile(partial, truncate = True)
+
+        done = False
+        try:
+            try:
+                while not done:
+                    # errors reading the dump, including a corrupted one,
+                    # are raised from here
+                    data = source.read(BUFSIZE)
+                    if not data:
+                        done = True
+                        break
+
+                    try:
+                        proc.stdin.write(data)
+                    except IOError, e:
+                        # broken pipe: pg_restore is gone, see its return
+                        # code
+                        if e.errno != errno.EPIPE:
+                            raise
+                        if DEBUG:
+                            print e
+                        break
+
+                    if tee_fd:
+                        tee_fd.write(data)
+
+            finally:
+                if tee_fd:
+                    tee_fd.close()
 
                 try:
-                    a, b, c, d = line.split()[3:7]
-
-                    if a in ('ACL', 'SCHEMA'):
-                        if b == '-':
-                            schema = c
-                        else:
-                            schema = b
-
-                    elif a == 'COMMENT':
-                        if b == '-' and c == 'SCHEMA':
-                            schema = d
-
-                    elif b == 'CLASS':
-                        schema = c
-
-                    elif b == 'DATA':
-                        schema = c
-                        table  = d
-
-                    elif a == 'SEQUENCE':
-                        if b == 'OWNED' and c == 'BY':
-                            schema = d
-                        elif b == 'SET':
-                            schema = c
-                        else:
-                            schema = b
-
-                    elif a == 'FK' and b == 'CONSTRAINT':
-                        schema = c
-
-                    else:
-                        schema = b
-
-                    # filter out ACL lines for schemas we want to exclude
-                    if a == 'ACL' and b == '-' and c not in schemas:
-                        filter_out = True
-
-                    # check schemas (contains data we want to restore)
-                    if not filter_out and schema not in md_schemas:
-                        filter_out = True
-
-                    # check TRIGGER function dependancy
-                    if not filter_out and a == 'TRIGGER':
-                        # triggers[schema][trigger_name] = [f1, f2, f3]
-                        if b in triggers and c in triggers[b]:
-                            for f in triggers[b][c]:
-                                s = f.split('.')[0]
-
-                                if s not in schemas:
-                                    filter_out = True
-                                    break
-
-                    # filter out TABLE DATA section for schemas_nodata
-                    if not filter_out and self.schemas_nodata is not None \
-                           and a == 'TABLE' and b == 'DATA' \
-                           and schema in self.schemas_nodata:
-                        filter_out = True
-
-                    # then additional tables given by caller
-                    if not filter_out and a == 'TABLE' and b == 'DATA':
-                        for s, t in splitted_tables:
-                            if not filter_out and schema == s and table == t:
-                                filter_out = True
-
-                    # then tables filtered out by regexp in the config
-                    if not filter_out and a == 'TABLE' and b == 'DATA':
-                        qualified_relname = "%s.%s" % (schema, table)
-                        for regexp in self.relname_nodata:
-                            if re.search(regexp, qualified_relname):
-                                filter_out = True
-                                break
-
-                except ValueError, e:
-                    # unpack error, line won't match anything, don't filter
-                    # out
+                    proc.stdin.close()
+                except IOError:
                     pass
 
-            # filter_out means we turn it into a comment
-            if filter_out:
-                catalog.write(';%s\n' % line)
-            else:
-                catalog.write('%s\n' % line)
+                proc.wait()
 
-        # chop last \n
-        if 'SEEK_CUR' in os.__dict__:
-            whence = os.SEEK_CUR
-        else:
-            # http://www.python.org/doc/2.4.4/lib/bltin-file-objects.html
-            whence = 1
+            end_time = time.time()
 
-        catalog.seek(-1, whence)
-        catalog.truncate()
+            if proc.returncode != 0:
+                output.seek(0)
+                mesg  = 'Error [%d]: %s' % (proc.returncode, " ".join(cmd))
+                mesg += '\nDetail: %s' % output.read()
+                raise SubprocessException, mesg
 
-        if not out_to_file:
-            return catalog
+            if partial and done:
+                os.rename(partial, tee)
 
-        import tempfile
-        fd, realname = tempfile.mkstemp(prefix = '/tmp/staging.',
-                                        suffix = '.catalog')
+        finally:
+            output.close()
 
-        temp = os.fdopen(fd, "wb")
-        temp.write(catalog.getvalue())
-        temp.close()
+            if partial and os.path.exists(partial):
+                os.unlink(partial)
+
+        # time elapsed, in secs
+        return end_time - start_time
+
+    def read_toc(self, filename):
+        """ return a dumptoc object to read the TOC of the dump ourselves, or
+        None when pg_restore has to """
+        from options import VERBOSE
 
-        return realname
+        if self.remote:
+            return None
+
+        try:
+            return dumptoc.dumptoc(filename)
+        except UnsupportedDumpFormatException, e:
+            if VERBOSE:
+                print "%s, using pg_restore" % e
+            return None
+
+    def get_catalog(self, filename, tables, out_to_file = False):
+        """ return the backup catalog, pg_restore -l, commenting out what we
+        don't restore: either a StringIO or the name of a temp file """
+        import time, tempfile
+        from options import VERBOSE
+        from catalogfilter import catalogfilter
+
+        # which triggers calls which function (schema qualified) cache
+        triggers = self.get_trigger_funcs(filename)
+
+        f = catalogfilter(self.schemas, self.schemas_nodata, tables,
+                          self.relname_nodata, triggers)
+
+        start = time.time()
+        lines = None
+        if self.toc_cache:
+            lines = self.toc_cache.toc(filename)
+
+        if lines is None:
+            toc = self.read_toc(filename)
+            if toc:
+                lines = toc.listing()
+            else:
+                lines = self.run_lines([self.restore_cmd, "-l", filename])
+
+            if self.toc_cache:
+                lines = self.toc_cache.add_toc(filename, lines)
+
+        if not out_to_file:
+            from cStringIO import StringIO
+            catalog = StringIO()
+            f.filter(lines, catalog)
+        else:
+            fd, catalog = tempfile.mkstemp(prefix = '/tmp/staging.',
+                                           suffix = '.catalog')
+            temp = os.fdopen(fd, "wb")
+            try:
+                f.filter(lines, temp)
+            finally:
+                temp.close()
+
+        if VERBOSE:
+            print "catalog: %d lines, %d filtered out in %.3fs" \
+                  % (f.lines, f.filtered, time.time() - start)
+
+        return catalog
 
     ##
     # In the catalog, we have such TRIGGER lines:
@@ -461,11 +497,33 @@ class pgrestore:
     #  {'trigger_name': ['procedure']}
 
     def get_trigger_funcs(self, filename):
-        """ return the backup catalog, pg_restore -l, commenting table data """
-        from options import VERBOSE
+        """ return the trigger functions of the dump, from its TOC or from
+        the pg_restore -s output """
+        import time
+
+        if self.toc_cache:
+            triggers = self.toc_cache.triggers(filename)
+            if triggers is not None:
+                return triggers
+
+        start_time = time.time()
+
+        toc = self.read_toc(filename)
+        if toc:
+            triggers = toc.triggers()
+        else:
+            triggers = self.parse_trigger_funcs(filename)
+
+        if self.toc_cache:
+            self.toc_cache.add_triggers(filename, triggers,
+                                        time.time() - start_time)
+
+        return triggers
 
+    def parse_trigger_funcs(self, filename):
+        """ parse the pg_restore -s output as it comes rather than holding
+        the schema in memory """
         cmd = [self.restore_cmd, "-s", filename]
-        out = utils.run_command(cmd, returning = utils.RET_OUT)
 
         # expressions we're searching
         set_search_path     = 'SET search_path = '
@@ -482,8 +540,9 @@ class pgrestore:
         current_schema  = 'public'
         current_trigger = None
 
-        for line in out.split('\n'):
+        for line in self.run_lines(cmd):
             if line.find(set_search_path) > -1:
+                line = line.rstrip('\n')
                 current_schema = line[set_search_path_l:-1].split(', ')[0]
 
                 if current_schema not in triggers:
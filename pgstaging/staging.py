@@ -2,15 +2,19 @@
 ## Staging Class to organise processing
 ##
 
-import os, httplib, time, psycopg2
+import os, time, psycopg2
 
-import pgbouncer, restore, londiste, utils
+import pgbouncer, restore, londiste, fetch, dumpcache, pipeline, listing
+import throttle, httppool, localfetch, progress, compress, mirrors
+import dumpfile, remotefetch, toccache
+import utils
 from utils import NotYetImplementedException
 from utils import CouldNotGetDumpException
 from utils import PGRestoreFailedException
 from utils import SubprocessException
 from utils import ExportFileAlreadyExistsException
 from utils import ParseDumpFileException
+from utils import UnknownBackupDateException
 
 class Staging:
     """ Staging Object relates to a database name, where to find the backups
@@ -46,7 +50,8 @@ class Staging:
 
         self.section         = section
         self.dbname          = dbname
-        self.backup_host     = backup_host
+        self.backup_hosts    = mirrors.split(backup_host)
+        self.backup_host     = self.backup_hosts[0]
         self.backup_base_url = backup_base_url
         self.dumpall_url     = dumpall_url
         self.host            = host
@@ -66,6 +71,31 @@ class Staging:
         self.pg_restore_st   = pg_restore_st == "True"
         self.restore_vacuum  = restore_vacuum == "True"
         self.restore_jobs    = int(restore_jobs)
+        self.restore_stream  = False
+        self.fetch_jobs      = 1
+        self.cache_size      = None
+        self.toc_cache       = True
+        self.tocs            = None
+        self.restore_pipeline = None
+        self.fetch_cancel    = None
+        self.pinned          = []      # [(dumpcache, key)] we're using
+        self.listing_ttl     = None
+        self.listing_url     = None
+        self.host_rate_limit = None
+        self.fetch_rate_limit = None
+        self.wget_rate       = None
+        self.wget_progress   = None
+        self.wget_compression = None
+        self.wget_resident   = None
+        self.fetch_drop_cache = True
+        self.fetch_direct_io = False
+        self.fetch_buffer_size = None
+        self.remote_fetch    = False
+        self.remote_restore  = False
+        self.dump_file       = None
+        self.host_fetch_jobs = 2
+        self.mirror_min_rate = None
+        self.watch_interval  = 60
         self.replication     = None
         self.tmpdir          = tmpdir
         self.sql_path        = None
@@ -161,29 +191,30 @@ The default expression is used when date is None and can be one of 'today',
         """ return time elapsed since staging object creation """
         return time.time() - self.creation_time
 
-    def list_backups(self):
-        """ return a list of available backup files for self.dbname """
-        from apache_listing import ApacheListingParser
+    def get_backup_listing(self):
+        """ return the (shared) listing of self.backup_base_url """
+        from options import LISTING_TTL
 
-        conn = httplib.HTTPConnection(self.backup_host)
-        conn.request("GET", self.backup_base_url)
-        r = conn.getresponse()
+        ttl = self.listing_ttl
+        if ttl is None:
+            ttl = LISTING_TTL
 
-        if r.status != 200:
-            raise CouldNotGetDumpException, r.reason
+        url   = self.listing_url or self.backup_base_url
+        hosts = self.rank_mirrors()
 
-        # fill up a buffer with the response
-        import cStringIO
-        buf = cStringIO.StringIO()
+        for host in hosts:
+            try:
+                return listing.get_listing(host, url, ttl)
 
-        # now parse the apache listing
-        for chunk in r.read():
-            buf.write(chunk)
+            except mirrors.ERRORS, e:
+                if host == hosts[-1]:
+                    raise
 
-        # don't forget to re-position
-        buf.seek(0)
-        alp = ApacheListingParser(buf, self.dbname)
-        return alp.parse()
+                self.mirror_failed(host, e, hosts[hosts.index(host) + 1])
+
+    def list_backups(self):
+        """ return a list of available backup files for self.dbname """
+        return self.get_backup_listing().backups(self.dbname)
 
     def pp_file_size(self, size):
         """ Given 30947087864, print 30GB """
@@ -211,6 +242,16 @@ The default expression is used when date is None and can be one of 'today',
                 size = self.pp_file_size(os.stat(fullname)[stat.ST_SIZE])
                 yield size, name
 
+    def list_cached_backups(self):
+        """ return the dump cache content and statistics """
+        dumps = self.get_dump_cache()
+        if dumps is None:
+            return [], {}
+
+        content, stats = dumps.list()
+        return [(self.pp_file_size(size), os.path.basename(name))
+                for atime, size, name, key in content], stats
+
     def parse_backup_file_date(self, filename):
         """ extract date from foo_db.2011-03-11.dump """
         return self.parse_date(filename.split(".")[1])
@@ -221,79 +262,218 @@ The default expression is used when date is None and can be one of 'today',
 
     def get_latest_backup(self):
         """ return the latest backup date available """
-        b = None
-        d = None
-        for size, backup in self.list_backups():
-            c = self.parse_backup_file_date(backup)
-            if d is None:
-                d = c
-                b = size, backup
-            else:
-                if d < c:
-                    d = c
-                    b = size, backup
-        return b
+        return self.get_backup_listing().latest(self.dbname)
 
     def get_oldest_backup(self):
         """ return the oldest backup date available """
-        b = None
-        d = None
-        for size, backup in self.list_backups():
-            c = self.parse_backup_file_date(backup)
-            if d is None:
-                d = c
-                b = size, backup
-            else:
-                if d > c:
-                    d = c
-                    b = size, backup
-        return b
+        return self.get_backup_listing().oldest(self.dbname)
 
-    def wget(self, host, url, outfile):
-        """ fetch the given url at given host and return where we stored it """
-        from options import TERSE, BUFSIZE
+    def get_nearest_backup(self, date):
+        """ return the backup available nearest to given date """
+        return self.get_backup_listing().nearest(self.dbname,
+                                                 self.parse_date(date))
 
-        filename = "%s/%s" % (self.tmpdir, outfile)
+    def get_backup_file(self, filename):
+        """ return the name of the file to fetch for the dump filename,
+        that can be published compressed as filename.zst or filename.gz.
+        Local copies are cheaper than decompressing, so file:// sources
+        only use a compressed variant when the plain dump is missing """
+        names = set([name for size, name in self.get_backup_listing().files])
+
+        if localfetch.is_local(self.backup_base_url) and filename in names:
+            return filename
+
+        for ext in compress.available():
+            if filename + ext in names:
+                return filename + ext
+
+        return filename
+
+    def get_dump_cache(self, prefetch = False):
+        """ return the dump cache object, or None when not configured.
+        Without cache_size, the cache still knows about prefetched dumps """
+        if self.cache_size is None and not prefetch \
+               and not os.path.exists(os.path.join(self.tmpdir,
+                                                   dumpcache.INDEX)):
+            return None
+
+        return dumpcache.dumpcache(self.tmpdir, self.cache_size)
+
+    def get_toc_cache(self):
+        """ return the TOC cache object, or None when disabled """
+        if not self.toc_cache:
+            return None
+
+        if self.tocs is None:
+            self.tocs = toccache.toccache(self.tmpdir)
+
+        return self.tocs
+
+    def rank_mirrors(self, url = None):
+        """ return self.backup_hosts, best first, and use the best one from
+        now on. When given url, probe the mirrors we know too little about
+        with it """
+        from options import VERBOSE
+
+        if len(self.backup_hosts) == 1 \
+               or localfetch.is_local(self.backup_base_url):
+            return self.backup_hosts
+
+        hosts = self.get_mirrors().rank(self.backup_hosts, url)
+
+        if VERBOSE and hosts[0] != self.backup_host:
+            print "using mirror %s" % hosts[0]
+
+        self.backup_host = hosts[0]
+        return hosts
+
+    def mirror_failed(self, host, error, next_host):
+        """ remember host failed us, and that we use next_host instead """
+        from options import TERSE
+
+        self.get_mirrors().failed(host, error)
+        self.backup_host = next_host
 
         if not TERSE:
-            print "fetching '%s'\n    from http://%s%s" % (filename,
-                                                           host,
-                                                           url)
+            print "Notice: mirror %s failed: %s" % (host, error)
+            print "        failing over to %s" % next_host
+
+    def get_mirrors(self):
+        """ return the mirror statistics object """
+        return mirrors.mirrorstats(self.tmpdir)
+
+    def get_fetcher(self, host, url, filename):
+        """ return the object to fetch url into filename with """
+        if localfetch.is_local(url):
+            f = localfetch.filefetch(url, filename)
+        else:
+            f = fetch.httpfetch(host, url, filename, self.fetch_jobs,
+                                self.get_throttle(host))
+
+            # only give up on a slow mirror when there's another one
+            if len(self.backup_hosts) > 1:
+                f.min_rate = self.mirror_min_rate
+
+        f.drop_cache = self.fetch_drop_cache
+        f.direct     = self.fetch_direct_io
+        f.bufsize    = self.fetch_buffer_size
+        f.cancel     = self.fetch_cancel
+        return f
+
+    def wget(self, host, url, outfile, cache = False, size = None,
+             prefetch = False, hosts = None):
+        """ fetch the given url at given host and return where we stored it,
+        when cache is True first check for a local copy of it. size is the
+        expected size of the file, when known. When prefetch is True, the
+        file is registered in the cache for a later restore. hosts are the
+        mirrors to fail over to, in order, host first """
+        from options import TERSE, VERBOSE
+
+        filename = "%s/%s" % (self.tmpdir, outfile)
 
         import time
         start_time = time.time()
 
-        dump_fd = open(filename, "wb")
-        conn    = httplib.HTTPConnection(host)
-        conn.request("GET", url)
-        r = conn.getresponse()
+        if not hosts:
+            hosts = [host]
+
+        f = self.get_fetcher(host, url, filename)
+
+        # only used until we know better
+        f.progress.size = size
+        self.wget_progress = None
+        self.wget_compression = None
+        self.wget_resident = None
 
-        if r.status != 200:
-            mesg = "Could not get dump '%s': %s" % (url, r.reason)
-            raise CouldNotGetDumpException, mesg
+        dumps = None
+        if cache or prefetch:
+            dumps = self.get_dump_cache(prefetch)
 
-        done = False
-        while not done:
-            data = r.read(BUFSIZE)
-            if data:
-                dump_fd.write(data)
+        if dumps:
+            key = dumps.key(hosts, url)
+            f.head()
 
-            done = not data or len(data) < BUFSIZE
+            if dumps.get(key, host, f.size, f.etag, f.last_modified,
+                         pin = not prefetch):
+                if not prefetch:
+                    self.pinned.append((dumps, key))
+                self.wget_timing = time.time() - start_time
+                self.wget_rate   = None
+                return filename
 
-        dump_fd.close()
+        if not TERSE:
+            if localfetch.is_local(url):
+                print "fetching '%s'\n    from %s" % (filename, url)
+            else:
+                print "fetching '%s'\n    from http://%s%s" % (filename,
+                                                               host,
+                                                               url)
+
+        while True:
+            try:
+                f.fetch()
+                break
+
+            except mirrors.ERRORS, e:
+                if host == hosts[-1] or localfetch.is_local(url):
+                    raise
+
+                # resume from where the failed mirror left us
+                next_host = hosts[hosts.index(host) + 1]
+                self.mirror_failed(host, e, next_host)
+
+                host = next_host
+                f = self.get_fetcher(host, url, filename)
+                f.progress.size = size
+
+        if not TERSE and localfetch.is_local(url):
+            print "    using %s" % f.method
+
+        if len(hosts) > 1 and f.rate:
+            self.get_mirrors().record(host, f.rate)
+
+        if f.decompressed:
+            self.wget_compression = compress.stats(f.decompressed)
+
+        if dumps and (self.cache_size is not None or prefetch):
+            dumps.add(key, host, filename, f.size, f.etag, f.last_modified,
+                      f.digest, os.path.getsize(filename),
+                      pin = not prefetch)
+            if not prefetch:
+                self.pinned.append((dumps, key))
 
         end_time = time.time()
-        self.wget_timing = end_time - start_time
+        self.wget_timing   = end_time - start_time
+        self.wget_rate     = f.rate
+        self.wget_progress = f.progress
+
+        # how much of the dump we left in the page cache
+        self.wget_resident = dumpfile.resident(filename)
+
+        if VERBOSE and self.host_rate_limit \
+               and throttle.buckets[host].achieved():
+            print "http://%s: %s/s achieved, limit %s/s" \
+                  % (host,
+                     self.pp_file_size(throttle.buckets[host].achieved()),
+                     self.pp_file_size(self.host_rate_limit))
 
         return filename
 
+    def get_throttle(self, host):
+        """ return the bandwidth limits a download from host is subject to """
+        return throttle.throttle(host,
+                                 self.host_rate_limit,
+                                 self.fetch_rate_limit)
+
     def init_cluster(self):
         """ init a PostgreSQL cluster from pg_dumpall -g sql script """
         # unused here, in fact
         self.dated_dbname = None
 
         basename = "%s.%s" % (self.section, os.path.basename(self.dumpall_url))
-        filename = self.wget(self.backup_host, self.dumpall_url, basename)
+        hosts    = self.rank_mirrors()
+        filename = self.wget(hosts[0], self.dumpall_url, basename,
+                             hosts = hosts)
 
         # the restore object host the source sql file method
         r = restore.pgrestore(self.dated_dbname,
@@ -324,24 +504,256 @@ The default expression is used when date is None and can be one of 'today',
 
         return
 
-    def get_dump(self):
+    def get_dump(self, prefetch = False):
         """ get the dump file from the given URL """
         if not self.backup_date:
             raise UnknownBackupDateException
 
+        # we store the dump decompressed, whatever the backup host has
         filename = "%s.%s.dump" % (self.dbname, self.backup_date)
-        return self.wget(self.backup_host,                            # host
-                         "%s/%s" % (self.backup_base_url, filename),  # url
-                         filename)                                    # out
+        remote   = self.get_backup_file(filename)
+        url      = "%s/%s" % (self.backup_base_url, remote)
+        hosts    = self.rank_mirrors(url)
+
+        return self.wget(hosts[0],                                    # host
+                         url,                                         # url
+                         filename,                                    # out
+                         cache    = True,
+                         size     = self.get_backup_size(remote),
+                         prefetch = prefetch,
+                         hosts    = hosts)
+
+    def get_remote_dump(self):
+        """ have the target host fetch the dump, return its filename
+        there, in the same tmpdir """
+        from options import TERSE
 
-    def do_remove_dump(self, filename):
-        """ remove dump when self.remove_dump says so """
+        if not self.backup_date:
+            raise UnknownBackupDateException
+
+        filename = "%s.%s.dump" % (self.dbname, self.backup_date)
+        remote   = self.get_backup_file(filename)
+        url      = "%s/%s" % (self.backup_base_url, remote)
+        host     = self.rank_mirrors(url)[0]
+
+        f = remotefetch.remotefetch(self.host, self.use_sudo, host, url,
+                                    "%s/%s" % (self.tmpdir, filename))
+        f.cancel = self.fetch_cancel
+
+        if not TERSE:
+            print "fetching '%s' on %s\n    from %s" % (f.filename,
+                                                        self.host,
+                                                        f.source)
+
+        start_time = time.time()
+        f.fetch()
+
+        self.wget_timing      = time.time() - start_time
+        self.wget_rate        = f.rate
+        self.wget_progress    = f.progress
+        self.wget_compression = None
+        self.wget_resident    = None
+
+        return f.filename
+
+    def restore_on_target(self):
+        """ is the dump fetched and restored on the target host? """
+        return self.remote_fetch or self.remote_restore
+
+    def set_remote(self, r):
+        """ have the pgrestore object r run pg_restore on the target
+        host, where the dump is """
+        r.remote   = True
+        r.use_sudo = self.use_sudo
+
+        # straight to PostgreSQL rather than through pgbouncer
+        if self.remote_restore:
+            r.remote_port = self.postgres_port
+
+    def remove_remote_dump(self, filename):
+        """ remove the dump the target host fetched, when self.remove_dump
+        says so """
         from options import VERBOSE
 
         if self.remove_dump:
             if VERBOSE:
-                print "rm %s" % filename
-            os.unlink(filename)
+                print "rm %s:%s" % (self.host, filename)
+
+            utils.run_client_script(self.host, ["rmdump", filename],
+                                    self.use_sudo)
+
+    def get_dump_room(self):
+        """ return how many more bytes tmpdir needs for the dump, 0 when
+        it's in the dump cache already. Compressed dumps are stored
+        decompressed, we estimate their size from the ones we have
+        decompressed before """
+        if not self.backup_date:
+            raise UnknownBackupDateException
+
+        filename = "%s.%s.dump" % (self.dbname, self.backup_date)
+        url      = "%s/%s" % (self.backup_base_url,
+                              self.get_backup_file(filename))
+        f = self.get_fetcher(self.backup_host, url,
+                             "%s/%s" % (self.tmpdir, filename))
+        f.head()
+
+        dumps = self.get_dump_cache(prefetch = True)
+        if dumps.peek(dumps.key(self.backup_hosts, url), self.backup_host,
+                      f.size, f.etag, f.last_modified):
+            return 0
+
+        size = f.size
+        if f.compression:
+            ratio = dumps.ratio(f.compression) or compress.ESTIMATED_RATIO
+            size  = int(size * ratio)
+
+        # a partial download already holds its blocks
+        if os.path.exists(f.partial):
+            size -= os.stat(f.partial).st_blocks * 512
+
+        return max(0, size)
+
+    def get_backup_size(self, filename):
+        """ return the size of filename as given in the listing, in bytes,
+        or None """
+        for size, name in self.get_backup_listing().files:
+            if name == filename:
+                try:
+                    return utils.parse_size(size)
+                except ValueError:
+                    return None
+
+        return None
+
+    def can_stream_dump(self):
+        """ can we pipe the dump into pg_restore while fetching it? """
+        from options import TERSE
+
+        if not self.restore_stream:
+            return False
+
+        # the dump is already here
+        if self.dump_file:
+            return False
+
+        # pg_restore runs where the dump is fetched
+        if self.restore_on_target():
+            if not TERSE:
+                print "Notice: not streaming a dump fetched by %s" % self.host
+            return False
+
+        # pg_restore reads local dumps just fine
+        if localfetch.is_local(self.backup_base_url):
+            if not TERSE:
+                print "Notice: not streaming a local dump"
+            return False
+
+        # pg_restore -j needs to seek into the dump, and the catalog we
+        # prepare for schema filtering needs the whole dump file
+        if self.restore_jobs > 1 or self.schemas or self.schemas_nodata:
+            if not TERSE:
+                print "Notice: can't stream the dump with restore_jobs " \
+                      "or schemas filtering, fetching it first"
+            return False
+
+        return True
+
+    def stream_dump(self, r):
+        """ restore the dump with pg_restore as it's being fetched, return
+        pg_restore timing and the local copy filename, if any """
+        from options import TERSE
+
+        if not self.backup_date:
+            raise UnknownBackupDateException
+
+        filename = "%s.%s.dump" % (self.dbname, self.backup_date)
+        remote   = self.get_backup_file(filename)
+        url      = "%s/%s" % (self.backup_base_url, remote)
+
+        # pg_restore can't start over, we can only choose the mirror
+        self.rank_mirrors(url)
+
+        # keep a local copy of the dump only when we're not to remove it
+        tee = None
+        if not self.remove_dump:
+            tee = "%s/%s" % (self.tmpdir, filename)
+
+        if not TERSE:
+            print "streaming http://%s%s" % (self.backup_host, url)
+            if tee:
+                print "     into '%s'" % tee
+
+        # check the dump as it goes through, pg_restore_stream() then fails
+        # on a truncated or corrupted dump
+        checksum = fetch.get_checksum(self.backup_host, url)
+
+        p = progress.progress("http://%s%s" % (self.backup_host, url),
+                              self.get_backup_size(remote))
+        p.begin()
+
+        pool, conn, resp = httppool.request(self.backup_host, "GET", url,
+                                            {'Accept-Encoding': 'gzip'})
+        try:
+            if resp.status != 200:
+                mesg = "Could not get dump '%s': %s" % (url, resp.reason)
+                raise CouldNotGetDumpException, mesg
+
+            size = resp.getheader('content-length')
+            if size is not None:
+                p.size = int(size)
+
+            # pg_restore gets the dump decompressed
+            d = fetch.digester(url, None, checksum)
+            source, decompressed = fetch.dumpstream(
+                throttle.throttledstream(progress.progressstream(resp, p),
+                                         self.get_throttle(self.backup_host)),
+                resp, url, compress.kind_of(url), d)
+
+            secs = r.pg_restore_stream(source, tee)
+
+            # pg_restore may be done before the end of the dump
+            if tee and not os.path.exists(tee):
+                tee = None
+
+        finally:
+            pool.release(conn, resp)
+            p.done()
+
+        self.wget_progress = p
+
+        self.wget_compression = None
+        if decompressed:
+            self.wget_compression = compress.stats(decompressed)
+
+        # fetching is overlapped with pg_restore
+        self.wget_timing = None
+        self.wget_rate   = None
+        if secs > 0:
+            self.wget_rate = p.bytes / secs
+
+        return secs, tee
+
+    def do_remove_dump(self, filename):
+        """ remove dump when self.remove_dump says so, unless the dump cache
+        is managing it """
+        from options import VERBOSE
+
+        dumps = self.get_dump_cache()
+        cached = dumps and dumps.contains(filename)
+
+        if cached and self.cache_size is not None:
+            if VERBOSE:
+                print "keeping %s in the dump cache" % filename
+            return
+
+        if self.remove_dump:
+            if cached:
+                # prefetched for a section without a dump cache
+                dumps.forget(filename)
+            else:
+                if VERBOSE:
+                    print "rm %s" % filename
+                os.unlink(filename)
 
     def get_nodata_tables(self):
         """ return a list of tables to avoid restoring """
@@ -367,6 +779,7 @@ The default expression is used when date is None and can be one of 'today',
                               self.pg_restore,
                               self.pg_restore_st,
                               connect = False)
+        r.toc_cache = self.get_toc_cache()
 
         return r.get_trigger_funcs(filename)
 
@@ -386,6 +799,7 @@ The default expression is used when date is None and can be one of 'today',
                               self.schemas_nodata,
                               self.relname_nodata,
                               connect = False)
+        r.toc_cache = self.get_toc_cache()
 
         catalog = r.get_catalog(filename, self.get_nodata_tables())
         return catalog.getvalue()
@@ -409,88 +823,217 @@ The default expression is used when date is None and can be one of 'today',
         self.pgbouncer_add_database()
 
     def restore(self):
-        """ launch a pg_restore for the current staging configuration """
+        """ launch a pg_restore for the current staging configuration
+
+        The restore is a pipeline of stages, the dump download running
+        concurrently with the target database preparation. """
         from options import VERBOSE, TERSE, DEBUG
 
-        # first attempt to establish the connection to remote server
-        # no need to fetch the big backup file unless this succeed
-        #
-        # we will restore from pgbouncer connection, first connection is
-        # made to the maintenance database
-        r = restore.pgrestore(self.dated_dbname,
-                              self.dbuser,
-                              self.host,
-                              self.pgbouncer_port,
-                              self.dbowner,
-                              self.maintdb,
-                              self.postgres_major,
-                              self.pg_restore,
-                              self.pg_restore_st,
-                              self.schemas,
-                              self.schemas_nodata,
-                              self.relname_nodata)
+        # stages results
+        state  = {'r': None, 'filename': None, 'catalog': None,
+                  'secs': None, 'vacuum': None}
+        stream = self.can_stream_dump()
 
-        # while connected, try to create the database
-        r.createdb(self.db_encoding)
+        def connect():
+            # we will restore from pgbouncer connection, first connection
+            # is made to the maintenance database
+            r = restore.pgrestore(self.dated_dbname,
+                                  self.dbuser,
+                                  self.host,
+                                  self.pgbouncer_port,
+                                  self.dbowner,
+                                  self.maintdb,
+                                  self.postgres_major,
+                                  self.pg_restore,
+                                  self.pg_restore_st,
+                                  self.schemas,
+                                  self.schemas_nodata,
+                                  self.relname_nodata)
+            r.restore_jobs = self.restore_jobs
 
-        # add the new database to pgbouncer configuration now
-        # it could be that the restore will be connected to pgbouncer
-        self.pgbouncer_add_database()
+            # the dump is on the target host, so is pg_restore
+            if self.restore_on_target():
+                self.set_remote(r)
+            else:
+                r.toc_cache = self.get_toc_cache()
 
-        # source the extra SQL files (generator function)
-        for sql in self.psql_source_files(utils.PRE_SQL):
-            if VERBOSE:
-                print "psql -f %s" % sql
+            state['r'] = r
 
-        # now, download the dump we need.
-        filename = self.get_dump()
+        def createdb():
+            # while connected, try to create the database
+            state['r'].createdb(self.db_encoding)
+
+        def add_database():
+            # add the new database to pgbouncer configuration now
+            # it could be that the restore will be connected to pgbouncer
+            self.pgbouncer_add_database()
+
+        def presql():
+            # source the extra SQL files (generator function)
+            for sql in self.psql_source_files(utils.PRE_SQL):
+                if VERBOSE:
+                    print "psql -f %s" % sql
+
+        def get_dump():
+            if self.restore_on_target():
+                state['filename'] = self.get_remote_dump()
+                return
+
+            # another section fetched the dump for us, and removes it
+            if self.dump_file:
+                state['filename'] = self.dump_file
+                self.wget_timing  = 0
+                return
+
+            state['filename'] = self.get_dump()
 
-        # and restore it
-        mesg = None
-        try:
             if VERBOSE:
-                os.system("ls -l %s" % filename)
+                os.system("ls -l %s" % state['filename'])
+
+        def catalog():
+            # the filtered catalog only depends on the dump
+            state['catalog'] = state['r'].get_catalog(state['filename'],
+                                                      self.get_nodata_tables(),
+                                                      out_to_file = True)
+
+        def pg_restore():
+            try:
+                if stream:
+                    state['secs'], state['filename'] = \
+                                   self.stream_dump(state['r'])
+                else:
+                    state['secs'] = state['r'].pg_restore(
+                        state['filename'],
+                        self.get_nodata_tables(),
+                        state['catalog'])
+
+            except Exception, e:
+                if DEBUG:
+                    raise
+                mesg  = "Error: couldn't pg_restore from '%s'" \
+                        % (state['filename'] or self.backup_filename)
+                mesg += "\nDetail: %s" % e
+                raise PGRestoreFailedException, mesg
+
+        def vacuum():
+            # if told to do so, now vacuum analyze the database
+            state['vacuum'] = self.vacuumdb()
+
+        def postsql():
+            # source the extra SQL files
+            for sql in self.psql_source_files(utils.POST_SQL):
+                if VERBOSE:
+                    print "psql -f %s" % sql
+
+        p = pipeline.pipeline()
+        p.add('connect',     connect)
+        p.add('createdb',    createdb,     ['connect'])
+        p.add('pgbouncer',   add_database, ['createdb'])
+        p.add('presql',      presql,       ['pgbouncer'])
+
+        if stream:
+            p.add('pg_restore', pg_restore, ['presql'])
 
-            r.restore_jobs = self.restore_jobs
-            secs = r.pg_restore(filename, self.get_nodata_tables())
+        else:
+            p.add('fetch', get_dump)
 
-            # only switch pgbouncer configuration to new database when there
-            # was no restore error
-            if self.auto_switch:
-                self.switch()
+            restore_deps = ['presql', 'fetch']
+            if self.schemas or self.schemas_nodata:
+                p.add('catalog', catalog, ['connect', 'fetch'])
+                restore_deps = ['presql', 'catalog']
 
-        except Exception, e:
-            if DEBUG:
-                raise
-            mesg  = "Error: couldn't pg_restore from '%s'" % (filename)
-            mesg += "\nDetail: %s" % e
-            raise PGRestoreFailedException, mesg
+            p.add('pg_restore', pg_restore, restore_deps)
 
-        finally:
-            # set the database search_path if non default
-            self.set_database_search_path()
+        # only switch pgbouncer configuration to new database when there
+        # was no restore error
+        if self.auto_switch:
+            p.add('switch', self.switch, ['pg_restore'])
 
-        # remove the dump even when there was no exception
-        self.do_remove_dump(filename)
+        # set the database search_path if non default, before post SQL
+        p.add('search_path', self.set_database_search_path, ['pg_restore'])
+        p.add('vacuum',      vacuum,       ['pg_restore'])
+        p.add('postsql',     postsql,      ['vacuum', 'search_path'])
 
-        # if told to do so, now vacuum analyze the database
-        vacuum_timing = self.vacuumdb()
+        self.restore_pipeline = p
 
-        # source the extra SQL files
-        for sql in self.psql_source_files(utils.POST_SQL):
-            if VERBOSE:
-                print "psql -f %s" % sql
+        # stop fetching the dump as soon as another stage failed
+        self.fetch_cancel = p.cancelled
+
+        # the cached dump this restore fetches stays pinned until it's done
+        pins = len(self.pinned)
+        try:
+            try:
+                try:
+                    p.run()
+
+                except:
+                    # set the database search_path even when pg_restore
+                    # failed
+                    if 'createdb' in p.ended \
+                           and 'search_path' not in p.ended:
+                        self.set_database_search_path()
+                    raise
+            finally:
+                self.fetch_cancel = None
+
+            # remove the dump, now that the restore is a success
+            if state['filename'] and self.restore_on_target():
+                self.remove_remote_dump(state['filename'])
+
+            elif state['filename'] and state['filename'] != self.dump_file:
+                self.do_remove_dump(state['filename'])
 
-        return self.wget_timing, secs, vacuum_timing
+        finally:
+            self.unpin_dumps(pins)
+
+        # wget_timing is None when the fetch overlapped pg_restore
+        return self.wget_timing, state['secs'], state['vacuum']
+
+    def unpin_dumps(self, start = 0):
+        """ let the dump cache evict the dumps we pinned, from the start-th
+        one on """
+        while len(self.pinned) > start:
+            dumps, key = self.pinned.pop()
+            dumps.unpin(key)
+
+    def bench_restore(self):
+        """ restore the dump twice into a scratch database, dropped after
+        each run: from here through pgbouncer, then on the target host
+        over its local socket. Return [(path, fetch, pg_restore, total)]
+        timings, in seconds """
+        saved = (self.dated_dbname, self.auto_switch,
+                 self.remote_fetch, self.remote_restore)
+
+        results = []
+        try:
+            for path, remote in (("pgbouncer", False),
+                                 ("local socket", True)):
+                self.dated_dbname   = "%s_bench" % saved[0]
+                self.auto_switch    = False
+                self.remote_fetch   = False
+                self.remote_restore = remote
+
+                wget_t, pgrestore_t, vacuumdb_t = self.restore()
+                p = self.restore_pipeline
+                results.append((path, wget_t, pgrestore_t,
+                                p.end_time - p.start_time))
+
+                self.drop(self.dated_dbname)
+        finally:
+            self.dated_dbname, self.auto_switch, \
+                self.remote_fetch, self.remote_restore = saved
+
+        return results
 
     def load(self, filename):
         """ will pg_restore from the already present dumpfile and determine
         the backup date from the file, which isn't removed """
         from options import VERBOSE, TERSE, DEBUG
 
-        # first parse the dump filename
+        # first parse the dump filename, foo.2011-03-11.dump[.gz|.zst]
         try:
-            dbname, date, ext = filename.split('.')
+            basename = compress.strip_extension(os.path.basename(filename))
+            dbname, date, ext = basename.split('.')
             self.backup_date  = date.replace('-', '')
 
             # just validate it's an 8 figures integer
@@ -501,13 +1044,24 @@ The default expression is used when date is None and can be one of 'today',
             self.dated_dbname = "%s_%s" % (self.dbname, self.backup_date)
 
         except ValueError, e:
-            os.chdir(pushd)
             mesg = "load: '%s' isn't a valid dump file name" % filename
             raise ParseDumpFileException, mesg
 
         if filename[0] != '/':
             filename = os.path.join(self.tmpdir, filename)
 
+        # with remote_restore, filename is on the target host
+        if self.remote_restore and compress.kind_of(filename):
+            mesg = "load: '%s' is compressed, pg_restore needs a plain " \
+                   "dump on %s" % (filename, self.host)
+            raise ParseDumpFileException, mesg
+
+        # pg_restore needs a plain dump file, that we remove once done
+        decompressed = None
+        if compress.kind_of(filename):
+            decompressed = self.decompress_dump(filename)
+            filename     = decompressed
+
         # see comments in previous self.restore() method
         r = restore.pgrestore(self.dated_dbname,
                               self.dbuser,
@@ -522,6 +1076,9 @@ The default expression is used when date is None and can be one of 'today',
                               self.schemas_nodata,
                               self.relname_nodata)
 
+        if self.remote_restore:
+            self.set_remote(r)
+
         # create the target database if it does not already exists
         exists = self.dated_dbname in [n for n,d,h,p
                                        in self.pgbouncer_databases()]
@@ -531,7 +1088,7 @@ The default expression is used when date is None and can be one of 'today',
 
         # now restore the dump
         try:
-            if VERBOSE:
+            if VERBOSE and not self.remote_restore:
                 os.system("ls -l %s" % filename)
 
             r.restore_jobs = self.restore_jobs
@@ -548,8 +1105,43 @@ The default expression is used when date is None and can be one of 'today',
             # set the database search_path if non default
             self.set_database_search_path()
 
+            if decompressed:
+                os.unlink(decompressed)
+
         return secs
 
+    def decompress_dump(self, filename):
+        """ decompress filename into tmpdir, return the new file name """
+        from options import TERSE, BUFSIZE
+
+        outfile = os.path.join(self.tmpdir,
+                               compress.strip_extension(
+                                   os.path.basename(filename)))
+
+        if not TERSE:
+            print "decompressing '%s'\n    into '%s'" % (filename, outfile)
+
+        src = open(filename, "rb")
+        dst = open(outfile, "wb")
+        try:
+            try:
+                s = compress.decompressedstream(src, compress.kind_of(filename))
+
+                data = s.read(BUFSIZE)
+                while data:
+                    dst.write(data)
+                    data = s.read(BUFSIZE)
+            except:
+                dst.close()
+                os.unlink(outfile)
+                raise
+        finally:
+            dst.close()
+            src.close()
+
+        self.wget_compression = compress.stats(s)
+        return outfile
+
     def dump(self, filename, force = False):
         """ launch a pg_restore for the current staging configuration """
         from options import VERBOSE, TERSE
@@ -614,11 +1206,16 @@ The default expression is used when date is None and can be one of 'today',
                                 self.host,
                                 self.postgres_port)
 
-        newconffile = p.switch_to_database(self.dbname,
-                                           self.dated_dbname,
-                                           self.postgres_port)
+        lock = pgbouncer.get_config_lock(self.host, self.pgbouncer_conf)
+        lock.acquire()
+        try:
+            newconffile = p.switch_to_database(self.dbname,
+                                               self.dated_dbname,
+                                               self.postgres_port)
 
-        self.pgbouncer_update_conf(newconffile)
+            self.pgbouncer_update_conf(newconffile)
+        finally:
+            lock.release()
 
     def pgbouncer_add_database(self, dbname = None):
         """ edit pgbouncer configuration file to add a database """
@@ -632,9 +1229,14 @@ The default expression is used when date is None and can be one of 'today',
         if dbname is None:
             dbname = self.dated_dbname
 
-        newconffile = p.add_database(dbname, self.postgres_port)
+        lock = pgbouncer.get_config_lock(self.host, self.pgbouncer_conf)
+        lock.acquire()
+        try:
+            newconffile = p.add_database(dbname, self.postgres_port)
 
-        self.pgbouncer_update_conf(newconffile)
+            self.pgbouncer_update_conf(newconffile)
+        finally:
+            lock.release()
 
         if not TERSE:
             print "added a pgbouncer database %s" % dbname
@@ -648,9 +1250,14 @@ The default expression is used when date is None and can be one of 'today',
                                 self.host,
                                 self.postgres_port)
 
-        newconffile = p.del_database(dbname)
+        lock = pgbouncer.get_config_lock(self.host, self.pgbouncer_conf)
+        lock.acquire()
+        try:
+            newconffile = p.del_database(dbname)
 
-        self.pgbouncer_update_conf(newconffile)
+            self.pgbouncer_update_conf(newconffile)
+        finally:
+            lock.release()
 
         if VERBOSE:
             print "deleted a pgbouncer database %s" % dbname
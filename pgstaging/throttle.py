@@ -0,0 +1,116 @@
+##
+## Token bucket bandwidth limiting for backup fetches
+##
+## Each backup_host gets a bucket shared by every download from it in the
+## process, so that concurrent fetches of several sections together stay
+## under the host limit, and each download can have its own bucket too.
+## Readers take tokens for the bytes they got and sleep when in debt.
+##
+
+import time, threading
+
+# backup_host: tokenbucket, shared by all the downloads of the process
+buckets = {}
+buckets_lock = threading.Lock()
+
+def get_host_bucket(host, rate):
+    """ return the bucket of given backup_host, the lowest rate wins when
+    sections don't agree """
+    buckets_lock.acquire()
+    try:
+        if host not in buckets:
+            buckets[host] = tokenbucket(rate)
+
+        elif rate < buckets[host].rate:
+            buckets[host].set_rate(rate)
+
+        return buckets[host]
+    finally:
+        buckets_lock.release()
+
+class tokenbucket:
+    """ Allow rate bytes per second on average, in bursts of rate/4 """
+
+    def __init__(self, rate):
+        """ rate is a number of bytes per second """
+        self.lock   = threading.Lock()
+        self.set_rate(rate)
+
+        self.tokens = self.burst
+        self.stamp  = time.time()
+
+        # what we let through, to compute the achieved rate
+        self.start  = None
+        self.bytes  = 0
+
+    def set_rate(self, rate):
+        """ change the rate, and the burst size with it """
+        self.rate  = rate
+        self.burst = max(rate / 4, 64 * 1024)
+
+    def consume(self, n):
+        """ account for n bytes, sleep until the bucket isn't in debt """
+        self.lock.acquire()
+        try:
+            now = time.time()
+            if self.start is None:
+                self.start = now
+
+            self.tokens = min(self.burst,
+                              self.tokens + (now - self.stamp) * self.rate)
+            self.stamp  = now
+
+            self.tokens -= n
+            self.bytes  += n
+
+            wait = 0
+            if self.tokens < 0:
+                wait = - self.tokens / float(self.rate)
+        finally:
+            self.lock.release()
+
+        if wait > 0:
+            time.sleep(wait)
+
+    def achieved(self):
+        """ return the average rate we let through so far, in bytes/s """
+        if self.start is None or time.time() == self.start:
+            return None
+
+        return self.bytes / (time.time() - self.start)
+
+class throttle:
+    """ The buckets a single download has to go through """
+
+    def __init__(self, host, host_rate = None, rate = None):
+        """ host_rate is the backup_host limit, rate the download one """
+        self.buckets = []
+
+        if host_rate:
+            self.buckets.append(get_host_bucket(host, host_rate))
+
+        if rate:
+            self.buckets.append(tokenbucket(rate))
+
+    def chunk(self, size):
+        """ don't read more than a burst at once, to keep traffic smooth """
+        for b in self.buckets:
+            size = min(size, b.burst)
+        return size
+
+    def consume(self, n):
+        """ wait until all the buckets let n bytes through """
+        for b in self.buckets:
+            b.consume(n)
+
+class throttledstream:
+    """ A file-like object limiting the rate we read source at """
+
+    def __init__(self, source, throttle):
+        self.source   = source
+        self.throttle = throttle
+
+    def read(self, size):
+        data = self.source.read(self.throttle.chunk(size))
+        self.throttle.consume(len(data))
+        return data
@@ -0,0 +1,328 @@
+##
+## Persistent cache of what pg_restore tells us about a dump
+##
+## Filtering the catalog of a dump needs both its pg_restore -l listing and
+## the trigger functions found in its pg_restore -s output. The restore, the
+## catalog and triggers commands and every section restoring the same dump
+## would run both again, so we keep them in tmpdir/pg_staging.toc, a SQLite
+## database. Dumps are known by their size, mtime and a checksum of their
+## first and last blocks, where the custom format keeps its TOC, so that a
+## dump is found again whatever its file name.
+##
+## The TOC lines are stored one row each, so that neither storing nor
+## reading them back needs to hold the whole listing in memory. They are
+## written in batches under a pending dump that lookups can't find, without
+## holding the write lock, so that a slow pg_restore -l doesn't block the
+## other sections, then published in a short transaction.
+##
+
+import os, time, hashlib, itertools, threading, sqlite3
+
+INDEX = "pg_staging.toc"
+
+# how many dumps we keep the TOC of
+MAX_DUMPS = 32
+
+# the checksum covers that much of the start and the end of the dump
+BLOCK = 1024 * 1024
+
+# how many TOC lines we insert at a time
+BATCH = 10000
+
+# seconds after which a pending dump is considered left over by a crash
+STALE = 24 * 3600
+
+SCHEMA = """
+create table if not exists dump(id           integer primary key,
+                                size         integer,
+                                mtime        real,
+                                checksum     text,
+                                filename     text,
+                                atime        real,
+                                toc_secs     real,
+                                trigger_secs real,
+                                unique(size, mtime, checksum));
+
+create table if not exists toc(dump integer, n integer, line text,
+                               primary key(dump, n));
+
+create table if not exists trigger(dump integer, n integer, schema text,
+                                   name text, func text);
+"""
+
+class toccache:
+    """ Keep pg_restore -l listings and trigger functions of dumps """
+
+    def __init__(self, tmpdir):
+        self.index = os.path.join(tmpdir, INDEX)
+        self.keys  = {}         # {filename: (size, mtime, key)}
+
+        # what the cache saved us
+        self.lock  = threading.Lock()
+        self.hits  = 0
+        self.saved = 0
+
+    def connect(self):
+        """ return a new connection to the cache, one per thread """
+        conn = sqlite3.connect(self.index, timeout = 60,
+                               isolation_level = None)
+        conn.text_factory = str
+
+        # readers streaming TOC lines don't block the writers, nor the
+        # other way round
+        conn.execute("pragma journal_mode = wal")
+        conn.executescript(SCHEMA)
+        return conn
+
+    def key(self, filename):
+        """ return the (size, mtime, checksum) identity of the dump """
+        st = os.stat(filename)
+
+        if filename in self.keys:
+            size, mtime, key = self.keys[filename]
+            if size == st.st_size and mtime == st.st_mtime:
+                return key
+
+        h = hashlib.sha1()
+        f = open(filename, 'rb')
+        try:
+            h.update(f.read(BLOCK))
+            if st.st_size > 2 * BLOCK:
+                f.seek(-BLOCK, os.SEEK_END)
+                h.update(f.read(BLOCK))
+        finally:
+            f.close()
+
+        key = (st.st_size, st.st_mtime, h.hexdigest())
+        self.keys[filename] = (st.st_size, st.st_mtime, key)
+        return key
+
+    def lookup(self, conn, key, column):
+        """ return (id, secs) of the dump, secs is None when column is not
+        cached yet, or None when the dump is unknown """
+        return conn.execute("select id, %s from dump " % column +
+                            " where size = ? and mtime = ? and checksum = ?",
+                            key).fetchone()
+
+    def hit(self, conn, id, secs, what, filename):
+        """ count the time a cache hit saved us """
+        from options import VERBOSE
+
+        conn.execute("update dump set atime = ? where id = ?",
+                     (time.time(), id))
+
+        self.lock.acquire()
+        try:
+            self.hits  += 1
+            self.saved += secs
+        finally:
+            self.lock.release()
+
+        if VERBOSE:
+            print "toc cache: %s of '%s' saved %.3fs" % (what, filename, secs)
+
+    def register(self, conn, key, filename):
+        """ return the id of the dump, adding it when needed. Must be
+        called within a transaction """
+        row = self.lookup(conn, key, 'id')
+        if row:
+            conn.execute("update dump set filename = ?, atime = ? "
+                         " where id = ?", (filename, time.time(), row[0]))
+            return row[0]
+
+        cur = conn.execute("insert into dump(size, mtime, checksum, "
+                           "                 filename, atime) "
+                           "     values (?, ?, ?, ?, ?)",
+                           key + (filename, time.time()))
+        id = cur.lastrowid
+
+        self.prune(conn)
+        return id
+
+    def prune(self, conn):
+        """ forget about the least recently used dumps, and about pending
+        ones a crash left behind. Must be called within a transaction """
+        for old, in conn.execute("select id from dump "
+                                 " where size is not null "
+                                 " order by atime desc limit -1 offset ?",
+                                 (MAX_DUMPS,)).fetchall():
+            self.discard(conn, old)
+
+        for old, in conn.execute("select id from dump "
+                                 " where size is null and atime < ?",
+                                 (time.time() - STALE,)).fetchall():
+            self.discard(conn, old)
+
+    def toc(self, filename):
+        """ yield the cached pg_restore -l lines of the dump, or return None
+        when we don't have them """
+        conn = self.connect()
+        row  = self.lookup(conn, self.key(filename), 'toc_secs')
+
+        if row is None or row[1] is None:
+            conn.close()
+            return None
+
+        self.hit(conn, row[0], row[1], "pg_restore -l", filename)
+        return self.lines(conn, row[0])
+
+    def lines(self, conn, id):
+        """ yield the TOC lines from the cache """
+        try:
+            for line, in conn.execute("select line from toc where dump = ? "
+                                      "order by n", (id,)):
+                yield line
+        finally:
+            conn.close()
+
+    def add_toc(self, filename, lines):
+        """ store the pg_restore -l lines of the dump, then return them from
+        the cache. The lines are not read when another thread stored them
+        already """
+        key  = self.key(filename)
+        conn = self.connect()
+
+        try:
+            row = self.lookup(conn, key, 'toc_secs')
+            if row is not None and row[1] is not None:
+                return self.lines(conn, row[0])
+
+            start   = time.time()
+            pending = self.write_pending(conn, lines)
+            secs    = time.time() - start
+
+            return self.lines(conn, self.publish(conn, key, filename,
+                                                 pending, secs))
+        except:
+            conn.close()
+            raise
+
+    def write_pending(self, conn, lines):
+        """ store the lines under a new pending dump, that lookups can't
+        find, BATCH rows at a time and without holding the write lock
+        meanwhile, and return its id """
+        pending = conn.execute("insert into dump(atime) values (?)",
+                               (time.time(),)).lastrowid
+        try:
+            rows = ((pending, n, line.rstrip('\n'))
+                    for n, line in enumerate(lines))
+
+            # a transaction per batch, that only holds the write lock for
+            # as long as the insert takes
+            batch = list(itertools.islice(rows, BATCH))
+            while batch:
+                conn.execute("begin immediate")
+                try:
+                    conn.executemany("insert into toc(dump, n, line) "
+                                     "     values (?, ?, ?)", batch)
+                    conn.execute("commit")
+                except:
+                    conn.execute("rollback")
+                    raise
+                batch = list(itertools.islice(rows, BATCH))
+        except:
+            self.discard(conn, pending)
+            raise
+
+        return pending
+
+    def publish(self, conn, key, filename, pending, secs):
+        """ make the pending dump the one known by key, in a short
+        transaction, and return the id of the dump """
+        conn.execute("begin immediate")
+        try:
+            row = self.lookup(conn, key, 'toc_secs')
+
+            if row is not None and row[1] is not None:
+                # another thread stored them meanwhile
+                conn.execute("commit")
+                self.discard(conn, pending)
+                return row[0]
+
+            if row is not None:
+                # keep the trigger functions we have for the dump
+                old = row[0]
+                conn.execute("update trigger set dump = ? where dump = ?",
+                             (pending, old))
+                conn.execute("update dump set trigger_secs = "
+                             "  (select trigger_secs from dump where id = ?) "
+                             " where id = ?", (old, pending))
+                conn.execute("delete from toc where dump = ?", (old,))
+                conn.execute("delete from dump where id = ?", (old,))
+
+            conn.execute("update dump set size = ?, mtime = ?, checksum = ?, "
+                         "                filename = ?, atime = ?, "
+                         "                toc_secs = ? "
+                         " where id = ?",
+                         key + (filename, time.time(), secs, pending))
+            self.prune(conn)
+            conn.execute("commit")
+        except:
+            conn.execute("rollback")
+            self.discard(conn, pending)
+            raise
+
+        return pending
+
+    def discard(self, conn, id):
+        """ forget about the dump and what we have of it """
+        for table in ('toc', 'trigger'):
+            conn.execute("delete from %s where dump = ?" % table, (id,))
+        conn.execute("delete from dump where id = ?", (id,))
+
+    def triggers(self, filename):
+        """ return the cached trigger functions of the dump, as
+        restore.pgrestore.get_trigger_funcs() does, or None """
+        conn = self.connect()
+        try:
+            row = self.lookup(conn, self.key(filename), 'trigger_secs')
+            if row is None or row[1] is None:
+                return None
+
+            triggers = {}
+            for schema, name, func in conn.execute(
+                "select schema, name, func from trigger where dump = ? "
+                "order by n", (row[0],)):
+                funcs = triggers.setdefault(schema, {})
+                if name is not None:
+                    funcs = funcs.setdefault(name, [])
+                    if func is not None:
+                        funcs.append(func)
+
+            self.hit(conn, row[0], row[1], "pg_restore -s", filename)
+            return triggers
+
+        finally:
+            conn.close()
+
+    def add_triggers(self, filename, triggers, secs):
+        """ store the trigger functions of the dump, that secs of pg_restore
+        -s gave us """
+        rows = []
+        for schema in triggers:
+            rows.append((schema, None, None))
+            for name in triggers[schema]:
+                rows.append((schema, name, None))
+                for func in triggers[schema][name]:
+                    rows.append((schema, name, func))
+
+        key  = self.key(filename)
+        conn = self.connect()
+        try:
+            conn.execute("begin immediate")
+            try:
+                id = self.register(conn, key, filename)
+
+                conn.execute("delete from trigger where dump = ?", (id,))
+                conn.executemany("insert into trigger(dump, n, schema, "
+                                 "                    name, func) "
+                                 "     values (?, ?, ?, ?, ?)",
+                                 [(id, n) + r for n, r in enumerate(rows)])
+                conn.execute("update dump set trigger_secs = ? where id = ?",
+                             (secs, id))
+                conn.execute("commit")
+            except:
+                conn.execute("rollback")
+                raise
+        finally:
+            conn.close()
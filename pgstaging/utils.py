@@ -1,5 +1,5 @@
 # Exceptions and utilities
-import shlex, subprocess
+import shlex, ctypes, tempfile, subprocess
 
 RET_CODE = 0
 RET_OUT  = 1
@@ -57,6 +57,63 @@ def run_command(command,
     else:
         return proc.returncode
 
+def run_command_lines(command, expected_retcodes = 0):
+    """ run a command and yield its output lines as they come, then raise
+    an exception if retcode not in expected_retcode """
+    from options import VERBOSE
+    if VERBOSE:
+        print command
+
+    if type(expected_retcodes) == type(0):
+        expected_retcodes = (expected_retcodes,)
+
+    cmd = command
+    if type(cmd) == type('string'):
+        cmd = shlex.split(command)
+
+    # stderr goes to a temp file so that it can't fill a pipe and block the
+    # command while we read its output
+    err  = tempfile.TemporaryFile()
+    proc = subprocess.Popen(cmd, stdout = subprocess.PIPE, stderr = err)
+    try:
+        for line in proc.stdout:
+            yield line
+    finally:
+        # when the caller stops early, this kills the command with SIGPIPE
+        proc.stdout.close()
+        proc.wait()
+
+    if proc.returncode not in expected_retcodes:
+        err.seek(0)
+        mesg  = 'Error [%d]: %s' % (proc.returncode, command)
+        mesg += '\nDetail: %s' % err.read()
+        err.close()
+        raise SubprocessException, mesg
+
+    err.close()
+
+def parse_size(size):
+    """ parse 512K, 30G or 2T into a number of bytes """
+    units = {'K': 2**10, 'M': 2**20, 'G': 2**30, 'T': 2**40}
+
+    size = size.strip().upper().rstrip('B')
+    if size and size[-1] in units:
+        return int(float(size[:-1]) * units[size[-1]])
+
+    return int(size)
+
+def libc_call(name, restype, argtypes):
+    """ return the libc function, or None when libc doesn't have it """
+    libc = ctypes.CDLL(None, use_errno = True)
+    try:
+        func = getattr(libc, name)
+    except AttributeError:
+        return None
+
+    func.restype  = restype
+    func.argtypes = argtypes
+    return func
+
 def scp(host, src, dst):
     """ scp src host:dst """
     command = "scp %s %s:/tmp" % (src, host)
@@ -67,8 +124,8 @@ def ssh_cat(host, filename):
     command = "ssh %s cat %s" % (host, filename)
     return run_command(command, returning = RET_OUT)
 
-def run_client_script(host, args, use_sudo = True, ret = RET_OUT):
-    """ ssh host sudo CLIENT_SCRIPT args """
+def client_script_command(host, args, use_sudo = True):
+    """ return the ssh host sudo CLIENT_SCRIPT args command """
     from options import CLIENT_SCRIPT
 
     if use_sudo:
@@ -77,9 +134,26 @@ def run_client_script(host, args, use_sudo = True, ret = RET_OUT):
         sudo = ""
 
     str_args = " ".join([str(x) for x in args])
-    command  = "ssh %s %s %s %s" % (host, sudo, CLIENT_SCRIPT, str_args)
+    return "ssh %s %s %s %s" % (host, sudo, CLIENT_SCRIPT, str_args)
+
+def run_client_script(host, args, use_sudo = True, ret = RET_OUT):
+    """ ssh host sudo CLIENT_SCRIPT args """
+    command = client_script_command(host, args, use_sudo)
     return run_command(command, returning = ret )
 
+def popen_client_script(host, args, use_sudo = True, stderr = None):
+    """ ssh host sudo CLIENT_SCRIPT args, returning the running process
+    so that its output can be read as it comes """
+    from options import VERBOSE
+
+    command = client_script_command(host, args, use_sudo)
+    if VERBOSE:
+        print command
+
+    return subprocess.Popen(shlex.split(command),
+                            stdout = subprocess.PIPE,
+                            stderr = stderr)
+
 class NotYetImplementedException(Exception):
     """ Please try again """
     pass
@@ -88,6 +162,18 @@ class CouldNotGetDumpException(Exception):
     """ HTTP Return code was not 200 """
     pass
 
+class CorruptDumpException(Exception):
+    """ dump size or checksum is not the expected one """
+    pass
+
+class UnsupportedDumpFormatException(Exception):
+    """ not a custom format dump we can read, pg_restore might """
+    pass
+
+class FetchCancelledException(Exception):
+    """ another restore stage failed, we stopped fetching the dump """
+    pass
+
 class CouldNotConnectPostgreSQLException(Exception):
     """ Just that, check the config """
     pass
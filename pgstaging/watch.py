@@ -0,0 +1,151 @@
+##
+## Wait for the next dump of a section to be published
+##
+## We poll the backup listing, with conditional requests, until a dump
+## newer than the ones we had when starting shows up. A dump is complete
+## once a sidecar or marker file is published next to it, or when its size
+## and Last-Modified did not change between two polls. The restore can
+## then start right away, rather than at a fixed time with a safety margin.
+##
+
+import time, email.utils
+
+import mirrors
+
+# files published next to the dump once it's complete
+MARKERS = ('.sha256', '.md5', '.done', '.complete')
+
+def parse_http_date(date):
+    """ return the Last-Modified date as a timestamp, or None """
+    if date is None:
+        return None
+
+    parsed = email.utils.parsedate_tz(date)
+    if parsed is None:
+        return None
+
+    return email.utils.mktime_tz(parsed)
+
+class watcher:
+    """ Watch the backup listing of a Staging object for a new dump """
+
+    def __init__(self, staging, interval = 60):
+        """ interval is how many seconds to wait between polls """
+        self.staging  = staging
+        self.interval = interval
+
+        # the latest backup date when we started, or None
+        self.baseline = None
+
+        # the dump we're waiting to complete: [url, size, last_modified]
+        self.pending  = None
+
+        # filled in by self.wait()
+        self.date          = None
+        self.filename      = None
+        self.last_modified = None    # as a timestamp
+        self.detected      = None    # when we saw it complete
+        self.polls         = 0
+
+    def latest_date(self):
+        """ return the date of the latest backup in the listing, or None """
+        latest = self.staging.get_latest_backup()
+        if latest is None:
+            return None
+
+        return self.staging.parse_backup_file_date(latest[1])
+
+    def wait(self):
+        """ poll until a new dump is complete, return its date """
+        from options import TERSE
+
+        s = self.staging
+
+        # each poll asks the backup host once, conditionally
+        ttl, s.listing_ttl = s.listing_ttl, self.interval / 2.
+        try:
+            self.baseline = self.latest_date()
+
+            if not TERSE:
+                print "watching %s for a dump newer than %s" \
+                      % (s.backup_base_url, self.baseline)
+
+            while True:
+                self.polls += 1
+                try:
+                    if self.poll():
+                        break
+
+                except mirrors.ERRORS, e:
+                    # the dump may still be on its way, or the backup host
+                    # briefly unavailable
+                    if not TERSE:
+                        print "watch: %s, polling again" \
+                              % str(e).replace('\n', ' ')
+
+                time.sleep(self.interval)
+        finally:
+            s.listing_ttl = ttl
+
+        self.detected = time.time()
+
+        if not TERSE:
+            print "dump '%s' is complete, after %d polls" \
+                  % (self.filename, self.polls)
+
+        return self.date
+
+    def poll(self):
+        """ return True once a new dump is complete """
+        from options import VERBOSE
+
+        s    = self.staging
+        date = self.latest_date()
+
+        if date is None or (self.baseline and date <= self.baseline):
+            self.pending = None
+            return False
+
+        filename = s.get_backup_file("%s.%s.dump" % (s.dbname,
+                                                     date.isoformat()))
+        url      = "%s/%s" % (s.backup_base_url, filename)
+
+        f = s.get_fetcher(s.backup_host, url, "%s/%s" % (s.tmpdir, filename))
+        f.head()
+
+        current  = [url, f.size, f.last_modified]
+        complete = self.has_marker(filename) or current == self.pending
+
+        if VERBOSE:
+            print "%s: %s bytes, last modified %s%s" \
+                  % (filename, f.size, f.last_modified,
+                     complete and ", complete" or "")
+
+        self.pending = current
+
+        if complete:
+            self.date          = date
+            self.filename      = filename
+            self.last_modified = parse_http_date(f.last_modified)
+
+        return complete
+
+    def has_marker(self, filename):
+        """ is there a completion marker next to filename? """
+        sidecars = self.staging.get_backup_listing().get_sidecars(filename)
+
+        for marker in MARKERS:
+            if marker in sidecars:
+                return True
+
+        return False
+
+    def freshness(self, done):
+        """ return (publish to detection, detection to done, publish to
+        done) in seconds, done being when the new database is live """
+        if self.last_modified is None:
+            return None, done - self.detected, None
+
+        return (self.detected - self.last_modified,
+                done - self.detected,
+                done - self.last_modified)
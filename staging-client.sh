@@ -10,11 +10,30 @@ PGQADM=`{ test -x "/usr/bin/pgqadm.py" && echo "/usr/bin/pgqadm.py"; } || { test
 
 PGBOUNCER_BASEDIR=/etc/pgbouncer
 
+# the tmpdir of the sections using remote_fetch, the only places where we
+# fetch dumps into and restore them from, separated by spaces
+DUMP_BASEDIRS=/tmp
+
+# where we accept to run pg_restore from
+PG_BINDIRS="/usr/bin /usr/lib/postgresql/*/bin /usr/pgsql-*/bin /usr/local/pgsql/bin"
+
+# local settings of the above, only trusted when root owns them
+CONFIG=/etc/default/pg_staging
+
 if [ $EUID -ne 0 ]; then
     echo "Must be run as root." >&2
     exit 1
 fi
 
+if [ -f $CONFIG ]; then
+    if [ `stat -c %u $CONFIG` -ne 0 ] || [ -n "`find $CONFIG -perm /022`" ]
+    then
+	echo "$0: $CONFIG must be owned and only writable by root" >&2
+	exit 1
+    fi
+    . $CONFIG
+fi
+
 function pgbouncer() {
     if [ ! -f $1 ]; then
 	echo "$0: unable to read new pgbouncer.ini at $1" >&2
@@ -278,6 +297,103 @@ EOF
     # maybe we're missing some options there
 }
 
+function check_dump() {
+    # $1 dump file, must be a .dump file in one of $DUMP_BASEDIRS
+    dump=`realpath -ms -- "$1"`
+    for dir in $DUMP_BASEDIRS; do
+	case $dump in
+	    "`realpath -ms -- "$dir"`"/*.dump)
+		return 0
+		;;
+	esac
+    done
+
+    echo "$0: not a dump file in $DUMP_BASEDIRS: $1" >&2
+    return 1
+}
+
+function fetch() {
+    # $1 url of the dump
+    # $2 local file to fetch it into, decompressed for .gz and .zst urls
+    # $3 checksum algorithm to report, sha256 or md5
+    #
+    # output lines are "resume <bytes>", "progress <bytes>", "size <bytes>"
+    # then "<algorithm> <hexdigest>", of the file as published
+
+    url=$1
+    dump=$2
+    algo=$3
+    partial="$dump".partial
+
+    check_dump "$dump" || return 1
+
+    case $algo in
+	"sha256"|"md5") ;;
+	*)
+	    echo "$0: unsupported checksum algorithm $algo" >&2
+	    return 1
+	    ;;
+    esac
+
+    case $url in
+	*.gz)  decompress="gzip -dc";;
+	*.zst) decompress="zstd -dcq";;
+	*)     decompress="";;
+    esac
+
+    mkdir -p `dirname "$dump"` || return 2
+
+    if [ -f "$partial" ]; then
+	echo "resume `stat -c %s "$partial"`"
+    fi
+
+    # resume an interrupted fetch, and report progress every second
+    curl --fail --silent --show-error -C - -o "$partial" "$url" &
+    pid=$!
+    while kill -0 $pid 2>/dev/null; do
+	sleep 1
+	echo "progress `stat -c %s "$partial" 2>/dev/null || echo 0`"
+    done
+    wait $pid || return 3
+
+    echo "size `stat -c %s "$partial"`"
+    echo "$algo `${algo}sum "$partial" | cut -d' ' -f1`"
+
+    if [ -n "$decompress" ]; then
+	$decompress "$partial" > "$dump" || return 4
+	rm -f "$partial"
+    else
+	mv "$partial" "$dump" || return 4
+    fi
+}
+
+function rmdump() {
+    # $1 dump file, removed together with its partial download
+    check_dump "$1" || return 1
+    rm -f "$1" "$1".partial
+}
+
+function restore() {
+    # $1 pg_restore binary, then its arguments, the dump file last
+    binary=`realpath -ms -- "$1"`
+    found=""
+    for dir in $PG_BINDIRS; do
+	if [ "$binary" = "$dir/pg_restore" -a -x "$binary" ]; then
+	    found=$binary
+	fi
+    done
+
+    if [ -z "$found" ]; then
+	echo "$0: not a PostgreSQL pg_restore binary: $1" >&2
+	return 1
+    fi
+
+    check_dump "${@: -1}" || return 1
+
+    shift
+    "$found" "$@"
+}
+
 command=$1
 shift
 
@@ -316,6 +432,15 @@ case $command in
     "dropdb")
 	dropdb $*;;
 
+    "fetch")
+	fetch "$@";;
+
+    "rmdump")
+	rmdump "$@";;
+
+    "pg_restore")
+	restore "$@";;
+
     *)
 	echo "unsupported command" >&2
 	exit 1